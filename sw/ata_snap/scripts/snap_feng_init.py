@@ -1,7 +1,6 @@
 #! /usr/bin/env python
 import argparse
 import time
-import yaml
 import logging
 import sys
 import socket
@@ -9,12 +8,13 @@ import casperfpga
 import struct
 
 from ata_snap import ata_snap_fengine
+from ata_snap import ata_snap_config
 
 def run(host, fpgfile, configfile,
         sync=False,
         mansync=False,
         tvg=False,
-        feng_id=0,
+        feng_id=None,
         dest_port=None,
         skipprog=False,
         usetapcp=False,
@@ -31,10 +31,12 @@ def run(host, fpgfile, configfile,
 
     assert not (eth_spec and eth_volt), "Can't use both --eth_spec and --eth_volt options!"
 
-    # Load configuration file and override parameters with
-    # user flags
-    with open(configfile, 'r') as fh:
-        config = yaml.load(fh, Loader=yaml.SafeLoader)
+    # Load configuration file, and the configuration compiled
+    # for this board, and override parameters with user flags
+    config, boards = ata_snap_config.load_config(configfile)
+    board = boards[host]
+    if feng_id is not None and feng_id != board.feng_id:
+        board.set_feng_id(feng_id)
 
     config['acclen'] = acclen or config['acclen']
     config['spectrometer_dest'] = specdest or config['spectrometer_dest']
@@ -48,7 +50,7 @@ def run(host, fpgfile, configfile,
     logger.info("Connecting to %s" % host)
     feng = ata_snap_fengine.AtaSnapFengine(host,
             transport=transport,
-            feng_id=feng_id)
+            feng_id=board.feng_id)
 
     if not skipprog:
         logger.info("Programming %s with %s" % (host, fpgfile))
@@ -63,26 +65,22 @@ def run(host, fpgfile, configfile,
 
     feng.set_accumulation_length(config['acclen'])
 
-    # Use the same coefficients for both polarizations
-    feng.eq_load_coeffs(0, config['coeffs'])
-    feng.eq_load_coeffs(1, config['coeffs'])
-
-    feng.eq_load_test_vectors(0, list(range(feng.n_chans_f)))
-    feng.eq_load_test_vectors(1, list(range(feng.n_chans_f)))
+    # Load the precompiled EQ coefficients (the same for both polarizations),
+    # test vectors and, if configured, voltage output headers and channel map
+    feng.fpga.write_int('chan_reorder_use_8bit', int(board.use_8bit))
+    feng.load_brams(board.brams)
     feng.eq_test_vector_mode(enable=tvg)
     feng.spec_test_vector_mode(enable=tvg)
 
-    # Configure arp table
-    for ip, mac in config['arp'].items():
-        print ("Configuring ip: %s with mac: %x" %(ip, mac))
-        for ethn, eth in enumerate(feng.fpga.gbes):
-            eth.set_single_arp_entry(ip, mac)
-
-    voltage_config = config.get('voltage_output', None)
-    n_interfaces = voltage_config.get('n_interfaces', feng.n_interfaces)
-    for i in range(n_interfaces):
-        ip = config["interfaces"][feng.fpga.host][i]
-        mac = config["arp"][ip]
+    # Configure arp table. Each interface is loaded with the complete
+    # table for its own subnet in a single write
+    for i, (ip, table) in enumerate(zip(board.interface_ips, board.arp_tables)):
+        logger.info("Configuring ARP table for interface %d (%s)" % (i, ip))
+        feng.eth_set_arp_table(table, interface=i)
+
+    for i in range(board.n_interfaces):
+        ip = board.interface_ips[i]
+        mac = board.interface_macs[i]
         port = 10000
         eth = feng.fpga.gbes['eth%i_core' %i]
         eth.configure_core(mac, ip, port)
@@ -90,20 +88,16 @@ def run(host, fpgfile, configfile,
     if eth_spec:
         feng.spec_set_destination(config['spectrometer_dest'])
 
-    if voltage_config is not None:
-        n_chans = voltage_config['n_chans']
-        start_chan = voltage_config['start_chan']
-        dests = voltage_config['dests']
-        logger.info('Voltage output sending channels %d to %d' % (start_chan, start_chan+n_chans-1))
-        logger.info('Destination IPs: %s' %dests)
-        logger.info('Using %d interfaces' % n_interfaces)
-        feng.select_output_channels(start_chan, n_chans, dests, n_interfaces=n_interfaces)
+    for dest, chans in board.chans.items():
+        logger.info('Voltage output sending channels %d to %d to %s' % (chans[0], chans[-1], dest))
+    if len(board.chans) > 0:
+        logger.info('Using %d interfaces' % board.n_interfaces)
 
     feng.eth_set_dest_port(config['dest_port'])
 
     if eth_spec:
         feng.eth_set_mode('spectra')
-        feng.fpga.write_int('corr_feng_id', feng_id)
+        feng.fpga.write_int('corr_feng_id', board.feng_id)
     elif eth_volt:
         feng.eth_set_mode('voltage')
 
@@ -137,8 +131,8 @@ if __name__ == '__main__':
                         help ='Use this flag to issue an internal sync rather than using a PPS')
     parser.add_argument('-t', dest='tvg', action='store_true', default=False,
                         help ='Use this flag to switch to post-fft test vector outputs')
-    parser.add_argument('-i', dest='feng_id', type=int,
-                        default=0, help='F-engine ID to write to this SNAP\'s output packets')
+    parser.add_argument('-i', dest='feng_id', type=int, default=None,
+                        help='F-engine ID to write to this SNAP\'s output packets. Default: get from config file, or 0')
     parser.add_argument('-p', dest='dest_port', type=int,
                         default=None, help='10GBe destination port')
     parser.add_argument('--skipprog', dest='skipprog', action='store_true', default=False,
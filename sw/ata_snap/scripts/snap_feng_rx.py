@@ -1,34 +1,7 @@
-#! /usr/bin/env python
-import socket
-import struct
-import numpy as np
-import time
-import sys
-import os
+#! /usr/bin/env python3
 import argparse
-from ata_snap import ata_control
-from subprocess import Popen
-
-RXBUF = 8500
-
-def unpack(pkt):
-    header = struct.unpack(">BBHHHQ", pkt[0:16])
-    d = np.fromstring(pkt[16:], dtype=">B")
-    h = {}
-    h['timestamp'] = header[5]
-    h['feng_id'] = header[4]
-    h['chan']    = header[3]
-    h['n_chans'] = header[2]
-    h['type']    = header[1]
-    h['version'] = header[0]
-    #h['feng_id'] = header[0] & 0xffff
-    #h['chan']    = (header[0] >> 16) & 0xffff
-    #h['n_chans'] = (header[0] >> 32) & 0xffff
-    #h['type']    = (header[0] >> 48) & 0xff
-    #h['version'] = (header[0] >> 56) & 0xff
-    x = d[0::2]
-    y = d[1::2]
-    return h, x, y
+from ata_snap import rx
+from ata_snap import voltage
 
 parser = argparse.ArgumentParser(description='Start a process to capture SNAP F-engine packets',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -36,27 +9,35 @@ parser.add_argument('-i', dest='ip', type=str, default='100.100.10.1',
                     help ='IP address on which to receive')
 parser.add_argument('-p', dest='port', type=int, default=10000,
                     help ='UDP port on which to receive')
+parser.add_argument('-c', dest='n_chans_per_packet', type=int, default=256,
+                    help ='Number of channels in each packet. Packets of other sizes are discarded')
+parser.add_argument('--batch', type=int, default=64,
+                    help ='Maximum number of packets to receive and decode at once')
 
 args = parser.parse_args()
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((args.ip, args.port))
+receiver = rx.UdpReceiver(args.ip, args.port, timeout=1.0)
+ring = rx.PacketRing(16 * args.batch, voltage.MAX_PACKET_BYTES)
+decoder = voltage.VoltageDecoder(args.n_chans_per_packet, max_packets=args.batch)
 
 print("Receiving on %s:%d" % (args.ip, args.port))
 
-starttime = time.time()
-
 try:
-    tick = time.time()
     while(True):
-        data = sock.recv(RXBUF)
-        h, x, y = unpack(data)
-        print(h)
-        for i in range(32):
-            print(x[i], end=' ')
-        print('|', end=' ')
-        for i in range(32):
-            print(y[i], end=' ')
-        print()
+        s, n = receiver.recv_batch(ring, args.batch)
+        if n == 0:
+            continue
+        # Short or malformed packets are counted by the decoder and skipped
+        headers, data = decoder.decode(ring.buf[s:s + n], ring.nbytes[s:s + n])
+        for h, d in zip(headers, data):
+            print({k: int(h[k]) for k in voltage.HEADER_DTYPE.names})
+            # First channel's time samples of each polarization
+            for pol in range(voltage.N_POLS):
+                for i in range(voltage.N_TIMES_PER_PACKET):
+                    print('%+d%+dj' % (d[0, i, pol].real, d[0, i, pol].imag), end=' ')
+                print('|' if pol == 0 else '', end=' ')
+            print()
 except KeyboardInterrupt:
     pass
+receiver.close()
+print("Received %d packets, discarded %d invalid packets" % (decoder.n_packets + decoder.n_invalid, decoder.n_invalid))
@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+import time
+import logging
+import argparse
+from ata_snap import rx
+from ata_snap import demux
+from ata_snap import spectra
+from ata_snap import voltage
+
+parser = argparse.ArgumentParser(description='Receive packets from multiple SNAP boards, using '
+                                             'multiple sockets, and keep per-board statistics',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('inttime', type=float,
+                    help = 'Number of seconds to receive for')
+parser.add_argument('-i', dest='ip', type=str, default='0.0.0.0',
+                    help ='IP address on which to receive')
+parser.add_argument('-p', dest='port', type=int, default=10000,
+                    help ='UDP port on which to receive')
+parser.add_argument('-n', dest='n_workers', type=int, default=None,
+                    help ='Number of receive sockets / processes. Default: number of CPUs')
+parser.add_argument('--format', dest='fmt', type=str, default='spectra', choices=list(demux.FORMATS.keys()),
+                    help ='Packet format')
+parser.add_argument('--route', dest='route', type=str, default='source', choices=demux.ROUTES,
+                    help ='How to split packets into streams')
+parser.add_argument('--rcvbuf', dest='rcvbuf', type=int, default=None,
+                    help ='Socket receive buffer size to request for each socket, in bytes. '
+                          'Default: enough for 0.5 seconds of packets at the expected packet rate')
+parser.add_argument('-a', dest='acc_len', type=int, default=1024,
+                    help ='Spectrometer accumulation length, in spectra. Used to compute the expected packet rate')
+parser.add_argument('-s', dest='srate', type=float, default=838.8608,
+                    help ='ADC sample rate, in MHz. Used to compute the expected packet rate')
+parser.add_argument('-b', dest='n_boards', type=int, default=12,
+                    help ='Number of boards sending spectra. Used to compute the expected packet rate')
+parser.add_argument('-c', dest='configfile', type=str, default=None,
+                    help ='Array configuration file. If provided, the expected voltage packet rate '
+                          'is computed from the channels each board sends to this host')
+parser.add_argument('-f', dest='filename', type=str, default=None,
+                    help ='If provided, record spectra from each board to a file with this prefix '
+                          '(the board address and a timestamp are appended). Spectrometer packets only')
+parser.add_argument('--products', dest='products', type=str, default='I', choices=list(spectra.PRODUCT_MODES),
+                    help ='Products to record with -f, stored together for each channel')
+
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# Expected packet rate, and so the socket buffer size required to ride out stalls.
+# Sockets are given a buffer large enough to take all the traffic, since the
+# kernel may put several boards' flows on the same socket
+rcvbuf = args.rcvbuf
+if rcvbuf is None:
+    if args.fmt == 'spectra':
+        packet_rate = args.n_boards * spectra.packet_rate(args.acc_len, args.srate)
+        packet_bytes = spectra.PACKET_BYTES
+    elif args.configfile is not None:
+        from ata_snap import ata_snap_config
+        config, boards = ata_snap_config.load_config(args.configfile)
+        packet_rate = sum(b.packet_rates(args.srate).get(args.ip, 0) for b in boards.values())
+        packet_bytes = voltage.MAX_PACKET_BYTES
+    else:
+        packet_rate = 0
+        packet_bytes = voltage.MAX_PACKET_BYTES
+    print("Expected packet rate: %.1f packets/s" % packet_rate)
+    rcvbuf = rx.rcvbuf_for_rate(packet_rate, packet_bytes)
+
+stream_factory = None
+if args.filename is not None:
+    assert args.fmt == 'spectra', "Only spectrometer packets can be recorded to file"
+    stream_factory = demux.FilePerStream("%s_%%s_%d.raw" % (args.filename, time.time()),
+                                         spectra.SpectraFileWriter, products=args.products)
+
+receiver = demux.MultiReceiver(args.ip, args.port, fmt=args.fmt, n_workers=args.n_workers,
+                               route=args.route, stream_factory=stream_factory, rcvbuf=rcvbuf)
+print("Receiving on %s:%d with %d sockets" % (args.ip, args.port, receiver.n_workers))
+receiver.start()
+stop = time.time() + args.inttime
+try:
+    while time.time() < stop:
+        time.sleep(1)
+        receiver.log_stats()
+except KeyboardInterrupt:
+    pass
+receiver.stop()
+print("")
+receiver.log_stats()
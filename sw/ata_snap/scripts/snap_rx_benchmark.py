@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+"""
+Measure the sustained spectrometer packet rate which can be received and
+recorded without loss, by replaying synthetic packets over the loopback
+interface at increasing rates.
+"""
+import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from ata_snap import rx
+from ata_snap import spectra
+from ata_snap import pipeline
+
+def receive(ip, port, duration, batch, block, rcvbuf, ready, results):
+    receiver = rx.UdpReceiver(ip, port, rcvbuf=rcvbuf, timeout=0.1)
+    ring = rx.PacketRing(16 * batch, spectra.PACKET_BYTES)
+    with open(os.devnull, 'wb') as fh:
+        recorder = spectra.SpectraRecorder(fh, block_spectra=block)
+        ready.set()
+        spectra.record(receiver, ring, recorder, duration, batch_packets=batch)
+        recorder.finish()
+    receiver.close()
+    results.put(recorder.n_packets)
+
+def make_packets(n_spectra):
+    pkts = np.zeros(n_spectra * spectra.N_PACKETS_PER_SPECTRUM, dtype=spectra.PACKET_DTYPE)
+    pkts['data'] = np.random.randint(0, 2**16, size=pkts['data'].shape)
+    return pkts.view(np.uint8).reshape(len(pkts), spectra.PACKET_BYTES)
+
+def run_trial(ip, port, rate, duration, batch, block, rcvbuf, use_pipeline=False):
+    """
+    Replay packets at `rate` packets per second for `duration` seconds.
+
+    :return: n_sent, n_received, achieved send rate
+    """
+    if use_pipeline:
+        capture = pipeline.CapturePipeline(ip, port, os.devnull, duration + 1.0, rcvbuf=rcvbuf,
+                                           block_packets=batch, block_spectra=block)
+        capture.start()
+        # Give the receive process time to bind its socket
+        time.sleep(0.5)
+    else:
+        ready = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=receive,
+                   args=(ip, port, duration + 1.0, batch, block, rcvbuf, ready, results))
+        proc.start()
+        ready.wait()
+    count = int(rate * duration) if rate is not None else None
+    pkts = make_packets(16)
+    n_sent, elapsed = rx.replay_packets(pkts, ip, port, rate=rate, duration=duration,
+                                        count=count, counter_offset=0)
+    if use_pipeline:
+        capture.join()
+        n_received = int(capture.stats()['receive']['packets'])
+    else:
+        n_received = results.get()
+        proc.join()
+    return n_sent, n_received, n_sent / elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the spectrometer receiver using loopback packet replay',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--ip', type=str, default='127.0.0.1',
+                        help='IP address to send to / receive on')
+    parser.add_argument('--port', type=int, default=10000,
+                        help='UDP port to send to / receive on')
+    parser.add_argument('-t', dest='duration', type=float, default=2.0,
+                        help='Duration of each trial, in seconds')
+    parser.add_argument('--rates', type=float, nargs='+',
+                        default=[10000, 20000, 40000, 80000, 160000, 320000],
+                        help='Packet rates to try, in packets per second')
+    parser.add_argument('--batch', type=int, default=256,
+                        help='Maximum number of packets to receive and decode at once')
+    parser.add_argument('--block', type=int, default=64,
+                        help='Number of spectra per disk write')
+    parser.add_argument('--rcvbuf', type=int, default=64*1024*1024,
+                        help='Socket receive buffer size to request, in bytes')
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help='Benchmark the multi-process capture pipeline rather than the single-process receiver')
+    args = parser.parse_args()
+
+    print("%12s %12s %12s %12s %10s" % ('Target', 'Achieved', 'Sent', 'Received', 'Lost'))
+    best = None
+    for rate in args.rates + [None]:
+        n_sent, n_received, achieved = run_trial(args.ip, args.port, rate, args.duration,
+                                                 args.batch, args.block, args.rcvbuf, args.pipeline)
+        lost = n_sent - n_received
+        print("%12s %12.0f %12d %12d %10d" % (rate or 'max', achieved, n_sent, n_received, lost))
+        if lost == 0 and (best is None or achieved > best):
+            best = achieved
+    if best is None:
+        print("Packets were lost at all rates")
+    else:
+        print("Highest loss-free rate: %.0f packets/s (%.1f Gb/s, %.0f spectra/s)" % (
+              best, best * spectra.PACKET_BYTES * 8 / 1e9, best / spectra.N_PACKETS_PER_SPECTRUM))
@@ -1,22 +1,20 @@
-#! /usr/bin/env python
-import socket
-import struct
-import numpy as np
+#! /usr/bin/env python3
 import time
 import sys
 import os
+import logging
 import argparse
+import functools
+import numpy as np
 from ata_snap import ata_control
-from subprocess import Popen
-
-def unpack(pkt):
-    header = struct.unpack(">Q", pkt[0:8])[0]
-    d = np.fromstring(pkt[8:], dtype=">i4")
-    xx = d[0::4]
-    yy = d[1::4]
-    #xy_r = d[3::4]
-    #xy_i = d[4::4]
-    return header, xx, yy
+from ata_snap import rx
+from ata_snap import pipeline
+from ata_snap import spectra
+from ata_snap import sigproc
+from ata_snap import decimate
+from ata_snap import dedisperse
+from ata_snap import fold
+from ata_snap import rfi
 
 parser = argparse.ArgumentParser(description='Start a process to write 10GbE SNAP data to disk',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -25,7 +23,7 @@ parser.add_argument('filename', type=str,
 parser.add_argument('inttime', type=float,
                     help = 'Number of seconds to record for')
 parser.add_argument('--makefb', dest='makefb', action='store_true', default=False,
-                    help ='Use this flag to add filterbank headers to raw files')
+                    help ='Use this flag to write a filterbank file, rather than a raw file')
 parser.add_argument('-s', dest='source', type=str, default="psrb0329+54",
                     help ='Source name (as per ATA catalog calls)')
 parser.add_argument('-a', dest='acc_len', type=int, default=1024,
@@ -36,110 +34,161 @@ parser.add_argument('-r', dest='rfc', type=float, default=3500.0,
                     help ='RF centre frequency in MHz')
 parser.add_argument('-i', dest='ifc', type=float, default=629.1452,
                     help ='IF centre frequency in MHz')
+parser.add_argument('--ip', dest='ip', type=str, default="10.10.10.131",
+                    help ='IP address on which to receive')
+parser.add_argument('--port', dest='port', type=int, default=10000,
+                    help ='UDP port on which to receive')
+parser.add_argument('--rcvbuf', dest='rcvbuf', type=int, default=None,
+                    help ='Socket receive buffer size to request, in bytes. Default: enough '
+                          'for 0.5 seconds of packets, given the accumulation length and sample rate')
+parser.add_argument('--batch', dest='batch', type=int, default=256,
+                    help ='Number of packets per shared memory packet block')
+parser.add_argument('--block', dest='block', type=int, default=64,
+                    help ='Number of spectra per disk write')
+parser.add_argument('--window', dest='window', type=int, default=2,
+                    help ='Number of blocks within which out-of-order packets are reordered')
+parser.add_argument('--fill', dest='fill', type=str, default='zero', choices=spectra.FILL_POLICIES,
+                    help ='How to fill in the data of missing packets. A mask of received packets '
+                          'is written alongside the data, with extension .mask')
+parser.add_argument('--products', dest='products', type=str, default='I', choices=list(spectra.PRODUCT_MODES),
+                    help ='Products to record, stored together for each channel: total power (I), '
+                          'per-polarization power (XXYY), full Stokes (IQUV), or the four spectrometer '
+                          'outputs (raw: XX, YY, real(XY*), imag(XY*))')
+parser.add_argument('--float16', dest='float16', action='store_true', default=False,
+                    help ='Record float16, rather than float32, values')
+parser.add_argument('--scale', dest='scale', type=float, default=1.0,
+                    help ='Factor by which to multiply recorded values. With --float16, values '
+                          'beyond 65504 are recorded as infinite, so the spectrometer outputs usually need scaling down')
+parser.add_argument('--decimate', dest='decimate', type=int, nargs=2, default=None, metavar=('NTIME', 'NCHAN'),
+                    help ='Also write a file of spectra decimated by summing or averaging NTIME spectra '
+                          'and NCHAN channels. NCHAN must divide the channels of a packet')
+parser.add_argument('--decimate-mode', dest='decimate_mode', type=str, default='mean', choices=decimate.MODES,
+                    help ='Whether decimated spectra are averages or sums')
+parser.add_argument('--rfi', dest='rfi', action='store_true', default=False,
+                    help ='Flag RFI in the spectra as they are received, and write the flags to a '
+                          'bit-packed file with extension .rfi')
+parser.add_argument('--rfi-threshold', dest='rfi_threshold', type=float, default=5.0,
+                    help ='RFI flagging threshold, in robust standard deviations')
+parser.add_argument('--rfi-replace', dest='rfi_replace', type=str, default=None, choices=rfi.REPLACE_POLICIES,
+                    help ='If given, replace data flagged as RFI with zeros, NaNs, or the channel\'s running median. '
+                          'NaNs may not be used with decimation, dedispersion or folding')
+parser.add_argument('--dm', dest='dms', type=float, nargs='+', default=None,
+                    help ='Dedisperse the spectra as they are received, at each of these DMs, '
+                          'and write a SIGPROC time series file for each')
+parser.add_argument('--fold', dest='fold_period', type=float, default=None,
+                    help ='Fold the spectra as they are received at this topocentric period, in seconds, '
+                          'and save the folded profiles to a .npz file')
+parser.add_argument('--fold-pdot', dest='fold_pdot', type=float, default=0.0,
+                    help ='Period derivative to fold with')
+parser.add_argument('--fold-epoch', dest='fold_epoch', type=float, default=None,
+                    help ='Unix time at which the folding period applies, and pulse phase is zero. '
+                          'Default: the sync time')
+parser.add_argument('--fold-bins', dest='fold_bins', type=int, default=128,
+                    help ='Number of phase bins to fold into')
+parser.add_argument('--sync-time', dest='sync_time', type=float, default=None,
+                    help ='Unix time of the F-engine\'s last sync, from which spectrum times are computed '
+                          'when folding. If not given, it is read from the board given by --snap')
+parser.add_argument('--snap', dest='snap', type=str, default=None,
+                    help ='Hostname of the SNAP board sending spectra, from which the sync time is read')
+parser.add_argument('--no-spectra', dest='no_spectra', action='store_true', default=False,
+                    help ='Don\'t write full resolution spectra, only the outputs of --decimate, --dm and --fold')
+parser.add_argument('--nblocks', dest='nblocks', type=int, default=64,
+                    help ='Number of blocks in each of the shared memory packet and spectrum buffers')
 
 
 args = parser.parse_args()
 
-PORT = 10000
-IP = "10.10.10.131"
-PACKETS_PER_SPECTRA = 4
-PRINT_PACKETS = 4000
-N_CHANNELS = 2048
-N_STOKES_PER_PACKET = 4
-BYTES_PER_WORD = 4
-HEADER_BYTES = 8
+N_CHANNELS = spectra.N_CHANS
 
-bytes_per_packet = BYTES_PER_WORD * N_CHANNELS * N_STOKES_PER_PACKET / PACKETS_PER_SPECTRA + HEADER_BYTES
-print "Bytes per packet: %d" % bytes_per_packet
+logging.basicConfig(level=logging.INFO, format='%(message)s')
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((IP, PORT))
+print("Bytes per packet: %d" % spectra.PACKET_BYTES)
+packet_rate = spectra.packet_rate(args.acc_len, args.srate)
+print("Expected packet rate: %.1f packets/s" % packet_rate)
+rcvbuf = args.rcvbuf or rx.rcvbuf_for_rate(packet_rate, spectra.PACKET_BYTES)
 
 starttime = time.time()
-fh = open("%s_%d.raw" % (args.filename, starttime), "w")
-fh_fullname = fh.name
-fh_basename = os.path.basename(fh_fullname)
+fh_fullname = "%s_%d.%s" % (args.filename, starttime, 'fil' if args.makefb else 'raw')
+header = None
+if args.makefb or args.dms is not None or args.fold_period is not None:
+    ra, dec = ata_control.get_ra_dec(args.source, deg=False)
+    header = sigproc.spectrometer_header(args.source, ra, dec, args.acc_len, args.srate,
+                                         args.rfc, args.ifc, starttime, n_chans=N_CHANNELS,
+                                         nifs=len(spectra.PRODUCT_MODES[args.products]),
+                                         nbits=16 if args.float16 else 32,
+                                         rawdatafile=os.path.basename(fh_fullname))
+processors = []
+if args.dms is not None:
+    # Dedisperse in the write process. The time series are written as they are made
+    processors += [functools.partial(dedisperse.TimeSeriesWriter, fh_fullname, args.dms, header,
+                                     products=args.products)]
+    print("Dedispersing at DMs %s" % args.dms)
+if args.fold_period is not None:
+    sync_time = args.sync_time
+    if sync_time is None:
+        assert args.snap is not None, "Folding requires the sync time. Use --sync-time or --snap"
+        from ata_snap import ata_snap_fengine
+        sync_time = ata_snap_fengine.AtaSnapFengine(args.snap).sync_get_last_sync_time()
+    epoch = sync_time if args.fold_epoch is None else args.fold_epoch
+    ephemeris = fold.Ephemeris.from_period(args.fold_period, epoch=epoch, pdot=args.fold_pdot)
+    fold_filename = "%s_%d.fold.npz" % (args.filename, starttime)
+    processors += [functools.partial(fold.Folder, ephemeris, header, sync_time, n_bins=args.fold_bins,
+                                     products=args.products, filename=fold_filename)]
+    print("Folding at period %.9f s with sync time %d" % (args.fold_period, sync_time))
+if args.makefb:
+    # Stream spectra straight into a filterbank file. The number of
+    # samples is filled in when the file is closed
+    print("Writing filterbank file with header:")
+    print(header)
 
-pkt_cnt = 0
-missing_packets_count = 0
-wait = True
+# Receive, decode and disk writes run in separate processes, so that
+# slow writes are absorbed by the shared memory rings rather than
+# causing packets to be dropped
+capture = pipeline.CapturePipeline(args.ip, args.port, fh_fullname, args.inttime,
+                                   rcvbuf=rcvbuf,
+                                   block_packets=args.batch,
+                                   n_packet_blocks=args.nblocks,
+                                   block_spectra=args.block,
+                                   n_spectrum_blocks=args.nblocks,
+                                   window_blocks=args.window,
+                                   fill=args.fill,
+                                   header=header if args.makefb else None,
+                                   products=args.products,
+                                   out_dtype=np.float16 if args.float16 else np.float32,
+                                   scale=args.scale,
+                                   decimation=args.decimate,
+                                   decimate_mode=args.decimate_mode,
+                                   keep_full=not args.no_spectra,
+                                   rfi_flagging={'threshold': args.rfi_threshold,
+                                                 'replace': args.rfi_replace} if args.rfi else None,
+                                   processors=processors)
+capture.start()
 try:
-    tick = time.time()
-    while(True):
-        data = sock.recv(bytes_per_packet)
-        h, xx, yy = unpack(data)
-        if wait:
-            if h % PACKETS_PER_SPECTRA == 0:
-                wait = False
-            else:
-                continue
-        if pkt_cnt != 0:
-            if h != last_h + 1:
-                missing_packets = h - last_h - 1
-                missing_packets_count += missing_packets
-                print "%d PACKETS LOST! (running total: %d)" % (missing_packets, missing_packets_count)
-                padding = np.zeros(missing_packets * N_CHANNELS / PACKETS_PER_SPECTRA, dtype=np.float32).tostring()
-                fh.write(padding)
-                pkt_cnt += missing_packets
-        last_h = h
-        I = (np.array(xx, dtype=np.float32) + np.array(yy, dtype=np.float32)).tostring()
-        #I = np.array(xx, dtype=np.float32).tostring()
-        pkt_cnt += 1
-        if pkt_cnt % PRINT_PACKETS == 0:
-            tock = time.time()
-            n_spectra = pkt_cnt / PACKETS_PER_SPECTRA
-            print "Received packet %d (spectra %d) (last %d spectra took %.1f seconds)" % (pkt_cnt, n_spectra, PRINT_PACKETS / PACKETS_PER_SPECTRA, tock-tick)
-            tick = tock
-        fh.write(I)
-        if time.time() > (starttime + args.inttime):
-            break
+    while capture.is_alive():
+        time.sleep(1)
+        capture.log_stats()
 except KeyboardInterrupt:
     pass
+capture.join()
+stats = capture.stats()
 
-# Deal with the case of closing file
-# When we're mid way through a spectra
-straggling_packets = pkt_cnt % PACKETS_PER_SPECTRA
-for i in range(straggling_packets):
-    fh.write(np.zeros(N_CHANNELS / PACKETS_PER_SPECTRA, dtype=np.float32).tostring())
-print ""
-print "Closing %s" % fh.name
-print "Recorded %d spectra" % (pkt_cnt / PACKETS_PER_SPECTRA)
-print "Dropped %d packets" % missing_packets_count
-print "Wrote zeros for %d straggling packets to end on a complete spectra" % straggling_packets
-fh.close()
-
-# Finally make the filterbank header
-if args.makefb:
-    print "Making filterbank header"
-    ra, dec = ata_control.get_ra_dec(args.source, deg=False)
-    fbhdr_filename = fh_fullname + ".fbhdr"
-    fb_args = [
-      "-o", fbhdr_filename,
-      "-nifs", "1",
-      "-fch1", "%8f" % (args.rfc - args.srate/2. + args.ifc),
-      "-source", args.source.strip("psr").upper(),
-      "-filename", fh_basename,
-      "-telescope", "ATA",
-      "-src_raj", ra.replace(":",""),
-      "-src_dej", dec.replace(":",""),
-      "-tsamp", "%.8f" % (args.acc_len * N_CHANNELS * 2 / args.srate), # outputs micrpsecs for srate in MHz
-      "-foff", "%.8f" % (-args.srate / 2 / N_CHANNELS), # in MHz for srate in MHz
-      "-nbits", "32",
-      "-nchans", "%d" % N_CHANNELS,
-      "-tstart", "%.8f" % (starttime / 86400. + 40587),
-    ]
-    print "Making filterbank header with arguments:"
-    print fb_args
-
-    proc = Popen(["filterbank_mkheader"] + fb_args)
-    proc.wait()
-
-    print "Reading header file"
-    with open(fh_fullname, "rb") as fh:
-        data = fh.read()
-    print "Reading data file"
-    with open(fbhdr_filename, "rb") as fh:
-        header = fh.read()
-    print "Writing filterbank file"
-    with open(fh_fullname + ".fil", "wb") as fh:
-        fh.write(header + data)
+print("")
+if not args.no_spectra:
+    print("Closed %s" % fh_fullname)
+print("Recorded %d spectra" % stats['write']['spectra'])
+if args.decimate is not None:
+    print("Wrote %d decimated spectra to %s" % (stats['write']['decimated'], capture.decimate_filename))
+if args.dms is not None:
+    for dm in args.dms:
+        print("Wrote DM %.2f time series to %s" % (dm, dedisperse.timeseries_filename(fh_fullname, dm)))
+if args.fold_period is not None:
+    print("Wrote folded profiles to %s" % fold_filename)
+if args.rfi:
+    print("Flagged %d samples as RFI" % stats['write']['flagged'])
+print("%d spectra had missing packets" % stats['reduce']['invalid'])
+print("Dropped %d packets" % stats['reduce']['missing'])
+print("Discarded %d late packets" % stats['reduce']['late'])
+loss = capture.loss_report()
+print("Dropped %d packets in the kernel socket buffer" % loss['kernel_drops'])
+print("Discarded %d packets because the pipeline was full" % loss['app_drops'])
+print("Lost %d packets before they reached this host" % loss['upstream'])
@@ -0,0 +1,149 @@
+#! /usr/bin/env python3
+"""
+Measure the rate at which voltage packets can be decoded, and compare it
+with the rate at which an F-engine sends them for a given band, or
+measure the throughput of a voltage processing stage.
+"""
+import time
+import argparse
+import numpy as np
+from ata_snap import voltage
+from ata_snap import xengine
+from ata_snap import beamform
+from ata_snap import upchan
+
+def make_packets(n_packets, n_chans_per_packet, feng_id=0):
+    size = voltage.HEADER_BYTES + voltage.payload_bytes(n_chans_per_packet)
+    buf = np.random.randint(0, 256, size=(n_packets, size)).astype(np.uint8)
+    headers = np.zeros(n_packets, dtype=voltage.HEADER_DTYPE)
+    headers['n_chans'] = n_chans_per_packet
+    headers['feng_id'] = feng_id
+    headers['timestamp'] = np.arange(n_packets) * voltage.N_TIMES_PER_PACKET
+    buf[:, 0:voltage.HEADER_BYTES] = headers.view(np.uint8).reshape(n_packets, voltage.HEADER_BYTES)
+    return buf
+
+def bench_decode(buf, n_chans_per_packet, out_format, duration):
+    """
+    Decode batches of packets for `duration` seconds.
+
+    :return: Packets decoded per second
+    """
+    decoder = voltage.VoltageDecoder(n_chans_per_packet, max_packets=len(buf), out_format=out_format)
+    decoder.decode(buf)
+    n = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        decoder.decode(buf)
+        n += len(buf)
+    return n / (time.monotonic() - start)
+
+def make_block(n_ants, n_chans, n_times):
+    shape = (n_ants, n_chans, n_times, voltage.N_POLS)
+    re = np.random.randint(-8, 8, size=shape)
+    im = np.random.randint(-8, 8, size=shape)
+    return (re + 1j * im).astype(np.complex64)
+
+def bench_stage(stage, block, duration):
+    """
+    Process `block` with `stage` repeatedly for `duration` seconds.
+
+    :return: Blocks processed per second
+    """
+    stage.process(block)
+    n = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        stage.process(block)
+        n += 1
+    return n / (time.monotonic() - start)
+
+def run_decode(args):
+    required = voltage.packet_rate(args.n_chans, args.srate, args.n_chans_per_packet)
+    packet_bytes = voltage.HEADER_BYTES + voltage.payload_bytes(args.n_chans_per_packet)
+    print("Required: %.0f packets/s (%.2f Gb/s)" % (required, required * packet_bytes * 8 / 1e9))
+    buf = make_packets(args.batch, args.n_chans_per_packet)
+    print("%10s %14s %10s %10s" % ('Format', 'Packets/s', 'Gb/s', 'Margin'))
+    for out_format in voltage.OUTPUT_FORMATS:
+        rate = bench_decode(buf, args.n_chans_per_packet, out_format, args.duration)
+        print("%10s %14.0f %10.2f %10.2f" % (out_format, rate, rate * packet_bytes * 8 / 1e9, rate / required))
+
+def run_xengine(args):
+    block = make_block(args.n_ants, args.n_chans, args.block_times)
+    n_baselines = len(xengine.baselines(args.n_ants)[0])
+    # Time samples per second in each channel
+    required = args.srate * 1e6 / (2 * voltage.N_CHANS_F)
+    print("%d antennas, %d baselines, %d channels, %d samples per block" % (
+          args.n_ants, n_baselines, args.n_chans, args.block_times))
+    print("%8s %20s %10s" % ('Threads', 'Baseline-chans', 'Margin'))
+    for n_threads in args.threads:
+        corr = xengine.Correlator(args.n_ants, args.n_chans, n_int=2**62, n_threads=n_threads)
+        rate = bench_stage(corr, block, args.duration) * args.block_times / required
+        corr.close()
+        # Rate is in seconds of data processed per second, so this is the number
+        # of baseline-channels which could be correlated in real time
+        print("%8d %20.0f %10.2f" % (n_threads, rate * n_baselines * args.n_chans, rate))
+
+def run_beamform(args):
+    block = make_block(args.n_ants, args.n_chans, args.block_times)
+    weights = np.exp(2j * np.pi * np.random.uniform(size=(args.n_beams, args.n_ants, args.n_chans)))
+    required = args.srate * 1e6 / (2 * voltage.N_CHANS_F)
+    print("%d antennas, %d beams, %d channels, %d samples per block" % (
+          args.n_ants, args.n_beams, args.n_chans, args.block_times))
+    print("%8s %20s %10s" % ('Threads', 'Beam-chans', 'Margin'))
+    for n_threads in args.threads:
+        bf = beamform.Beamformer(weights, n_int=args.n_int, incoherent=True, n_threads=n_threads)
+        rate = bench_stage(bf, block, args.duration) * args.block_times / required
+        bf.close()
+        print("%8d %20.0f %10.2f" % (n_threads, rate * args.n_beams * args.n_chans, rate))
+
+def run_upchan(args):
+    block = make_block(1, args.n_chans, args.block_times)[0]
+    required = args.srate * 1e6 / (2 * voltage.N_CHANS_F)
+    print("%d-point FFT, %d taps, %d channels, %d samples per block" % (
+          args.n_fft, args.n_taps, args.n_chans, args.block_times))
+    up = upchan.Upchannelizer(args.n_fft, n_taps=args.n_taps, n_int=args.n_int)
+    blocks_per_sec = bench_stage(up, block, args.duration)
+    # Samples per second of each channel, relative to the F-engine's output
+    rate = blocks_per_sec * args.block_times / required
+    print("%.3g channel-samples/s, %.0f channels in real time" % (
+          blocks_per_sec * args.block_times * args.n_chans, rate * args.n_chans))
+
+STAGES = {
+    'decode': run_decode,
+    'xengine': run_xengine,
+    'beamform': run_beamform,
+    'upchan': run_upchan,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark decoding and processing of F-engine voltage packets',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', dest='srate', type=float, default=2048.0,
+                        help='ADC sample rate, in MHz')
+    parser.add_argument('-n', dest='n_chans', type=int, default=1024,
+                        help='Number of channels received, eg. by one 10GbE port')
+    parser.add_argument('-a', dest='n_ants', type=int, default=16,
+                        help='Number of antennas in each voltage block')
+    parser.add_argument('--stage', type=str, default='decode', choices=list(STAGES.keys()),
+                        help='Processing stage to benchmark')
+    parser.add_argument('-c', dest='n_chans_per_packet', type=int, default=256,
+                        help='Number of channels in each packet')
+    parser.add_argument('--batch', type=int, default=256,
+                        help='Number of packets decoded at once')
+    parser.add_argument('--block-times', dest='block_times', type=int, default=2048,
+                        help='Number of time samples in each voltage block')
+    parser.add_argument('--beams', dest='n_beams', type=int, default=4,
+                        help='Number of coherent beams to form')
+    parser.add_argument('--int', dest='n_int', type=int, default=64,
+                        help='Number of time samples integrated into each detected beam sample')
+    parser.add_argument('--fft', dest='n_fft', type=int, default=1024,
+                        help='Upchannelizer FFT length')
+    parser.add_argument('--taps', dest='n_taps', type=int, default=4,
+                        help='Upchannelizer PFB taps')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Numbers of threads to try')
+    parser.add_argument('-t', dest='duration', type=float, default=2.0,
+                        help='Duration of each trial, in seconds')
+    args = parser.parse_args()
+
+    STAGES[args.stage](args)
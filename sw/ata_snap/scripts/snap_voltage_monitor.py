@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+"""
+Receive F-engine voltage packets, and periodically report the RMS and
+clipping of their 4-bit samples. Optionally, correct the boards' EQ
+coefficients to bring each channel's RMS to a target.
+"""
+import time
+import logging
+import argparse
+import numpy as np
+from ata_snap import rx
+from ata_snap import voltage
+from ata_snap import quantstats
+from ata_snap import ata_snap_config
+from ata_snap import ata_snap_fengine
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monitor the quantization of F-engine voltage packets',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', dest='ip', type=str, default='100.100.10.1',
+                        help='IP address on which to receive')
+    parser.add_argument('-p', dest='port', type=int, default=10000,
+                        help='UDP port on which to receive')
+    parser.add_argument('-C', dest='configfile', type=str, default=None,
+                        help='Configuration file, from which the boards and channels sent to this IP are found')
+    parser.add_argument('-f', dest='feng_ids', type=int, nargs='+', default=[0],
+                        help='F-engine IDs to monitor, if no configuration file is given')
+    parser.add_argument('-s', dest='start_chan', type=int, default=0,
+                        help='First channel received, if no configuration file is given')
+    parser.add_argument('-n', dest='n_chans', type=int, default=voltage.N_CHANS_F,
+                        help='Number of channels received, if no configuration file is given')
+    parser.add_argument('-c', dest='n_chans_per_packet', type=int, default=256,
+                        help='Number of channels in each packet')
+    parser.add_argument('--interval', type=float, default=10.0,
+                        help='Seconds between reports')
+    parser.add_argument('-t', dest='duration', type=float, default=None,
+                        help='Seconds for which to run. Default: until interrupted')
+    parser.add_argument('--update-eq', dest='update_eq', action='store_true',
+                        help='After each report, correct the EQ coefficients of each board. '
+                             'Requires a configuration file.')
+    parser.add_argument('--target-rms', dest='target_rms', type=float, default=1.0,
+                        help='Target RMS of each channel, in 4-bit LSBs, when correcting EQ coefficients')
+    parser.add_argument('--batch', type=int, default=256,
+                        help='Maximum number of packets to receive and process at once')
+    parser.add_argument('--rcvbuf', type=int, default=64*1024*1024,
+                        help='Socket receive buffer size to request, in bytes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger(__file__)
+
+    fengs = {}
+    if args.configfile is not None:
+        config, boards = ata_snap_config.load_config(args.configfile)
+        boards = [b for b in boards.values() if args.ip in b.chans]
+        if len(boards) == 0:
+            raise ValueError("No board sends channels to %s" % args.ip)
+        feng_ids = [b.feng_id for b in boards]
+        chans = np.concatenate([np.asarray(b.chans[args.ip]).ravel() for b in boards])
+        chans = np.arange(chans.min(), chans.max() + 1)
+        if args.update_eq:
+            for b in boards:
+                fengs[b.feng_id] = ata_snap_fengine.AtaSnapFengine(b.host, feng_id=b.feng_id)
+    elif args.update_eq:
+        raise ValueError("A configuration file is required to correct EQ coefficients")
+    else:
+        feng_ids = args.feng_ids
+        chans = np.arange(args.start_chan, args.start_chan + args.n_chans)
+
+    monitor = quantstats.QuantizationMonitor(feng_ids, chans, args.n_chans_per_packet, interval=args.interval)
+    receiver = rx.UdpReceiver(args.ip, args.port, rcvbuf=args.rcvbuf, timeout=0.1)
+    ring = rx.PacketRing(16 * args.batch, voltage.MAX_PACKET_BYTES)
+    logger.info("Monitoring F-engines %s, channels %d-%d, on %s:%d" % (
+                feng_ids, chans[0], chans[-1], args.ip, args.port))
+
+    start = time.monotonic()
+    try:
+        while args.duration is None or time.monotonic() - start < args.duration:
+            s, n = receiver.recv_batch(ring, args.batch)
+            if n > 0:
+                monitor.add_packets(ring.buf[s:s + n], ring.nbytes[s:s + n])
+            summary = monitor.poll()
+            if summary is None:
+                continue
+            for feng_id, feng in fengs.items():
+                if feng_id not in summary:
+                    continue
+                logger.info("Correcting EQ coefficients of %s" % feng.host)
+                monitor.update_eq(feng, target_rms=args.target_rms)
+    except KeyboardInterrupt:
+        pass
+    receiver.close()
+    logger.info("Monitored %d packets (%d invalid)" % (monitor.n_packets, monitor.n_invalid))
@@ -0,0 +1,127 @@
+#! /usr/bin/env python3
+"""
+Receive F-engine voltage packets, assemble them into blocks, and record
+the blocks, still packed at 4 bits, to GUPPI raw files.
+"""
+import time
+import logging
+import argparse
+import numpy as np
+from ata_snap import rx
+from ata_snap import voltage
+from ata_snap import assemble
+from ata_snap import guppi
+from ata_snap import sigproc
+from ata_snap import ata_control
+from ata_snap import ata_snap_config
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record F-engine voltage packets to GUPPI raw files',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', dest='ip', type=str, default='100.100.10.1',
+                        help='IP address on which to receive')
+    parser.add_argument('-p', dest='port', type=int, default=10000,
+                        help='UDP port on which to receive')
+    parser.add_argument('-o', dest='filename', type=str, default='voltages',
+                        help='Base output file name, to which the start time and file number are appended')
+    parser.add_argument('-C', dest='configfile', type=str, default=None,
+                        help='Configuration file, from which the boards and channels sent to this IP are found')
+    parser.add_argument('-f', dest='feng_ids', type=int, nargs='+', default=[0],
+                        help='F-engine IDs to record, if no configuration file is given')
+    parser.add_argument('-s', dest='start_chan', type=int, default=0,
+                        help='First channel received, if no configuration file is given')
+    parser.add_argument('-n', dest='n_chans', type=int, default=256,
+                        help='Number of channels received, if no configuration file is given')
+    parser.add_argument('-c', dest='n_chans_per_packet', type=int, default=256,
+                        help='Number of channels in each packet')
+    parser.add_argument('-t', dest='duration', type=float, default=None,
+                        help='Seconds for which to record. Default: until interrupted')
+    parser.add_argument('--srate', dest='srate', type=float, default=2048.0,
+                        help='ADC sample rate, in MHz')
+    parser.add_argument('--rfc', dest='rfc', type=float, default=0.0,
+                        help='RF centre frequency, in MHz')
+    parser.add_argument('--ifc', dest='ifc', type=float, default=629.1452,
+                        help='IF centre frequency, in MHz')
+    parser.add_argument('--source', dest='source', type=str, default=None,
+                        help='Source name, whose coordinates are looked up for the file headers')
+    parser.add_argument('--sync-time', dest='sync_time', type=float, default=None,
+                        help='Unix time of the F-engines\' last sync, from which block times are computed. '
+                             'Default: the time the first block is received')
+    parser.add_argument('--block-times', dest='block_times', type=int, default=8192,
+                        help='Number of time samples in each block')
+    parser.add_argument('--blocks-per-file', dest='blocks_per_file', type=int, default=128,
+                        help='Number of blocks in each file')
+    parser.add_argument('--direct-io', dest='direct_io', action='store_true',
+                        help='Write files with O_DIRECT, bypassing the page cache')
+    parser.add_argument('--align', type=int, default=4096,
+                        help='With --direct-io, the size, in bytes, of which every block written is a multiple')
+    parser.add_argument('--batch', type=int, default=256,
+                        help='Maximum number of packets to receive and assemble at once')
+    parser.add_argument('--rcvbuf', type=int, default=256*1024*1024,
+                        help='Socket receive buffer size to request, in bytes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger(__file__)
+
+    if args.configfile is not None:
+        config, boards = ata_snap_config.load_config(args.configfile)
+        boards = [b for b in boards.values() if args.ip in b.chans]
+        if len(boards) == 0:
+            raise ValueError("No board sends channels to %s" % args.ip)
+        feng_ids = [b.feng_id for b in boards]
+        chans = np.concatenate([np.asarray(b.chans[args.ip]).ravel() for b in boards])
+        chans = np.arange(chans.min(), chans.max() + 1)
+    else:
+        feng_ids = args.feng_ids
+        chans = np.arange(args.start_chan, args.start_chan + args.n_chans)
+
+    source, ra, dec = 'unknown', '00:00:00', '00:00:00'
+    if args.source is not None:
+        source = args.source
+        ra, dec = ata_control.get_ra_dec(args.source, deg=False)
+    spectra_per_sec = args.srate * 1e6 / (2 * voltage.N_CHANS_F)
+
+    asm = assemble.VoltageAssembler(feng_ids, chans, args.n_chans_per_packet, block_times=args.block_times,
+                                    out_format='packed', max_packets=args.batch)
+    receiver = rx.UdpReceiver(args.ip, args.port, rcvbuf=args.rcvbuf, timeout=0.1)
+    ring = rx.PacketRing(16 * args.batch, voltage.MAX_PACKET_BYTES)
+    logger.info("Recording F-engines %s, channels %d-%d, from %s:%d" % (
+                feng_ids, chans[0], chans[-1], args.ip, args.port))
+
+    writer = None
+    start = time.monotonic()
+    try:
+        while args.duration is None or time.monotonic() - start < args.duration:
+            s, n = receiver.recv_batch(ring, args.batch)
+            if n > 0:
+                asm.add_packets(ring.buf[s:s + n], ring.nbytes[s:s + n])
+            else:
+                asm.poll()
+            for block in asm.get():
+                if writer is None:
+                    if args.sync_time is None:
+                        tstart = time.time()
+                    else:
+                        tstart = args.sync_time + block.timestamp / spectra_per_sec
+                    filename = '%s_%d' % (args.filename, tstart)
+                    header = sigproc.voltage_header(source, ra, dec, args.srate, args.rfc, args.ifc,
+                                                    tstart, chans)
+                    writer = guppi.RawWriter(filename, header, feng_ids, chans, args.block_times,
+                                             blocks_per_file=args.blocks_per_file,
+                                             direct_io=args.direct_io, align=args.align)
+                    logger.info("Writing to %s" % guppi.raw_filename(filename, 0))
+                writer.write(block.data, block.timestamp, block.valid())
+                asm.free(block)
+    except KeyboardInterrupt:
+        pass
+    asm.flush()
+    for block in asm.get():
+        if writer is not None:
+            writer.write(block.data, block.timestamp, block.valid())
+        asm.free(block)
+    receiver.close()
+    if writer is not None:
+        writer.close()
+        logger.info("Wrote %d blocks (%.1f MB)" % (writer.n_blocks, writer.nbytes / 1e6))
+    logger.info("Assembler statistics: %s" % asm.stats())
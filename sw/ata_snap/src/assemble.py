@@ -0,0 +1,413 @@
+"""
+Assembly of voltage packets from many F-engines into time blocks.
+
+Each SNAP board sends the channels selected by
+`AtaSnapFengine.select_output_channels` as a stream of packets, each
+holding `n_chans_per_packet` channels and `voltage.N_TIMES_PER_PACKET`
+time samples, identified by the `feng_id`, `chan` and `timestamp` fields of
+its header. A `VoltageAssembler` corner-turns these packets into a
+preallocated buffer with dimensions
+[time block, antenna, channel, time, polarization], in which each packet's
+position is computed from its header, so that packets from all the boards
+of a batch are placed with a single vectorized assignment.
+
+A block is released to consumers when all its packets have arrived, when
+it has waited for `timeout` seconds since its first packet, or when packets
+for a much later block arrive. Blocks are released in time order, as views
+of the buffer, and their buffer slot is only reused once the consumer has
+freed them. Packets for blocks which have already been released are
+counted as late, and packets which never arrived are counted as missing,
+for each board.
+
+Packets more than `max_jump` blocks before or after the next block to be
+released, such as those of a board which is not synchronized with the
+others, are discarded. If only such packets arrive for a while, as when the
+F-engines are re-synchronized and their timestamps restart, the assembler
+is reset, and starts again from their timestamps.
+
+Example usage:
+    asm = VoltageAssembler([1, 2, 3], range(1024, 2048), n_chans_per_packet=256)
+    asm.add_packets(ring.buf[start:start + n], ring.nbytes[start:start + n])
+    for block in asm.get():
+        process(block.data, block.valid())
+        asm.free(block)
+"""
+
+import time
+import logging
+import collections
+import numpy as np
+
+from . import voltage
+
+#: Counters kept for each board
+BOARD_STATS = (
+    'packets',    # Packets placed in a block
+    'late',       # Packets discarded because their block had already been released
+    'missing',    # Packets which had not arrived when their block was released
+    'duplicate',  # Packets received more than once
+)
+
+#: Counters kept for the assembler as a whole
+ASSEMBLER_STATS = (
+    'blocks',     # Blocks released
+    'complete',   # Blocks released with all their packets
+    'timed_out',  # Blocks released incomplete, because they timed out or were overtaken
+    'skipped',    # Blocks for which no packets arrived
+    'unknown',    # Packets discarded because their F-engine ID or channel was not expected
+    'overflow',   # Packets discarded because no buffer slot was free
+    'out_of_range', # Packets discarded because their block was more than max_jump blocks from the next block
+    'resets',     # Times the assembler was reset, because packets were consistently out of range
+)
+
+class VoltageBlock(object):
+    """
+    A block of assembled voltages, which is a view of a slot of the
+    assembler's buffer. Pass it to `VoltageAssembler.free` when done with it.
+
+    :ivar index: Block number, ie. timestamp // block_times
+    :ivar timestamp: Timestamp, in samples, of the first time sample in the block
+    :ivar data: Voltages, with dimensions [antenna, channel, time, polarization].
+        Samples of packets which did not arrive are zero.
+    :ivar mask: Arrival mask, with dimensions [antenna, packet channel group, packet time],
+        which is True where a packet arrived
+    :ivar complete: True if all the block's packets arrived
+    :ivar slot: Buffer slot holding the block
+    """
+    def __init__(self, index, timestamp, data, mask, slot):
+        self.index = index
+        self.timestamp = timestamp
+        self.data = data
+        self.mask = mask
+        self.complete = bool(mask.all())
+        self.slot = slot
+
+    def valid(self):
+        """
+        Expand the arrival mask to individual samples.
+
+        :return: Boolean mask, with dimensions [antenna, channel, time], which is True
+            where data arrived
+        :rtype: numpy.ndarray
+        """
+        n_chans_per_packet = self.data.shape[1] // self.mask.shape[1]
+        return np.repeat(np.repeat(self.mask, n_chans_per_packet, axis=1),
+                         voltage.N_TIMES_PER_PACKET, axis=2)
+
+class VoltageAssembler(object):
+    """
+    Assemble voltage packets from several F-engines into time blocks.
+
+    :param feng_ids: F-engine IDs of the boards, in the order in which they
+        should appear on the antenna axis
+    :type feng_ids: list
+    :param chans: Channels received, as returned for this destination by
+        `AtaSnapFengine.select_output_channels`. These must be contiguous.
+    :type chans: list
+    :param n_chans_per_packet: Number of channels in each packet
+    :type n_chans_per_packet: int
+    :param block_times: Number of time samples per block. Must be a multiple of
+        voltage.N_TIMES_PER_PACKET
+    :type block_times: int
+    :param n_slots: Number of blocks in the buffer, including those held by consumers
+    :type n_slots: int
+    :param n_active: Number of blocks which may be assembled at once. A packet for
+        a block `n_active` or more blocks after the oldest block being assembled
+        causes the oldest block to be released, complete or not.
+    :type n_active: int
+    :param timeout: Seconds after a block's first packet at which it is released,
+        complete or not
+    :type timeout: float
+    :param out_format: Sample format. One of voltage.OUTPUT_FORMATS.
+    :type out_format: str
+    :param max_packets: Maximum number of packets passed to `add_packets` at once
+    :type max_packets: int
+    :param max_jump: Number of blocks before or after the next block to be released
+        beyond which packets are out of range. Out of range packets, eg. from an
+        unsynchronized board, or with corrupt headers, are discarded.
+    :type max_jump: int
+    :param resync_packets: Number of consecutive out of range packets after which the
+        assembler is reset (see `reset`), and starts assembling from their timestamps,
+        eg. after the F-engines are re-synchronized. Default: the number of packets in a block.
+    :type resync_packets: int
+
+    :ivar buf: Buffer, with dimensions [slot, antenna, channel, time, polarization]
+    :ivar mask: Arrival masks, with dimensions [slot, antenna, packet channel group, packet time]
+    :ivar board_stats: Counters, with dimensions [antenna, BOARD_STATS]
+    """
+    def __init__(self, feng_ids, chans, n_chans_per_packet, block_times=8192, n_slots=8, n_active=2,
+                 timeout=1.0, out_format='complex64', max_packets=1024, max_jump=64, resync_packets=None):
+        self.logger = logging.getLogger('VoltageAssembler')
+        chans = np.asarray(chans)
+        if not np.all(np.diff(chans) == 1):
+            raise ValueError("Channels must be contiguous")
+        if len(chans) % n_chans_per_packet != 0:
+            raise ValueError("Number of channels (%d) must be a multiple of the channels per packet (%d)" % (
+                             len(chans), n_chans_per_packet))
+        if block_times % voltage.N_TIMES_PER_PACKET != 0:
+            raise ValueError("Block length must be a multiple of %d samples" % voltage.N_TIMES_PER_PACKET)
+        if n_active > n_slots:
+            raise ValueError("Number of active blocks must not exceed the number of slots")
+        if max_jump < n_active:
+            raise ValueError("Maximum jump must be at least the number of active blocks")
+        self.feng_ids = list(feng_ids)
+        self.n_ants = len(self.feng_ids)
+        self.start_chan = int(chans[0])
+        self.n_chans = len(chans)
+        self.n_chans_per_packet = n_chans_per_packet
+        self.n_groups = self.n_chans // n_chans_per_packet
+        self.block_times = block_times
+        self.n_time_packets = block_times // voltage.N_TIMES_PER_PACKET
+        self.n_slots = n_slots
+        self.n_active = n_active
+        self.timeout = timeout
+        self.max_jump = max_jump
+        if resync_packets is None:
+            resync_packets = self.n_ants * self.n_groups * self.n_time_packets
+        self.resync_packets = resync_packets
+        self.decoder = voltage.VoltageDecoder(n_chans_per_packet, max_packets=max_packets, out_format=out_format)
+        lut = voltage.OUTPUT_FORMATS[out_format]
+        self.buf = np.zeros((n_slots, self.n_ants, self.n_chans, block_times, voltage.N_POLS) + lut.shape[1:],
+                            dtype=lut.dtype)
+        self.mask = np.zeros([n_slots, self.n_ants, self.n_groups, self.n_time_packets], dtype=bool)
+        # View of the buffer with each packet's channels and times on their own axes
+        self._packets = self.buf.reshape((n_slots, self.n_ants, self.n_groups, n_chans_per_packet,
+                                          self.n_time_packets, voltage.N_TIMES_PER_PACKET, voltage.N_POLS)
+                                         + lut.shape[1:])
+        # Antenna index of each F-engine ID
+        self._ant = np.full(2**16, -1, dtype=np.int64)
+        self._ant[self.feng_ids] = np.arange(self.n_ants)
+        self.board_stats = np.zeros([self.n_ants, len(BOARD_STATS)], dtype=np.int64)
+        self.assembler_stats = dict.fromkeys(ASSEMBLER_STATS, 0)
+        self._free = collections.deque(range(n_slots))
+        self._active = {} # block index -> slot
+        self._first_arrival = np.zeros(n_slots)
+        self._ready = collections.deque()
+        # Oldest block which has not been released. None until the first packet arrives.
+        self.next_block = None
+        # Number of consecutive out of range packets
+        self._n_out_of_range = 0
+
+    def _count(self, stat, ants, n=1):
+        np.add.at(self.board_stats[:, BOARD_STATS.index(stat)], ants, n)
+
+    def add_packets(self, buf, nbytes=None, now=None):
+        """
+        Decode a batch of packets and place them in their blocks.
+
+        :param buf: Packets, as a 2D array of shape [n_packets, >= packet size] of uint8,
+            such as a batch of slots in a `rx.PacketRing`
+        :type buf: numpy.ndarray
+        :param nbytes: Size of each packet. If None, all packets are taken to be of the
+            expected size.
+        :type nbytes: numpy.ndarray
+        :param now: Arrival time, as returned by time.monotonic(). Default: the current time.
+        :type now: float
+        """
+        headers, data = self.decoder.decode(buf, nbytes)
+        self.add(headers, data, now=now)
+
+    def add(self, headers, data, now=None):
+        """
+        Place decoded packets in their blocks.
+
+        :param headers: Packet headers, as returned by `voltage.decode_headers`
+        :type headers: numpy.ndarray
+        :param data: Packet samples, with dimensions [packet, channel, time, polarization],
+            as returned by `voltage.decode_payloads`
+        :type data: numpy.ndarray
+        :param now: Arrival time, as returned by time.monotonic(). Default: the current time.
+        :type now: float
+        """
+        if len(headers) == 0:
+            return
+        now = time.monotonic() if now is None else now
+        ant = self._ant[headers['feng_id']]
+        group, offset = np.divmod(headers['chan'].astype(np.int64) - self.start_chan, self.n_chans_per_packet)
+        known = (ant >= 0) & (group >= 0) & (group < self.n_groups) & (offset == 0)
+        if not np.all(known):
+            self.assembler_stats['unknown'] += int(np.count_nonzero(~known))
+            headers, data, ant, group = headers[known], data[known], ant[known], group[known]
+            if len(headers) == 0:
+                return
+        block, tpkt = np.divmod(headers['timestamp'].astype(np.int64), self.block_times)
+        tpkt //= voltage.N_TIMES_PER_PACKET
+        if self.next_block is None:
+            self.next_block = int(block.min())
+        out_of_range = np.abs(block - self.next_block) > self.max_jump
+        if np.any(out_of_range):
+            if np.all(out_of_range):
+                self._n_out_of_range += len(block)
+                if self._n_out_of_range >= self.resync_packets:
+                    self.logger.warning("Resetting after %d consecutive packets more than %d blocks from block %d" % (
+                                        self._n_out_of_range, self.max_jump, self.next_block))
+                    self.reset()
+                    self.add(headers, data, now=now)
+                    return
+            else:
+                self._n_out_of_range = 0
+            self.assembler_stats['out_of_range'] += int(np.count_nonzero(out_of_range))
+            keep = ~out_of_range
+            data, ant, group, block, tpkt = data[keep], ant[keep], group[keep], block[keep], tpkt[keep]
+        else:
+            self._n_out_of_range = 0
+        # Blocks are filled in time order, so that a batch spanning more than
+        # n_active blocks releases each block only after its packets are placed
+        for b in np.unique(block):
+            b = int(b)
+            # Release blocks overtaken by this one
+            self._advance(b - self.n_active + 1)
+            sel = block == b
+            if b < self.next_block:
+                self._count('late', ant[sel])
+                continue
+            slot = self._slot(b, now)
+            if slot is None:
+                self.assembler_stats['overflow'] += int(np.count_nonzero(sel))
+                continue
+            a, g, t = ant[sel], group[sel], tpkt[sel]
+            # Duplicates of packets placed earlier, or of other packets in this batch
+            dup = self.mask[slot, a, g, t]
+            idx = (a * self.n_groups + g) * self.n_time_packets + t
+            _, first = np.unique(idx, return_index=True)
+            if len(first) < len(idx):
+                repeat = np.ones(len(idx), dtype=bool)
+                repeat[first] = False
+                dup |= repeat
+            if np.any(dup):
+                self._count('duplicate', a[dup])
+            self.mask[slot, a, g, t] = True
+            self._packets[slot, a, g, :, t] = data[sel]
+            self._count('packets', a)
+        self.poll(now)
+
+    def _slot(self, block, now):
+        """
+        Get the slot of an active block, claiming a free slot for a new one.
+        Returns None if no slot is free.
+        """
+        slot = self._active.get(block)
+        if slot is not None:
+            return slot
+        if len(self._free) == 0:
+            return None
+        slot = self._free.popleft()
+        self.mask[slot] = False
+        self._first_arrival[slot] = now
+        self._active[block] = slot
+        return slot
+
+    def _skip(self, n):
+        """
+        Skip the next `n` blocks, for which no packets arrived.
+        """
+        self.assembler_stats['skipped'] += n
+        self.board_stats[:, BOARD_STATS.index('missing')] += n * self.n_groups * self.n_time_packets
+        self.next_block += n
+
+    def _release(self):
+        """
+        Release the next block, which must be active, to the ready queue.
+        """
+        block = self.next_block
+        slot = self._active.pop(block)
+        mask = self.mask[slot]
+        missing = self.n_groups * self.n_time_packets - mask.reshape(self.n_ants, -1).sum(axis=1)
+        self.board_stats[:, BOARD_STATS.index('missing')] += missing
+        if missing.any():
+            # Clear the stale samples of an older block left where packets are missing
+            a, g, t = np.nonzero(~mask)
+            self._packets[slot, a, g, :, t] = 0
+        rb = VoltageBlock(block, block * self.block_times, self.buf[slot], mask, slot)
+        self.assembler_stats['blocks'] += 1
+        self.assembler_stats['complete' if rb.complete else 'timed_out'] += 1
+        if not rb.complete:
+            self.logger.debug("Released block %d with %d packets missing" % (block, missing.sum()))
+        self._ready.append(rb)
+        self.next_block = block + 1
+
+    def _advance(self, block):
+        """
+        Release all blocks before `block`.
+        """
+        while self.next_block < block:
+            pending = [b for b in self._active if b < block]
+            first = min(pending) if pending else block
+            if first > self.next_block:
+                self._skip(first - self.next_block)
+            else:
+                self._release()
+
+    def poll(self, now=None):
+        """
+        Release the oldest blocks, in order, while they are complete or timed out.
+        This is called by `add`, but should also be called periodically when no
+        packets are arriving, so that blocks time out.
+
+        :param now: Current time, as returned by time.monotonic(). Default: the current time.
+        :type now: float
+        """
+        now = time.monotonic() if now is None else now
+        while len(self._active) > 0:
+            slot = self._active.get(self.next_block)
+            if slot is None:
+                # No packets have arrived for the next block. Give up on it once a later block has timed out.
+                oldest = min(self._first_arrival[s] for s in self._active.values())
+                if now - oldest < self.timeout:
+                    return
+                self._skip(min(self._active) - self.next_block)
+            elif self.mask[slot].all() or now - self._first_arrival[slot] >= self.timeout:
+                self._release()
+            else:
+                return
+
+    def flush(self):
+        """
+        Release all the blocks being assembled, complete or not.
+        """
+        if len(self._active) > 0:
+            self._advance(max(self._active) + 1)
+
+    def reset(self):
+        """
+        Release all the blocks being assembled, and start again, taking the timestamp
+        of the next packet to arrive as the start of the stream.
+        """
+        self.flush()
+        self.next_block = None
+        self._n_out_of_range = 0
+        self.assembler_stats['resets'] += 1
+
+    def get(self):
+        """
+        Get the blocks which have been released since the last call.
+
+        :return: Released blocks, in time order
+        :rtype: list of VoltageBlock
+        """
+        blocks = list(self._ready)
+        self._ready.clear()
+        return blocks
+
+    def free(self, block):
+        """
+        Return a released block's buffer slot to the assembler, once the consumer
+        has finished with it.
+
+        :param block: Block returned by `get`
+        :type block: VoltageBlock
+        """
+        self._free.append(block.slot)
+
+    def stats(self):
+        """
+        Get the assembler's counters.
+
+        :return: Dictionary of ASSEMBLER_STATS, with an entry 'boards', which is a
+            dictionary keyed by F-engine ID of dictionaries of BOARD_STATS
+        :rtype: dict
+        """
+        rv = dict(self.assembler_stats)
+        rv['boards'] = {f: dict(zip(BOARD_STATS, map(int, self.board_stats[i])))
+                        for i, f in enumerate(self.feng_ids)}
+        return rv
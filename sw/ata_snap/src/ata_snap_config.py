@@ -0,0 +1,425 @@
+"""
+Validation and compilation of SNAP F-engine array configuration files
+(eg. `config/ataconfig.yml`).
+
+A configuration file is checked in its entirety before any board is
+touched, and everything a board's initialization derives from it
+(interface addresses, ARP tables, EQ coefficients and voltage output
+channel plans) is computed up front and packed into the binary images
+which are written to the board's memories.
+The result is cached, keyed by a hash of the configuration file and of
+the F-engine constants from which the images are derived, so that
+subsequent initializations of any board in the array do no planning work.
+
+Example usage:
+    config, boards = load_config('ataconfig.yml')
+    feng.load_brams(boards['frb-snap1-pi'].brams)
+"""
+
+import os
+import json
+import hashlib
+import logging
+import yaml
+import numpy as np
+
+from . import ata_snap_fengine
+from . import rx
+from . import voltage
+from .ata_snap_fengine import AtaSnapFengine
+
+# Change this if the compiled output changes, to invalidate cached files
+COMPILER_VERSION = 1
+
+# AtaSnapFengine attributes on which compiled configurations depend. These
+# are included in the cache key, so that changing them invalidates cached files.
+_FENGINE_CONSTANTS = ('n_pols', 'n_chans_f', 'n_chans_per_block', 'n_interfaces',
+                      'n_times_per_packet', 'packetizer_granularity', 'n_coeff_shared',
+                      'eq_coeff_bits', 'eq_coeff_bp')
+
+logger = logging.getLogger(__name__)
+
+def _is_ip(ip):
+    """
+    Return True if `ip` is an IPv4 address string (eg '10.11.10.1')
+    """
+    if not isinstance(ip, str):
+        return False
+    octets = ip.split('.')
+    if len(octets) != 4:
+        return False
+    try:
+        return all(0 <= int(o) <= 255 for o in octets)
+    except ValueError:
+        return False
+
+def _is_int(x, minimum=None, maximum=None):
+    """
+    Return True if `x` is an integer (not a bool) within the range [minimum, maximum]
+    """
+    if isinstance(x, bool) or not isinstance(x, int):
+        return False
+    if minimum is not None and x < minimum:
+        return False
+    if maximum is not None and x > maximum:
+        return False
+    return True
+
+def validate_config(config):
+    """
+    Check a configuration against the expected schema, and check that
+    the voltage output configuration can be realized by the firmware.
+    All problems are collected and reported together.
+
+    :param config: Configuration dictionary, as parsed from a YAML configuration file.
+    :type config: dict
+
+    :raises ValueError: If the configuration is invalid. The exception message
+        lists every problem found.
+    """
+    errors = []
+    if not isinstance(config, dict):
+        raise ValueError("Invalid configuration: expected a dictionary, got %s" % type(config).__name__)
+
+    for key in ['acclen', 'coeffs', 'dest_port', 'spectrometer_dest', 'arp', 'interfaces']:
+        if key not in config:
+            errors += ["Missing required key '%s'" % key]
+
+    if 'acclen' in config and not _is_int(config['acclen'], minimum=1):
+        errors += ["'acclen' should be a positive integer"]
+    if 'dest_port' in config and not _is_int(config['dest_port'], minimum=0, maximum=2**16 - 1):
+        errors += ["'dest_port' should be an integer UDP port number"]
+    if 'coeffs' in config:
+        try:
+            AtaSnapFengine._eq_coeffs_image(config['coeffs'])
+        except (AssertionError, TypeError, ValueError):
+            errors += ["'coeffs' should be a non-negative number, or a list of %d or %d non-negative numbers" % (
+                       AtaSnapFengine.n_chans_f // AtaSnapFengine.n_coeff_shared, AtaSnapFengine.n_chans_f)]
+
+    arp = config.get('arp', {})
+    if not isinstance(arp, dict):
+        errors += ["'arp' should be a dictionary of IP addresses and MAC addresses"]
+        arp = {}
+    for ip, mac in arp.items():
+        if not _is_ip(ip):
+            errors += ["ARP entry '%s' is not an IP address" % ip]
+        if not _is_int(mac, minimum=0, maximum=ata_snap_fengine.ETH_MAC_MASK):
+            errors += ["ARP entry for %s should be a 48-bit integer MAC address" % ip]
+
+    if 'spectrometer_dest' in config:
+        if not _is_ip(config['spectrometer_dest']):
+            errors += ["'spectrometer_dest' should be an IP address"]
+        elif config['spectrometer_dest'] not in arp:
+            errors += ["'spectrometer_dest' %s has no ARP entry" % config['spectrometer_dest']]
+
+    n_interfaces = AtaSnapFengine.n_interfaces
+    voltage_config = config.get('voltage_output', None)
+    if voltage_config is not None:
+        if not isinstance(voltage_config, dict):
+            errors += ["'voltage_output' should be a dictionary"]
+        else:
+            for key in ['start_chan', 'n_chans', 'dests']:
+                if key not in voltage_config:
+                    errors += ["Missing required key 'voltage_output.%s'" % key]
+            for key in ['start_chan', 'n_chans']:
+                if key in voltage_config and not _is_int(voltage_config[key], minimum=0):
+                    errors += ["'voltage_output.%s' should be a non-negative integer" % key]
+            dests = voltage_config.get('dests', [])
+            if not isinstance(dests, list) or len(dests) == 0:
+                errors += ["'voltage_output.dests' should be a non-empty list of IP addresses"]
+                dests = []
+            for dest in dests:
+                if not _is_ip(dest):
+                    errors += ["Voltage destination '%s' is not an IP address" % dest]
+                elif dest not in arp:
+                    errors += ["Voltage destination %s has no ARP entry" % dest]
+            n_interfaces = voltage_config.get('n_interfaces', n_interfaces)
+            if not _is_int(n_interfaces, minimum=1, maximum=AtaSnapFengine.n_interfaces):
+                errors += ["'voltage_output.n_interfaces' should be an integer between 1 and %d" % AtaSnapFengine.n_interfaces]
+                n_interfaces = AtaSnapFengine.n_interfaces
+
+    interfaces = config.get('interfaces', {})
+    if not isinstance(interfaces, dict):
+        errors += ["'interfaces' should be a dictionary of hostnames and lists of IP addresses"]
+        interfaces = {}
+    for host, ips in interfaces.items():
+        if not isinstance(ips, list) or not (n_interfaces <= len(ips) <= AtaSnapFengine.n_interfaces):
+            errors += ["Interfaces for %s should be a list of between %d and %d IP addresses" % (
+                       host, n_interfaces, AtaSnapFengine.n_interfaces)]
+            continue
+        for ip in ips:
+            if not _is_ip(ip):
+                errors += ["Interface address '%s' of %s is not an IP address" % (ip, host)]
+            elif ip not in arp:
+                errors += ["Interface address %s of %s has no ARP entry" % (ip, host)]
+
+    feng_ids = config.get('feng_ids', {})
+    if not isinstance(feng_ids, dict):
+        errors += ["'feng_ids' should be a dictionary of hostnames and F-engine IDs"]
+        feng_ids = {}
+    for host, feng_id in feng_ids.items():
+        if host not in interfaces:
+            errors += ["F-engine ID given for %s, which has no interfaces entry" % host]
+        if not _is_int(feng_id, minimum=0, maximum=2**16 - 1):
+            errors += ["F-engine ID for %s should be a 16-bit integer" % host]
+
+    # Only try to plan the voltage output if everything it depends on is sane
+    if voltage_config is not None and len(errors) == 0:
+        try:
+            AtaSnapFengine.plan_output_channels(voltage_config['start_chan'], voltage_config['n_chans'],
+                    dests=voltage_config['dests'], n_interfaces=n_interfaces)
+        except (AssertionError, NotImplementedError) as e:
+            errors += ["Voltage output configuration cannot be realized by the firmware: %s" % (str(e) or repr(e))]
+
+    if len(errors) > 0:
+        raise ValueError("Invalid configuration:\n  - " + "\n  - ".join(errors))
+
+class BoardConfig(object):
+    """
+    Configuration of a single board, derived from an array configuration
+    by `compile_config`.
+
+    :ivar host: Hostname of the board
+    :ivar feng_id: F-engine ID written into packet headers
+    :ivar interface_ips: List of IP addresses of the board's 10GbE interfaces
+    :ivar interface_macs: List of integer MAC addresses of the board's 10GbE interfaces
+    :ivar n_interfaces: Number of interfaces used for voltage output
+    :ivar arp_tables: List of ARP tables, one for each entry of `interface_ips`,
+        suitable for passing to `AtaSnapFengine.eth_set_arp_table`
+    :ivar brams: BRAM images, keyed by BRAM name, suitable for passing to
+        `AtaSnapFengine.load_brams`. Each value is a (bytes, word_bytes) tuple.
+    :ivar use_8bit: True if the voltage output is in 8-bit mode
+    :ivar chans: Dictionary, keyed by destination IP, of the channels sent to
+        that destination. Empty if voltage output is not configured.
+    """
+    def __init__(self, host, feng_id, interface_ips, interface_macs, n_interfaces,
+                 arp_tables, brams, use_8bit=False, chans=None):
+        self.host = host
+        self.feng_id = feng_id
+        self.interface_ips = interface_ips
+        self.interface_macs = interface_macs
+        self.n_interfaces = n_interfaces
+        self.arp_tables = arp_tables
+        self.brams = brams
+        self.use_8bit = use_8bit
+        self.chans = chans or {}
+
+    def set_feng_id(self, feng_id):
+        """
+        Change the F-engine ID written into the packetizer header images.
+
+        :param feng_id: New F-engine ID
+        :type feng_id: int
+        """
+        self.feng_id = feng_id
+        for name in self.brams:
+            if not (name.startswith('packetizer') and name.endswith('_header')):
+                continue
+            ips_name = name[:-len('_header')] + '_ips'
+            headers = ata_snap_fengine.decode_packetizer_headers(self.brams[name][0], self.brams[ips_name][0])
+            headers['feng_id'] = feng_id
+            self.brams[name] = (ata_snap_fengine.encode_packetizer_headers(headers)[0], self.brams[name][1])
+
+    def packet_rates(self, srate):
+        """
+        Compute the rate at which voltage packets are sent to each destination.
+        This can be used to size receivers' socket buffers.
+
+        :param srate: ADC sample rate, in MHz
+        :type srate: float
+
+        :return: Dictionary, keyed by destination IP, of packets per second
+        :rtype: dict
+        """
+        rv = {}
+        for name in self.brams:
+            if not (name.startswith('packetizer') and name.endswith('_header')):
+                continue
+            ips_name = name[:-len('_header')] + '_ips'
+            headers = ata_snap_fengine.decode_packetizer_headers(self.brams[name][0], self.brams[ips_name][0])
+            # One header entry per packet is flagged as the packet's first
+            headers = headers[headers['valid'] & headers['first']]
+            for dest in np.unique(headers['dest']):
+                h = headers[headers['dest'] == dest]
+                ip = rx.int_to_ip(int(dest))
+                rv[ip] = rv.get(ip, 0) + voltage.packet_rate(int(h['n_chans'].sum()), srate, int(h['n_chans'][0]))
+        return rv
+
+def compile_config(config):
+    """
+    Validate a configuration, and derive the configuration of every
+    board it describes.
+
+    Boards are those listed in the configuration's `interfaces` section.
+    Each board's BRAM images comprise EQ coefficients (the same for both
+    polarizations), ramp test vectors (test vector `i` is `i`), and, if
+    `voltage_output` is present, packetizer headers and a channel reorder map.
+
+    :param config: Configuration dictionary, as parsed from a YAML configuration file.
+    :type config: dict
+
+    :raises ValueError: If the configuration is invalid.
+
+    :return: Dictionary of BoardConfig instances, keyed by hostname.
+    :rtype: dict
+    """
+    validate_config(config)
+    F = AtaSnapFengine
+    arp_tables = ata_snap_fengine.compile_arp_tables(config['arp'])
+    coeffs_image = F._eq_coeffs_image(config['coeffs'])[0]
+    tv_image = F._eq_test_vector_image(range(F.n_chans_f))
+    shared_brams = {}
+    for pol in range(F.n_pols):
+        shared_brams['eq_pol%d_coeffs' % pol] = (coeffs_image, 4)
+        shared_brams['eqtvg_pol%d_tv' % pol] = (tv_image, 1)
+
+    voltage_config = config.get('voltage_output', None)
+    n_interfaces = F.n_interfaces
+    plan = None
+    if voltage_config is not None:
+        n_interfaces = voltage_config.get('n_interfaces', F.n_interfaces)
+        # All boards share a plan, other than the F-engine ID, which is patched in later
+        plan = F.plan_output_channels(voltage_config['start_chan'], voltage_config['n_chans'],
+                dests=voltage_config['dests'], n_interfaces=n_interfaces)
+        reorder_image = F._reorder_map_image(plan['reorder_map'])
+        header_images = [ata_snap_fengine.encode_packetizer_headers(h) for h in plan['headers']]
+
+    boards = {}
+    for host, ips in config['interfaces'].items():
+        brams = dict(shared_brams)
+        if plan is not None:
+            brams['chan_reorder_reorder3_map'] = (reorder_image, 2)
+            for i, (header_image, ip_image) in enumerate(header_images):
+                brams['packetizer%d_header' % i] = (header_image, 8)
+                brams['packetizer%d_ips' % i] = (ip_image, 4)
+        board = BoardConfig(host, 0,
+                    interface_ips=list(ips),
+                    interface_macs=[config['arp'][ip] for ip in ips],
+                    n_interfaces=n_interfaces,
+                    arp_tables=[arp_tables[ata_snap_fengine._ip_subnet(ip)] for ip in ips],
+                    brams=brams,
+                    use_8bit=False if plan is None else plan['use_8bit'],
+                    chans={} if plan is None else plan['chans'],
+                )
+        board.set_feng_id(config.get('feng_ids', {}).get(host, 0))
+        boards[host] = board
+    return boards
+
+def _default_cache_dir():
+    """
+    Get the default directory in which compiled configurations are cached.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'ata_snap')
+
+def _save_compiled(path, config, boards):
+    """
+    Save a configuration and its compiled board configurations to a .npz file.
+    Binary images are saved as arrays, and everything else as JSON.
+    """
+    arrays = {}
+    meta = {'version': COMPILER_VERSION, 'config': config, 'boards': {}}
+    for host, b in boards.items():
+        meta['boards'][host] = {
+            'feng_id': b.feng_id,
+            'interface_ips': b.interface_ips,
+            'interface_macs': b.interface_macs,
+            'n_interfaces': b.n_interfaces,
+            'use_8bit': b.use_8bit,
+            'chans': b.chans,
+            'brams': {name: word_bytes for name, (data, word_bytes) in b.brams.items()},
+        }
+        for name, (data, word_bytes) in b.brams.items():
+            arrays['%s/bram/%s' % (host, name)] = np.frombuffer(data, dtype=np.uint8)
+        for i, table in enumerate(b.arp_tables):
+            arrays['%s/arp/%d' % (host, i)] = table
+    arrays['meta'] = np.array(json.dumps(meta))
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as fh:
+        np.savez(fh, **arrays)
+    os.replace(tmp_path, path)
+
+def _load_compiled(path):
+    """
+    Load a configuration and its compiled board configurations, as saved
+    by `_save_compiled`.
+    """
+    with np.load(path) as d:
+        meta = json.loads(str(d['meta']))
+        if meta['version'] != COMPILER_VERSION:
+            raise ValueError("Compiled configuration %s has version %s (expected %d)" % (
+                             path, meta['version'], COMPILER_VERSION))
+        boards = {}
+        for host, b in meta['boards'].items():
+            brams = {name: (d['%s/bram/%s' % (host, name)].tobytes(), word_bytes)
+                     for name, word_bytes in b['brams'].items()}
+            arp_tables = [d['%s/arp/%d' % (host, i)] for i in range(len(b['interface_ips']))]
+            boards[host] = BoardConfig(host, b['feng_id'], b['interface_ips'], b['interface_macs'],
+                               b['n_interfaces'], arp_tables, brams, use_8bit=b['use_8bit'],
+                               chans=b['chans'])
+    return meta['config'], boards
+
+def config_hash(configfile):
+    """
+    Compute the hash by which a configuration file's compiled form is cached.
+
+    :param configfile: Path to configuration file
+    :type configfile: str
+
+    :return: Hex digest of the configuration file contents, the compiler version, and
+        the F-engine constants on which the compiled configuration depends
+    :rtype: str
+    """
+    h = hashlib.sha256(b'ata_snap_config v%d\n' % COMPILER_VERSION)
+    constants = {name: getattr(AtaSnapFengine, name) for name in _FENGINE_CONSTANTS}
+    constants.update({
+        'ETH_ARP_TABLE_SIZE': ata_snap_fengine.ETH_ARP_TABLE_SIZE,
+        'ETH_MAC_BROADCAST': ata_snap_fengine.ETH_MAC_BROADCAST,
+        'PACKETIZER_HEADER_DTYPE': str(ata_snap_fengine.PACKETIZER_HEADER_DTYPE.descr),
+        'PACKETIZER_HEADER_FIELDS': ata_snap_fengine._PACKETIZER_HEADER_FIELDS,
+    })
+    h.update(json.dumps(constants, sort_keys=True).encode() + b'\n')
+    with open(configfile, 'rb') as fh:
+        h.update(fh.read())
+    return h.hexdigest()
+
+def load_config(configfile, cache_dir=None, use_cache=True):
+    """
+    Load a configuration file and the board configurations derived from it.
+    If a compiled version of this configuration file is cached, use it.
+    Otherwise, parse, validate and compile the file, and cache the result.
+
+    :param configfile: Path to configuration file
+    :type configfile: str
+    :param cache_dir: Directory in which compiled configurations are cached.
+        Default: $XDG_CACHE_HOME/ata_snap (or ~/.cache/ata_snap)
+    :type cache_dir: str
+    :param use_cache: If False, always recompile, and don't save the result.
+    :type use_cache: bool
+
+    :raises ValueError: If the configuration is invalid.
+
+    :return: config, boards. `config` is the parsed configuration dictionary.
+        `boards` is a dictionary of BoardConfig instances, keyed by hostname.
+    :rtype: dict, dict
+    """
+    cache_dir = cache_dir or _default_cache_dir()
+    cache_path = os.path.join(cache_dir, config_hash(configfile) + '.npz')
+    if use_cache and os.path.exists(cache_path):
+        try:
+            config, boards = _load_compiled(cache_path)
+            logger.info("Using compiled configuration %s" % cache_path)
+            return config, boards
+        except Exception as e:
+            logger.warning("Failed to load compiled configuration %s (%s). Recompiling" % (cache_path, e))
+    logger.info("Compiling configuration %s" % configfile)
+    with open(configfile, 'r') as fh:
+        config = yaml.load(fh, Loader=yaml.SafeLoader)
+    boards = compile_config(config)
+    if use_cache:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            _save_compiled(cache_path, config, boards)
+        except OSError as e:
+            logger.warning("Failed to cache compiled configuration in %s (%s)" % (cache_dir, e))
+    return config, boards
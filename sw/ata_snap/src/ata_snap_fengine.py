@@ -3,6 +3,7 @@ import struct
 import logging
 import numpy as np
 import time
+import zlib
 
 def _ip_to_int(ip):
     """
@@ -40,9 +41,168 @@ def silence_tftpy():
         l = logging.getLogger(log)
         l.setLevel(logging.CRITICAL)
 
+ETH_ARP_TABLE_OFFSET = 0x3000 # Byte offset of the ARP table in a 10GbE core's memory map
+ETH_ARP_TABLE_SIZE = 256 # One ARP entry per final IP octet
+ETH_MAC_MASK = 0xffffffffffff
+ETH_MAC_BROADCAST = 0xffffffffffff
+
+def _ip_subnet(ip):
+    """
+    Get the first three octets of an IP string (eg '10.11.10.1' -> '10.11.10')
+    """
+    return ip.rsplit('.', 1)[0]
+
+def compile_arp_tables(arp):
+    """
+    Compile an IP -> MAC mapping into complete ARP tables, suitable
+    for loading into 10GbE cores with `AtaSnapFengine.eth_set_arp_table`.
+
+    A 10GbE core's ARP table has one entry per final IP octet, so one
+    table is generated for each /24 subnet present in `arp`. Addresses not
+    present in `arp` are mapped to the broadcast MAC address.
+
+    :param arp: Dictionary, keyed by IP address string, of integer MAC addresses.
+        E.g. {'10.11.1.151': 0xe41d2d073fe1}
+    :type arp: dict
+
+    :return: Dictionary, keyed by subnet (eg '10.11.1'), of ARP tables.
+        Each table is an array of ETH_ARP_TABLE_SIZE MAC addresses, where entry `i`
+        is the MAC address of IP address <subnet>.<i>
+    :rtype: dict
+    """
+    tables = {}
+    for ip, mac in arp.items():
+        subnet = _ip_subnet(ip)
+        if subnet not in tables:
+            tables[subnet] = np.full(ETH_ARP_TABLE_SIZE, ETH_MAC_BROADCAST, dtype=np.uint64)
+        tables[subnet][_ip_to_int(ip) & 0xff] = mac & ETH_MAC_MASK
+    return tables
+
+# Counters sampled by `AtaSnapFengine.eth_get_counters`, in the order they
+# appear in its output. These are the suffixes of the `eth<n>_core_<counter>`
+# registers. `txvldctr` / `rxvldctr` count valid 64-bit words, and so can
+# be multiplied by ETH_BYTES_PER_WORD to get a byte count.
+ETH_COUNTERS = ('txctr', 'txvldctr', 'txofctr', 'txfullctr', 'txerrctr',
+                'rxctr', 'rxvldctr', 'rxofctr', 'rxbadctr', 'rxerrctr', 'rxeofctr')
+ETH_BYTES_PER_WORD = 8
+ETH_COUNTER_BITS = 32
+
 TGE_N_SAMPLES_PER_WORD = 8 # 8 1-byte words per 64-bit 10GbE input. TODO: what about 8-bit mode?
 MAX_SAMPLE_DELAY = 16384 - 1
 
+# Decoded form of one packetizer header BRAM entry (plus its destination IP).
+# `dest` is held as an integer IP address. Use `_int_to_ip` to get a string.
+PACKETIZER_HEADER_DTYPE = np.dtype([
+    ('first', np.bool_),
+    ('valid', np.bool_),
+    ('last', np.bool_),
+    ('is_8_bit', np.bool_),
+    ('is_time_fastest', np.bool_),
+    ('n_chans', np.uint16),
+    ('chan', np.uint16),
+    ('feng_id', np.uint16),
+    ('dest', np.uint32),
+])
+
+# (field, bit offset, mask) of each field in a 64-bit packetizer header word
+_PACKETIZER_HEADER_FIELDS = [
+    ('last', 58, 0x1),
+    ('valid', 57, 0x1),
+    ('first', 56, 0x1),
+    ('is_8_bit', 49, 0x1),
+    ('is_time_fastest', 48, 0x1),
+    ('n_chans', 32, 0xffff),
+    ('chan', 16, 0xffff),
+    ('feng_id', 0, 0xffff),
+]
+
+def encode_packetizer_headers(headers):
+    """
+    Encode a table of packetizer headers into the binary images
+    expected by the packetizer header and IP BRAMs.
+
+    :param headers: Headers to encode, one entry per packetizer block.
+    :type headers: numpy.ndarray with dtype PACKETIZER_HEADER_DTYPE
+
+    :return: header_bytes, ip_bytes. Big-endian 64-bit header words and
+        big-endian 32-bit IP words, suitable for writing to
+        `packetizer<n>_header` and `packetizer<n>_ips`, respectively.
+    :rtype: bytes, bytes
+    """
+    headers = np.asarray(headers, dtype=PACKETIZER_HEADER_DTYPE)
+    words = np.zeros(headers.shape, dtype=np.uint64)
+    for field, offset, mask in _PACKETIZER_HEADER_FIELDS:
+        v = headers[field].astype(np.uint64) & np.uint64(mask)
+        words |= v << np.uint64(offset)
+    return words.astype('>u8').tobytes(), headers['dest'].astype('>u4').tobytes()
+
+def decode_packetizer_headers(header_bytes, ip_bytes):
+    """
+    Decode binary packetizer header and IP BRAM images into a table of headers.
+    This is the inverse of `encode_packetizer_headers`.
+
+    :param header_bytes: Contents of a `packetizer<n>_header` BRAM.
+    :type header_bytes: bytes
+    :param ip_bytes: Contents of a `packetizer<n>_ips` BRAM.
+    :type ip_bytes: bytes
+
+    :return: Decoded headers, one entry per packetizer block.
+    :rtype: numpy.ndarray with dtype PACKETIZER_HEADER_DTYPE
+    """
+    words = np.frombuffer(header_bytes, dtype='>u8').astype(np.uint64)
+    ips = np.frombuffer(ip_bytes, dtype='>u4')
+    assert words.shape == ips.shape, "Header and IP tables have different lengths"
+    headers = np.zeros(words.shape, dtype=PACKETIZER_HEADER_DTYPE)
+    for field, offset, mask in _PACKETIZER_HEADER_FIELDS:
+        headers[field] = (words >> np.uint64(offset)) & np.uint64(mask)
+    headers['dest'] = ips
+    return headers
+
+def _diff_word_ranges(a, b, word_bytes=4):
+    """
+    Find the ranges of words which differ between two binary images.
+
+    :param a: First binary image
+    :type a: bytes
+    :param b: Second binary image. Should be the same length as `a`.
+    :type b: bytes
+    :param word_bytes: Number of bytes per word.
+    :type word_bytes: int
+
+    :return: List of (start, stop) word index ranges, such that words
+        start..stop-1 differ. Trailing bytes which do not fill a word are
+        treated as a partial word.
+    :rtype: list
+    """
+    assert len(a) == len(b), "Binary images have different lengths"
+    a = np.frombuffer(a, dtype=np.uint8)
+    b = np.frombuffer(b, dtype=np.uint8)
+    n_words = -(-len(a) // word_bytes)
+    pad = n_words * word_bytes - len(a)
+    bad_bytes = np.concatenate([a != b, np.zeros(pad, dtype=bool)])
+    bad = bad_bytes.reshape(n_words, word_bytes).any(axis=1)
+    edges = np.diff(np.concatenate([[0], bad.astype(np.int8), [0]]))
+    starts = np.where(edges == 1)[0]
+    stops = np.where(edges == -1)[0]
+    return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
+def _headers_from_dicts(headers):
+    """
+    Convert a list of header dictionaries (in the format described by
+    `AtaSnapFengine._populate_headers`) to a PACKETIZER_HEADER_DTYPE array.
+    """
+    out = np.zeros(len(headers), dtype=PACKETIZER_HEADER_DTYPE)
+    for hn, h in enumerate(headers):
+        chans = h['chans']
+        try:
+            chan = chans[0]
+        except TypeError:
+            chan = chans
+        out[hn] = (h['first'], h['valid'], h['last'], h['is_8_bit'],
+                   h['is_time_fastest'], h['n_chans'], chan, h['feng_id'],
+                   _ip_to_int(h['dest']))
+    return out
+
 class AtaSnapFengine(object):
     """
     This is a class which implements methods for programming
@@ -71,6 +231,8 @@ class AtaSnapFengine(object):
     n_times_per_packet = 16 # Number of time samples per packet
     packetizer_granularity = 2**5 # Number of 64-bit words ber packetizer step
     n_coeff_shared = 4 # Number of adjacent frequency channels sharing an EQ coefficient
+    eq_coeff_bits = 32 # Bits per EQ coefficient
+    eq_coeff_bp = 5 # Binary point position of EQ coefficients
 
     def __init__(self, host, feng_id=0, transport=casperfpga.TapcpTransport, use_rpi=None):
         """
@@ -87,6 +249,14 @@ class AtaSnapFengine(object):
         self.logger = logging.getLogger('AtaSnapFengine')
         self.logger.setLevel(logging.DEBUG)
         self.feng_id = feng_id
+        # Images of the BRAM tables written by this instance, keyed by
+        # BRAM name. Each entry is a (bytes, word_bytes) tuple.
+        # These are used by `verify_brams` to check what the board holds.
+        self._bram_images = {}
+        # Cached plan of Ethernet counter register reads, and the last counter sample
+        # taken by `eth_get_counters`
+        self._eth_counter_regs = None
+        self._eth_counters_last = None
         # If the board is programmed, try to get the fpg data
         #if self.is_programmed():
         #    try:
@@ -148,6 +318,10 @@ class AtaSnapFengine(object):
         else:
             self.fpga.upload_to_ram_and_program(fpgfile)
         self.fpga.get_system_information(fpgfile)
+        # Reprogramming clears everything we have previously written
+        self._bram_images = {}
+        self._eth_counter_regs = None
+        self._eth_counters_last = None
         self.sync_select_input(self.pps_source)
         if init_adc:
             self.adc_initialize()
@@ -577,25 +751,34 @@ class AtaSnapFengine(object):
         Reorder the channels such that the channel order[i]
         emerges out of the reorder in position i.
         """
-        out_array = np.zeros([self.n_times_per_packet *  self.n_chans_f // self.n_chans_per_block], dtype='>i2')
+        self._bram_write('chan_reorder_reorder3_map', self._reorder_map_image(order, transpose_time), word_bytes=2)
+
+    @classmethod
+    def _reorder_map_image(cls, order, transpose_time=True):
+        """
+        Generate the binary contents of the channel reorder map BRAM
+        which causes channel order[i] to emerge out of the reorder
+        in position i.
+
+        :return: BRAM image
+        :rtype: bytes
+        """
         if not transpose_time:
             raise NotImplementedError("Reorder only implemented with time fastest ordering")
         # Check input
         order = np.array(order)
+        n_blocks = cls.n_chans_f // cls.n_chans_per_block
         # We must load the reorder map in one go
-        assert order.shape[0] == (self.n_chans_f // self.n_chans_per_block)
+        assert order.shape[0] == n_blocks
         # Start points can only be integer multiples of the number of channels in a word
-        for o in order:
-            assert o < (self.n_chans_f // self.n_chans_per_block)
-            assert o % 1 == 0
+        assert np.all(order < n_blocks)
+        assert np.all(order % 1 == 0)
         # All elements must appear only once
         assert np.unique(order).shape[0] == order.shape[0]
-        for xn, x in enumerate(order):
-            #print("Mapping channel %d to position %d" % (x, xn))
-            for t in range(self.n_times_per_packet):
-                out_array[xn * self.n_times_per_packet + t] = x + (t*self.n_chans_f // self.n_chans_per_block)
-        
-        self.fpga.write('chan_reorder_reorder3_map', out_array.tobytes())
+        # Entry [xn * n_times_per_packet + t] maps channel block order[xn], time t
+        t = np.arange(cls.n_times_per_packet)
+        out_array = order.astype(np.int64)[:, None] + (t * n_blocks)[None, :]
+        return out_array.astype('>i2').tobytes()
 
     def fft_of_detect(self):
         """
@@ -795,12 +978,29 @@ class AtaSnapFengine(object):
 
         :rtype: numpy.ndarray, int
         """
-        COEFF_BITS = 32 # Bits per coefficient
-        COEFF_BP = 5 # binary point position
+        assert pol in [0, 1]
+        coeffs_str, coeffs, coeff_bp = self._eq_coeffs_image(coeffs)
+        self._bram_write('eq_pol%d_coeffs' % pol, coeffs_str, word_bytes=4)
+        return coeffs.repeat(self.n_coeff_shared), coeff_bp
 
-        n_coeffs = self.n_chans_f // self.n_coeff_shared
+    @classmethod
+    def _eq_coeffs_image(cls, coeffs):
+        """
+        Quantize EQ coefficients and generate the binary contents of an EQ
+        coefficient BRAM. See `eq_load_coeffs` for the format of `coeffs`.
+
+        :return: 3-tuple image, int_coeffs, bin_pt.
+            image: The BRAM image
+            int_coeffs: An array of self.n_chans_f / self.n_coeff_shared integer
+            coefficients which the image holds.
+            bin_pt: position of binary point with which firmware interprets coefficients.
+        :rtype: bytes, numpy.ndarray, int
+        """
+        COEFF_BITS = cls.eq_coeff_bits
+        COEFF_BP = cls.eq_coeff_bp
+
+        n_coeffs = cls.n_chans_f // cls.n_coeff_shared
 
-        assert pol in [0, 1]
         # If the coefficients provided are a single number
         # set all coefficients to this value
         try:
@@ -809,8 +1009,8 @@ class AtaSnapFengine(object):
         # Otherwise force numpy array to list
         except TypeError:
             coeffs = list(coeffs)
-            if len(coeffs) == self.n_chans_f:
-                coeffs = coeffs[::self.n_coeff_shared]
+            if len(coeffs) == cls.n_chans_f:
+                coeffs = coeffs[::cls.n_coeff_shared]
             assert len(coeffs) == n_coeffs
         # Negative equalization coefficients don't make sense!
         for coeff in coeffs:
@@ -826,8 +1026,7 @@ class AtaSnapFengine(object):
             coeffs_str = struct.pack('>%dL'%n_coeffs, *coeffs)
         else:
             raise TypeError("Don't know how to convert %d-bit numbers to binary" % COEFF_BITS)
-        self.fpga.write('eq_pol%d_coeffs' % pol, coeffs_str)
-        return np.array(coeffs).repeat(self.n_coeff_shared), COEFF_BP
+        return coeffs_str, np.array(coeffs), COEFF_BP
 
     def eq_read_coeffs(self, pol, return_float=False):
         """
@@ -849,8 +1048,8 @@ class AtaSnapFengine(object):
         :rtype: numpy.ndarray or numpy.ndarray, int
         """
 
-        COEFF_BITS = 32 # Bits per coefficient
-        COEFF_BP = 5 # binary point position
+        COEFF_BITS = self.eq_coeff_bits
+        COEFF_BP = self.eq_coeff_bp
         n_coeffs = self.n_chans_f // self.n_coeff_shared
 
         assert pol in [0, 1]
@@ -879,12 +1078,22 @@ class AtaSnapFengine(object):
         :raises AssertionError: If an array of test vectors is provided with an invalid size,
             or if pol is a non-allowed value
         """
-        tv = list(tv)
-        assert len(tv) == self.n_chans_f
         assert pol in [0, 1]
+        self._bram_write('eqtvg_pol%d_tv' % pol, self._eq_test_vector_image(tv), word_bytes=1)
+
+    @classmethod
+    def _eq_test_vector_image(cls, tv):
+        """
+        Generate the binary contents of a test vector BRAM.
+        See `eq_load_test_vectors` for the format of `tv`.
+
+        :return: BRAM image
+        :rtype: bytes
+        """
+        tv = list(tv)
+        assert len(tv) == cls.n_chans_f
         tv_8bit = [x%256 for x in tv]
-        tv_8bit_str = struct.pack('>%dB'%self.n_chans_f, *tv_8bit)
-        self.fpga.write('eqtvg_pol%d_tv' % pol, tv_8bit_str)
+        return struct.pack('>%dB'%cls.n_chans_f, *tv_8bit)
 
     def eq_test_vector_mode(self, enable):
         """
@@ -1156,6 +1365,135 @@ class AtaSnapFengine(object):
         for i in self.fpga.gbes:
             print("%s:" % i.name, i.read_counters())
 
+    def eth_get_arp_table(self, interface):
+        """
+        Read the ARP table of a 10GbE core.
+
+        :param interface: Which physical interface to read.
+        :type interface: int
+
+        :return: Array of ETH_ARP_TABLE_SIZE MAC addresses, where entry `i`
+            is the MAC address of the IP address with final octet `i`.
+        :rtype: numpy.ndarray
+        """
+        raw = self.fpga.read('eth%d_core' % interface, 8*ETH_ARP_TABLE_SIZE, offset=ETH_ARP_TABLE_OFFSET)
+        return np.frombuffer(raw, dtype='>u8').astype(np.uint64) & np.uint64(ETH_MAC_MASK)
+
+    def eth_set_arp_table(self, macs, interface='all', force=False):
+        """
+        Load a complete ARP table into 10GbE cores with a single write per core.
+        The current table is first read back, and the write is skipped if its
+        checksum matches that of the table to be loaded.
+
+        :param macs: Array of ETH_ARP_TABLE_SIZE MAC addresses, where entry `i`
+            is the MAC address of the IP address with final octet `i`.
+            Tables can be generated with `compile_arp_tables`.
+        :type macs: numpy.ndarray or list of ints
+        :param interface: Which physical interface to manipulate
+        :type interface: integer or 'all'
+        :param force: If True, write the table even if the loaded table already matches.
+        :type force: bool
+
+        :return: List of interfaces which were written
+        :rtype: list
+        """
+        macs = np.asarray(macs, dtype=np.uint64) & np.uint64(ETH_MAC_MASK)
+        assert macs.shape == (ETH_ARP_TABLE_SIZE,), "ARP table must have %d entries" % ETH_ARP_TABLE_SIZE
+        checksum = zlib.crc32(macs.astype('>u8').tobytes())
+        if interface == 'all':
+            interfaces = range(self.n_interfaces)
+        else:
+            interfaces = [int(interface)]
+        written = []
+        for i in interfaces:
+            if not force:
+                loaded = self.eth_get_arp_table(i)
+                if zlib.crc32(loaded.astype('>u8').tobytes()) == checksum:
+                    self.logger.info("ARP table of interface %d is up to date" % i)
+                    continue
+            self.logger.info("Loading ARP table of interface %d" % i)
+            self.fpga.gbes['eth%d_core' % i].set_arp_table([int(m) for m in macs])
+            written += [i]
+        return written
+
+    def _eth_counter_reads(self):
+        """
+        Plan the block reads which sample the Ethernet counters. The counter
+        registers present in the running firmware are found with `listdev`, and
+        registers at consecutive addresses are coalesced into a single read.
+
+        :return: List of reads, each a tuple of (registers read, interface of each
+            register, ETH_COUNTERS index of each register)
+        :rtype: list
+        """
+        devs = set(self.fpga.listdev())
+        regs = []
+        for i in range(self.n_interfaces):
+            for cn, c in enumerate(ETH_COUNTERS):
+                reg = 'eth%d_core_%s' % (i, c)
+                if reg in devs:
+                    regs += [(self.fpga.memory_devices[reg].address, reg, i, cn)]
+        reads = []
+        run = []
+        for addr, reg, i, cn in sorted(regs):
+            if len(run) > 0 and addr != run[0][0] + 4*len(run):
+                reads += [run]
+                run = []
+            run += [(addr, reg, i, cn)]
+        if len(run) > 0:
+            reads += [run]
+        return [([r[1] for r in run], np.array([r[2] for r in run]), np.array([r[3] for r in run])) for run in reads]
+
+    def eth_get_counters(self):
+        """
+        Sample the TX, RX and error counters of all Ethernet cores, and compute
+        counter rates relative to the previous call. Counters at consecutive
+        addresses are read together, so that each core's counters are usually
+        sampled with a single block read. If the transport rejects a read which
+        extends past the end of the register named (as tcpborphserver does), the
+        counters are read one register at a time instead.
+
+        Counters are returned in the order given by ETH_COUNTERS.
+        Counters which are not present in the running firmware read as 0.
+        Rates are computed using a monotonic clock, and account for
+        counter wraparound (provided counters wrap at most once between calls).
+
+        :return: t, counts, rates.
+            t: Monotonic time (in seconds, as returned by `time.monotonic`) at which the
+            counters were sampled.
+            counts: Array of counter values, with shape [self.n_interfaces, len(ETH_COUNTERS)]
+            rates: Array of counter increments per second since the previous call, with the same shape
+            as `counts`. None if this is the first call.
+        :rtype: float, numpy.ndarray, numpy.ndarray
+        """
+        if self._eth_counter_regs is None:
+            self._eth_counter_regs = self._eth_counter_reads()
+        counts = np.zeros([self.n_interfaces, len(ETH_COUNTERS)], dtype=np.uint32)
+        t0 = time.monotonic()
+        plan = []
+        for regs, ifaces, cns in self._eth_counter_regs:
+            if len(regs) > 1:
+                try:
+                    counts[ifaces, cns] = np.frombuffer(self.fpga.read(regs[0], 4*len(regs)), dtype='>u4')
+                    plan += [(regs, ifaces, cns)]
+                    continue
+                except RuntimeError:
+                    self.logger.warning("Block read from %s failed. Reading counters one register at a time" % regs[0])
+            for i, reg in enumerate(regs):
+                counts[ifaces[i], cns[i]] = self.fpga.read_uint(reg)
+                plan += [([reg], ifaces[i:i+1], cns[i:i+1])]
+        self._eth_counter_regs = plan
+        t1 = time.monotonic()
+        t = (t0 + t1) / 2.
+        rates = None
+        if self._eth_counters_last is not None:
+            last_t, last_counts = self._eth_counters_last
+            # Unsigned subtraction handles counter wraps
+            delta = counts - last_counts
+            rates = delta / (t - last_t)
+        self._eth_counters_last = (t, counts)
+        return t, counts, rates
+
     def eth_set_dest_port(self, port, interface='all'):
         """
         Set the destination UDP port for output 10GbE packets.
@@ -1187,11 +1525,10 @@ class AtaSnapFengine(object):
         :type feng_id: int
         """
         self.feng_id = feng_id
-        self.write_int("corr_feng_id", self.feng_id)
+        self.fpga.write_int("corr_feng_id", self.feng_id)
         for interface in range(self.n_interfaces):
             headers = self._read_headers(interface)
-            for i in range(len(headers)):
-                headers[i]['feng_id'] = feng_id
+            headers['feng_id'] = feng_id
             self._populate_headers(interface, headers)
         
 
@@ -1228,6 +1565,59 @@ class AtaSnapFengine(object):
             {'10.0.0.10': [0,1,..,255], '10.0.0.11': [256,257,..,511]}
         :rtype: dict
         """
+        plan = self.plan_output_channels(start_chan, n_chans, dests=dests, feng_id=self.feng_id,
+                                         n_interfaces=n_interfaces, n_bits=n_bits)
+        self.load_output_plan(plan)
+        return plan['chans']
+
+    def load_output_plan(self, plan):
+        """
+        Load a voltage output configuration generated by `plan_output_channels`.
+
+        :param plan: Output configuration, as returned by `plan_output_channels`
+        :type plan: dict
+        """
+        # Set the firmware bitwidth register
+        self.fpga.write_int('chan_reorder_use_8bit', int(plan['use_8bit']))
+        # Load the headers
+        for i, headers in enumerate(plan['headers']):
+            self._populate_headers(i, headers)
+        # Load the chan reorder map
+        self._reorder_channels(plan['reorder_map'])
+
+    @classmethod
+    def plan_output_channels(cls, start_chan, n_chans, dests=['0.0.0.0'], feng_id=0, n_interfaces=None, n_bits=4):
+        """
+        Compute the packetizer headers and channel reorder map required to output
+        a range of channels from the voltage pipeline. This method does not communicate
+        with a board, and its output can be loaded with `load_output_plan`.
+        See `select_output_channels` for a description of the channel selection
+        parameters.
+
+        :param start_chan: First channel to output
+        :type start_chan: int
+        :param n_chans: Number of channels to output
+        :type n_chans: int
+        :param dests: List of IP address strings to which data should be sent.
+        :type dests: list of str
+        :param feng_id: F-Engine ID to write into packet headers
+        :type feng_id: int
+        :param n_interfaces: Number of 10GbE interfaces to use.
+        :type n_interface: int
+        :param n_bits: Number of bits per sample (4 or 8)
+        :type n_bits: int
+
+        :raises AssertionError: If the channel selection is invalid.
+
+        :return: A dictionary with keys:
+            'headers': An array of packetizer headers, with shape [n_interfaces, n_blocks] and
+            dtype PACKETIZER_HEADER_DTYPE.
+            'reorder_map': The channel reorder map, as passed to `_reorder_channels`.
+            'use_8bit': True if the firmware should be placed in 8-bit mode.
+            'chans': A dictionary, keyed by destination IP, of the channels destined for
+            this IP, as returned by `select_output_channels`.
+        :rtype: dict
+        """
 
         # Each 10GbE core in the design has its own packetizer.
         # Each packetizer has internal state which changes every packetizer_granularity
@@ -1266,41 +1656,35 @@ class AtaSnapFengine(object):
         # n_chans_f * n_times_per_packet / nchans_per_block words, with each word
         # 8+8 bits x nchans_per_block x 2 [pols] wide.
 
-        feng_id = self.feng_id
+        logger = logging.getLogger('AtaSnapFengine')
 
         # default to using all the interfaces
-        n_interfaces = n_interfaces or self.n_interfaces
-        assert n_interfaces <= self.n_interfaces
+        n_interfaces = n_interfaces or cls.n_interfaces
+        assert n_interfaces <= cls.n_interfaces
 
         # define maximum number of channels per packet such that max packet
         # size is 8 kByte + header
         assert n_bits in [4,8], "Only 4- or 8-bit output modes are supported!"
-        max_chans_per_packet = 8*8192 // (2*n_bits) // self.n_times_per_packet // 2
+        max_chans_per_packet = 8*8192 // (2*n_bits) // cls.n_times_per_packet // 2
 
         if n_bits == 8:
             raise NotImplementedError("8-bit mode not yet implemented")
 
-        # Set the firmware bitwidth register
-        if n_bits == 8:
-            self.fpga.write_int('chan_reorder_use_8bit', 1)
-        else:
-            self.fpga.write_int('chan_reorder_use_8bit', 0)
-
         # Figure out the channel granularity of the packetizer. This operates
         # in blocks of packetizer_granularity 64-bit words.
         # For now, we only consider case with time the faster axis.
         times_per_word = 64 // (2*2*n_bits)
         # This should always be True for reasonable firmware
-        assert self.packetizer_granularity % times_per_word == 0, "{} % {} != 0".format(self.packetizer_granularity, times_per_word)
-        packetizer_chan_granularity = self.packetizer_granularity // times_per_word
+        assert cls.packetizer_granularity % times_per_word == 0, "{} % {} != 0".format(cls.packetizer_granularity, times_per_word)
+        packetizer_chan_granularity = cls.packetizer_granularity // times_per_word
 
         # We reorder n_chans_per_block as parallel words, so must deal with
         # start / stop points with that granularity
-        assert start_chan % self.n_chans_per_block == 0, "{} % {} != 0".format(start_chan, self.n_chans_per_block)
+        assert start_chan % cls.n_chans_per_block == 0, "{} % {} != 0".format(start_chan, cls.n_chans_per_block)
         n_dests = len(dests)
         # Also Demand that the number of channels can be equally divided
         # among the destination addresses
-        assert n_chans % (n_dests * self.n_chans_per_block) == 0, "{} % {} != 0".format(n_chans, (n_dests * self.n_chans_per_block))
+        assert n_chans % (n_dests * cls.n_chans_per_block) == 0, "{} % {} != 0".format(n_chans, (n_dests * cls.n_chans_per_block))
         # Number of channels per destination is now gauranteed to be an integer
         # multiple of n_chans_per_block
         n_chans_per_destination = n_chans // n_dests
@@ -1311,21 +1695,21 @@ class AtaSnapFengine(object):
         assert n_chans_per_destination % n_packets_per_destination == 0, "{} % {} != 0".format(n_chans_per_destination, n_packets_per_destination)
         n_chans_per_packet = n_chans_per_destination  // n_packets_per_destination
         # Number of channels per packet should be a multiple of the reorder granularity
-        assert n_chans_per_packet % self.n_chans_per_block == 0, "{} % {} != 0".format(n_chans_per_packet, self.n_chans_per_block)
+        assert n_chans_per_packet % cls.n_chans_per_block == 0, "{} % {} != 0".format(n_chans_per_packet, cls.n_chans_per_block)
         # Number of channels per packet should be a multiple of packetizer granularity
         assert n_chans_per_packet % packetizer_chan_granularity == 0, "{} % {} != 0".format(n_chans_per_packet, packetizer_chan_granularity)
         n_slots_per_packet = n_chans_per_packet // packetizer_chan_granularity
         # Can't send more than all the channels!
-        assert start_chan + n_chans <= self.n_chans_f, "{} > {}".format(start_chan + n_chans, self.n_ch)
+        assert start_chan + n_chans <= cls.n_chans_f, "{} > {}".format(start_chan + n_chans, cls.n_chans_f)
 
-        self.logger.info('Start channel: %d' % start_chan)
-        self.logger.info('Number of channels to send: %d' % n_chans)
-        self.logger.info('Number of interfaces to be used: %d' % n_interfaces)
-        self.logger.info('Number of interfaces available: %d' % self.n_interfaces)
+        logger.info('Start channel: %d' % start_chan)
+        logger.info('Number of channels to send: %d' % n_chans)
+        logger.info('Number of interfaces to be used: %d' % n_interfaces)
+        logger.info('Number of interfaces available: %d' % cls.n_interfaces)
 
-        self.logger.info('Number of destinations: %d' % n_dests)
-        self.logger.info('Number of channels per destination: %d' % n_chans_per_destination)
-        self.logger.info('Number of channels per packet: %d' % n_chans_per_packet)
+        logger.info('Number of destinations: %d' % n_dests)
+        logger.info('Number of channels per destination: %d' % n_chans_per_destination)
+        logger.info('Number of channels per packet: %d' % n_chans_per_packet)
 
         # First, for simplicity, duplicate the destination list so that
         # we can deal exclusively in packets, with nominally 1 packet per destination,
@@ -1334,29 +1718,19 @@ class AtaSnapFengine(object):
         for dest in dests:
             for i in range(n_packets_per_destination):
                 dup_dests += [dest]
-        dests = dup_dests
 
         # Divide up each packetizer input stream of n_times_per_pkt * n_chans_f
         # into blocks of packetizer_chan_granularity
-        packetizer_n_blocks = self.n_chans_f // packetizer_chan_granularity
-        # Initialize variable for the headers
-        headers = [
-                      [
-                          {
-                               'first': False,
-                               'valid': False,
-                               'last': False,
-                               'dest': '0.0.0.0',
-                               'chans': [0] * packetizer_chan_granularity,
-                               'feng_id' : self.feng_id,
-                               'n_chans' : n_chans_per_packet,
-                               'is_8_bit' : n_bits == 8,
-                               'is_time_fastest' : True,
-                          } for i in range(packetizer_n_blocks)
-                      ]
-                  for j in range(n_interfaces)]
-
-        chan_reorder_map = -1 * np.ones(self.n_chans_f, dtype=np.int32)
+        packetizer_n_blocks = cls.n_chans_f // packetizer_chan_granularity
+        # Initialize variable for the headers. Unused blocks are invalid and
+        # destined for 0.0.0.0
+        headers = np.zeros([n_interfaces, packetizer_n_blocks], dtype=PACKETIZER_HEADER_DTYPE)
+        headers['feng_id'] = feng_id
+        headers['n_chans'] = n_chans_per_packet
+        headers['is_8_bit'] = n_bits == 8
+        headers['is_time_fastest'] = True
+
+        chan_reorder_map = -1 * np.ones(cls.n_chans_f, dtype=np.int32)
 
         # How many slots packetizer blocks do we need to use?
         # Lazily force data rate out of each interface to be the same
@@ -1366,12 +1740,12 @@ class AtaSnapFengine(object):
         needed_blocks = n_chans // packetizer_chan_granularity
         spare_blocks = available_blocks - needed_blocks
 
-        self.logger.info('Available blocks: %s' % available_blocks)
-        self.logger.info('Required blocks: %s' % needed_blocks)
-        self.logger.info('Spare blocks: %s' % spare_blocks)
+        logger.info('Available blocks: %s' % available_blocks)
+        logger.info('Required blocks: %s' % needed_blocks)
+        logger.info('Spare blocks: %s' % spare_blocks)
 
         spare_blocks_per_packet = int(np.floor(spare_blocks / n_packets))
-        self.logger.info('Spare blocks per packet: %s' % spare_blocks_per_packet)
+        logger.info('Spare blocks per packet: %s' % spare_blocks_per_packet)
 
         # So, however many packetizer blocks sending a packet takes, after the last
         # block in packet, the next `spare_blocks_per_packet` can be marked invalid
@@ -1383,11 +1757,12 @@ class AtaSnapFengine(object):
         slot_start_chan = start_chan
         for p in range(n_packets):
             for s in range(n_slots_per_packet):
-                headers[interface][slot[interface]]['first'] = s==0
-                headers[interface][slot[interface]]['valid'] = True
-                headers[interface][slot[interface]]['last'] = s==(n_slots_per_packet-1)
-                headers[interface][slot[interface]]['dest'] = dup_dests[p]
-                headers[interface][slot[interface]]['chans'] = range(slot_start_chan, slot_start_chan + packetizer_chan_granularity)
+                h = headers[interface, slot[interface]]
+                h['first'] = s==0
+                h['valid'] = True
+                h['last'] = s==(n_slots_per_packet-1)
+                h['dest'] = _ip_to_int(dup_dests[p])
+                h['chan'] = slot_start_chan
                 input_chan_id = slot[interface] * packetizer_chan_granularity
                 #print(p, s, input_chan_id)
                 chan_reorder_map[input_chan_id : input_chan_id + packetizer_chan_granularity] = range(slot_start_chan, slot_start_chan + packetizer_chan_granularity)
@@ -1401,42 +1776,28 @@ class AtaSnapFengine(object):
             slot[interface] += spare_blocks_per_packet
             interface = (interface + 1) % n_interfaces
             
-        #for i in range(n_interfaces):
-        #    for j in range(packetizer_n_blocks):
-        #        print(i,j,headers[i][j])
-        # Load the headers
-        for i in range(n_interfaces):
-            self._populate_headers(i, headers[i])
-        
-        # Load the chan reorder map
-
         # reduce the channel reorder map by the number of parallel chans in a reorder word
-        chan_reorder_map = chan_reorder_map[::self.n_chans_per_block]
-        for cn, c in enumerate(chan_reorder_map):
-            if c == -1:
-                continue
-            assert (c % self.n_chans_per_block) == 0
-            chan_reorder_map[cn] /= self.n_chans_per_block
+        chan_reorder_map = chan_reorder_map[::cls.n_chans_per_block]
+        used = chan_reorder_map != -1
+        assert np.all(chan_reorder_map[used] % cls.n_chans_per_block == 0)
+        chan_reorder_map[used] //= cls.n_chans_per_block
         # fill in the gaps (indicated by -1) in the above map with allowed channels we haven't used
         # Note that you _cannot_ repeat channels in the map, since we aren't double buffering
-        possible_chans = list(range(0, self.n_chans_f // self.n_chans_per_block))
-        for c in chan_reorder_map:
-            if c == -1:
-                continue
-            possible_chans.remove(c)
-        for i in range(len(chan_reorder_map)):
-            if chan_reorder_map[i] == -1:
-                chan_reorder_map[i] = possible_chans.pop(0)
-        self._reorder_channels(chan_reorder_map)
+        possible_chans = np.setdiff1d(np.arange(cls.n_chans_f // cls.n_chans_per_block), chan_reorder_map[used])
+        chan_reorder_map[~used] = possible_chans[0:np.count_nonzero(~used)]
 
-        # Return a dictionary, keyed by destination address, where each entry is the range of channels being
+        # A dictionary, keyed by destination address, where each entry is the range of channels being
         # send to that address.
-        rv = {}
+        chans = {}
         for dn, d in enumerate(dests):
-            rv[d] = list(range(start_chan + dn*n_chans_per_destination,
+            chans[d] = list(range(start_chan + dn*n_chans_per_destination,
                           start_chan + (dn+1)*n_chans_per_destination))
-        return rv
-        
+        return {
+            'headers': headers,
+            'reorder_map': chan_reorder_map,
+            'use_8bit': n_bits == 8,
+            'chans': chans,
+        }
 
     def _populate_headers(self, interface, headers):
         """
@@ -1444,14 +1805,15 @@ class AtaSnapFengine(object):
 
         :param interface: The 10GbE interface to populate
         :type interface: int
-        :param headers: A list of header dictionaries to populate
-        :type headers: list
+        :param headers: Headers to populate. Either an array with dtype
+            PACKETIZER_HEADER_DTYPE, or a list of header dictionaries.
+        :type headers: numpy.ndarray or list
 
-        Entry `i` of the `headers` list is written to packetizer header BRAM index `i`.
+        Entry `i` of `headers` is written to packetizer header BRAM index `i`.
         This represents the control word associated with the `i`th data sample block
         after a sync pulse. Each data block is self.packetizer_granularity words.
 
-        Each `headers` entry should be a dictionary with the following fields:
+        If `headers` is a list, each entry should be a dictionary with the following fields:
           - `first`: Boolean, indicating this sample block is the first in a packet.
           - `valid`: Boolean, indicating this sample block contains valid data.
           - `last`: Boolean, indicating this is the last valid sample block in a packet.
@@ -1464,23 +1826,14 @@ class AtaSnapFengine(object):
             This is usually always `self.feng_id`, but may vary if one board is spoofing
             traffic from multiple boards.
           - `dest` : String, the destination IP of this data block (eg "10.10.10.100")
+        If `headers` is an array, fields are as above, except that `chans` is replaced
+        by `chan` (the first channel in the block) and `dest` is an integer IP address.
         """
-
-        h_bytestr = b''
-        ip_bytestr = b''
-        for h in headers:
-            header_word = (int(h['last']) << 58) \
-                        + (int(h['valid']) << 57) \
-                        + (int(h['first']) << 56) \
-                        + (int(h['is_8_bit']) << 49) \
-                        + (int(h['is_time_fastest']) << 48) \
-                        + ((h['n_chans'] & 0xffff) << 32) \
-                        + ((h['chans'][0] & 0xffff) << 16) \
-                        + ((h['feng_id'] & 0xffff) << 0)
-            h_bytestr += struct.pack('>Q', header_word)
-            ip_bytestr += struct.pack('>I', _ip_to_int(h['dest']))
-        self.fpga.write('packetizer%d_ips' % interface, ip_bytestr)
-        self.fpga.write('packetizer%d_header' % interface, h_bytestr)
+        if not isinstance(headers, np.ndarray):
+            headers = _headers_from_dicts(headers)
+        h_bytestr, ip_bytestr = encode_packetizer_headers(headers)
+        self._bram_write('packetizer%d_ips' % interface, ip_bytestr, word_bytes=4)
+        self._bram_write('packetizer%d_header' % interface, h_bytestr, word_bytes=8)
 
     def _read_headers(self, interface):
         """
@@ -1490,13 +1843,13 @@ class AtaSnapFengine(object):
         :type interface: int
         
         :return: headers
-        :rtype: list
+        :rtype: numpy.ndarray with dtype PACKETIZER_HEADER_DTYPE
 
-        Entry `i` of the `headers` list represents the contents of header BRAM index `i`.
+        Entry `i` of `headers` represents the contents of header BRAM index `i`.
         This represents the control word associated with the `i`th data sample block
         after a sync pulse. Each data block is self.packetizer_granularity words.
 
-        Each `headers` entry should be a dictionary with the following fields:
+        Each `headers` entry has the following fields:
           - `first`: Boolean, indicating this sample block is the first in a packet.
           - `valid`: Boolean, indicating this sample block contains valid data.
           - `last`: Boolean, indicating this is the last valid sample block in a packet.
@@ -1504,33 +1857,122 @@ class AtaSnapFengine(object):
           - `is_time_fastest`: Boolean, indicating this packet has a payload in
             channel [slowest] x time x polarization [fastest] order.
           - `n_chans`: Integer, indicating the number of channels in this data block's packet.
-          - `chans`: list of ints, indicating the channels present in this data block. The zeroth element is the first channel in this block.
+          - `chan`: Integer, indicating the first channel present in this data block.
           - `feng_id`: Integer, indicating the F-Engine ID of this block's data.
             This is usually always `self.feng_id`, but may vary if one board is spoofing
             traffic from multiple boards.
-          - `dest` : String, the destination IP of this data block (eg "10.10.10.100")
+          - `dest` : Integer, the destination IP of this data block (eg 0x0a0a0a64
+            for "10.10.10.100")
         """
 
-        n_words = self.n_chans_f * self.n_times_per_packet * self.n_pols // TGE_N_SAMPLES_PER_WORD // self.packetizer_granularity
+        n_words = self._packetizer_n_words()
         hs_raw = self.fpga.read('packetizer%d_header' % interface, 8*n_words)
         ips_raw = self.fpga.read('packetizer%d_ips' % interface, 4*n_words)
-        hs = struct.unpack('>%dQ' % n_words, hs_raw)
-        ips = struct.unpack('>%dI' % n_words, ips_raw)
-        headers = []
-        for dn, d in enumerate(hs):
-            headers += [{}]
-            headers[-1]['feng_id'] = (d >> 0) & 0xffff
-            headers[-1]['chans'] = (d >> 16) & 0xffff
-            headers[-1]['n_chans'] = (d >> 32) & 0xffff
-            headers[-1]['is_time_fastest'] = bool(d >> 48)
-            headers[-1]['is_8_bit'] = bool(d >> 49)
-            headers[-1]['first'] = bool(d >> 56)
-            headers[-1]['valid'] = bool(d >> 57)
-            headers[-1]['last'] = bool(d >> 58)
-            headers[-1]['dest'] = _int_to_ip(ips[dn])
-        return headers
+        return decode_packetizer_headers(hs_raw, ips_raw)
+
+    def _packetizer_n_words(self):
+        """
+        Get the number of entries in each packetizer's header and IP BRAMs.
+
+        :return: Number of header entries
+        :rtype: int
+        """
+        return self.n_chans_f * self.n_times_per_packet * self.n_pols // TGE_N_SAMPLES_PER_WORD // self.packetizer_granularity
         
 
+    def _bram_write(self, name, data, word_bytes=4, offset=0):
+        """
+        Write to a BRAM, and record what was written so that it can
+        later be checked with `verify_brams`.
+
+        :param name: Name of the BRAM to write
+        :type name: str
+        :param data: Data to write
+        :type data: bytes
+        :param word_bytes: The BRAM's natural word size, in bytes. This is used
+            only to report the locations of errors found by `verify_brams`.
+        :type word_bytes: int
+        :param offset: Byte offset at which to write
+        :type offset: int
+        """
+        self.fpga.write(name, data, offset=offset)
+        image = bytearray(self._bram_images.get(name, (b'', word_bytes))[0])
+        if len(image) < offset + len(data):
+            image += b'\x00' * (offset + len(data) - len(image))
+        image[offset:offset + len(data)] = data
+        self._bram_images[name] = (bytes(image), word_bytes)
+
+    def load_brams(self, images):
+        """
+        Write pre-generated images to BRAMs. The images written are recorded,
+        so that they can be checked with `verify_brams`.
+
+        :param images: BRAM contents, keyed by BRAM name. Each value should
+            either be a bytes object, or a (bytes, word_bytes) tuple, where word_bytes
+            is the BRAM's word size.
+        :type images: dict
+        """
+        for name, image in images.items():
+            if isinstance(image, tuple):
+                data, word_bytes = image
+            else:
+                data, word_bytes = image, 4
+            self._bram_write(name, data, word_bytes=word_bytes)
+
+    def verify_brams(self, expected=None, repair=False):
+        """
+        Read back BRAM tables and compare them with their expected contents.
+        Each table is read with a single bulk read.
+
+        By default, the tables checked are those written by this instance since it was
+        created (or the board was last programmed). These are the packetizer header
+        and IP tables, the channel reorder map, the EQ coefficients and the
+        EQ test vectors.
+
+        :param expected: Expected BRAM contents, keyed by BRAM name. Each value should
+            either be a bytes object, or a (bytes, word_bytes) tuple, where word_bytes
+            is the BRAM's word size used to report errors. If None, use the tables
+            written by this instance.
+        :type expected: dict
+        :param repair: If True, rewrite any words which do not match, and check again.
+            Only the differing word ranges (rounded out to 32-bit boundaries) are rewritten.
+        :type repair: bool
+
+        :return: A dictionary, keyed by BRAM name, of the tables which did not
+            match. Each value is a list of (start, stop) word ranges, such that
+            words start..stop-1 were found to differ. If all tables match,
+            the dictionary is empty. If `repair` was set, the returned
+            ranges are those found before repairing.
+        :rtype: dict
+        """
+        if expected is None:
+            expected = self._bram_images
+        errors = {}
+        for name, image in expected.items():
+            if isinstance(image, tuple):
+                data, word_bytes = image
+            else:
+                data, word_bytes = image, 4
+            readback = self.fpga.read(name, len(data))
+            ranges = _diff_word_ranges(data, readback, word_bytes)
+            if len(ranges) == 0:
+                continue
+            n_bad = sum(stop - start for start, stop in ranges)
+            self.logger.warning("%s: %d words differ from expected values" % (name, n_bad))
+            errors[name] = ranges
+            if not repair:
+                continue
+            for start, stop in ranges:
+                # Writes must be aligned to 32-bit word boundaries
+                b_start = (start * word_bytes) // 4 * 4
+                b_stop = min(len(data), -(-(stop * word_bytes) // 4) * 4)
+                self.fpga.write(name, data[b_start:b_stop], offset=b_start)
+            if len(_diff_word_ranges(data, self.fpga.read(name, len(data)), word_bytes)) == 0:
+                self.logger.info("%s: repaired %d words" % (name, n_bad))
+            else:
+                self.logger.error("%s: failed to repair BRAM contents" % name)
+        return errors
+
     #def get_channel_assignments(self):
     #    """
     #    Get information about the channels currently being output.
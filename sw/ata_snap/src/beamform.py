@@ -0,0 +1,249 @@
+"""
+Coherent and incoherent beamforming of assembled voltage blocks.
+
+Each coherent beam is a weighted sum of the antennas' voltages, with a
+complex weight per beam, antenna and channel (and optionally polarization),
+typically the phase rotation which compensates each antenna's geometric
+delay towards the beam's direction (see `delay_weights`). For each channel
+and polarization, the weights of all beams form a [beam, antenna] matrix,
+which multiplies the [antenna, time] matrix of voltages, so all the beams
+of a block are formed by one batched matrix multiply. The incoherent beam
+is the sum of the antennas' detected powers.
+
+Beams are detected (|X|^2 + |Y|^2), integrated over `n_int` samples, and
+may be written to a SIGPROC filterbank file per beam. Channels may be split
+between several threads, as in `xengine.Correlator`.
+
+Example usage:
+    weights = delay_weights(delays, freqs)
+    writer = BeamWriter('obs.fil', header, weights, n_int=64, incoherent=True)
+    for block in assembler.get():
+        writer.process(block.data, block.valid())
+        assembler.free(block)
+    writer.close()
+"""
+
+import os
+import concurrent.futures
+import numpy as np
+
+from . import voltage
+from . import sigproc
+
+def delay_weights(delays, freqs, phases=None, gains=None):
+    """
+    Compute beamforming weights which compensate antenna delays.
+
+    :param delays: Delay of each antenna's signal, in seconds, relative to the
+        beam's reference, with dimensions [beam, antenna]
+    :type delays: numpy.ndarray
+    :param freqs: Channel sky frequencies, in MHz
+    :type freqs: numpy.ndarray
+    :param phases: If not None, additional phases, in radians, with dimensions [beam, antenna]
+        or [beam, antenna, channel], eg. instrumental phase calibrations
+    :type phases: numpy.ndarray
+    :param gains: If not None, weight amplitudes, with dimensions [antenna] or
+        [beam, antenna, channel]
+    :type gains: numpy.ndarray
+
+    :return: Weights, with dimensions [beam, antenna, channel]
+    :rtype: numpy.ndarray
+    """
+    delays = np.asarray(delays, dtype=np.float64)
+    freqs = np.asarray(freqs, dtype=np.float64) * 1e6
+    phase = 2 * np.pi * delays[:, :, None] * freqs
+    if phases is not None:
+        phases = np.asarray(phases, dtype=np.float64)
+        phase = phase - (phases if phases.ndim == 3 else phases[:, :, None])
+    weights = np.exp(1j * phase)
+    if gains is not None:
+        gains = np.asarray(gains)
+        weights = weights * (gains if gains.ndim == 3 else gains[None, :, None])
+    return weights.astype(np.complex64)
+
+class Beamformer(object):
+    """
+    Form beams from voltage blocks.
+
+    :param weights: Complex weights, with dimensions [beam, antenna, channel], or
+        [beam, antenna, channel, polarization] for polarization-dependent weights
+    :type weights: numpy.ndarray
+    :param n_int: Number of time samples integrated into each detected output sample.
+        Must divide the block length.
+    :type n_int: int
+    :param incoherent: If True, form an incoherent beam, which is output after the
+        coherent beams
+    :type incoherent: bool
+    :param n_threads: Number of threads between which channels are split
+    :type n_threads: int
+
+    :ivar n_beams: Number of beams output, including the incoherent beam
+    """
+    def __init__(self, weights, n_int=1, incoherent=False, n_threads=1):
+        weights = np.asarray(weights, dtype=np.complex64)
+        if weights.ndim == 3:
+            weights = np.repeat(weights[..., None], voltage.N_POLS, axis=-1)
+        self.n_coherent, self.n_ants, self.n_chans = weights.shape[0:3]
+        # Dimensions [polarization, channel, beam, antenna], for multiplying voltages
+        self.weights = np.ascontiguousarray(weights.transpose(3, 2, 0, 1))
+        self.n_int = n_int
+        self.incoherent = incoherent
+        self.n_beams = self.n_coherent + int(incoherent)
+        self.n_threads = n_threads
+        edges = np.linspace(0, self.n_chans, n_threads + 1).astype(int)
+        self._ranges = [slice(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+        self._pool = concurrent.futures.ThreadPoolExecutor(n_threads) if n_threads > 1 else None
+
+    def set_weights(self, weights):
+        """
+        Replace the weights, eg. as the delay model is updated.
+
+        :param weights: Complex weights, with the same dimensions as when the
+            beamformer was made
+        :type weights: numpy.ndarray
+        """
+        weights = np.asarray(weights, dtype=np.complex64)
+        if weights.ndim == 3:
+            weights = weights[..., None]
+        self.weights[...] = weights.transpose(3, 2, 0, 1)
+
+    def _form(self, x, valid, chans, power, beams):
+        """
+        Form the beams of a range of channels.
+        """
+        n_times = x.shape[2]
+        n_out = n_times // self.n_int
+        # Dimensions [polarization, channel, antenna, time]
+        m = np.ascontiguousarray(x[:, chans].transpose(3, 1, 0, 2))
+        if valid is not None:
+            m *= np.ascontiguousarray(valid[:, chans].transpose(1, 0, 2))
+        b = np.matmul(self.weights[:, chans], m)
+        if beams is not None:
+            beams[:, chans] = b.transpose(2, 1, 3, 0)
+        # Dimensions [polarization, channel, beam, output sample, sample]
+        p = (b.real**2 + b.imag**2).reshape(voltage.N_POLS, -1, self.n_coherent, n_out, self.n_int)
+        power[:, chans, 0:self.n_coherent] = p.sum(axis=(0, 4)).transpose(2, 0, 1)
+        if self.incoherent:
+            q = (m.real**2 + m.imag**2).reshape(voltage.N_POLS, -1, self.n_ants, n_out, self.n_int)
+            power[:, chans, self.n_coherent] = q.sum(axis=(0, 2, 4)).T
+
+    def process(self, data, valid=None, return_voltages=False):
+        """
+        Form the beams of a block of voltages.
+
+        :param data: Voltages, with dimensions [antenna, channel, time, polarization] of
+            complex64, or [antenna, channel, time, polarization, real/imag] of int8
+        :type data: numpy.ndarray
+        :param valid: Boolean mask, with dimensions [antenna, channel, time], which is True
+            where data were received. Data which were not received are excluded.
+            If None, all data are valid.
+        :type valid: numpy.ndarray
+        :param return_voltages: If True, also return the coherent beams' voltages
+        :type return_voltages: bool
+
+        :return: Detected power, with dimensions [time / n_int, channel, beam], and if
+            `return_voltages` is set, the beams' voltages, with dimensions
+            [beam, channel, time, polarization]
+        :rtype: numpy.ndarray
+        """
+        x = voltage.to_complex(data)
+        n_times = x.shape[2]
+        if n_times % self.n_int != 0:
+            raise ValueError("Block length (%d) must be a multiple of the integration length (%d)" % (
+                             n_times, self.n_int))
+        power = np.zeros([n_times // self.n_int, self.n_chans, self.n_beams], dtype=np.float32)
+        beams = None
+        if return_voltages:
+            beams = np.zeros([self.n_coherent, self.n_chans, n_times, voltage.N_POLS], dtype=np.complex64)
+        if self._pool is None:
+            self._form(x, valid, slice(None), power, beams)
+        else:
+            for f in [self._pool.submit(self._form, x, valid, r, power, beams) for r in self._ranges]:
+                f.result()
+        if return_voltages:
+            return power, beams
+        return power
+
+    def close(self):
+        """
+        Stop the beamformer's threads.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+
+def beam_filename(filename, beam):
+    """
+    Get the name of the filterbank file to which a beam is written.
+
+    :param filename: Base file name, eg. 'obs_1600000000.fil'
+    :type filename: str
+    :param beam: Beam index, or 'inc' for the incoherent beam
+    :type beam: int or str
+
+    :return: File name, eg. 'obs_1600000000_beam0.fil'
+    :rtype: str
+    """
+    root, ext = os.path.splitext(filename)
+    if beam == 'inc':
+        return '%s_inc%s' % (root, ext)
+    return '%s_beam%d%s' % (root, beam, ext)
+
+class BeamWriter(object):
+    """
+    Form beams from voltage blocks, and write each detected beam to a
+    SIGPROC filterbank file.
+
+    :param filename: Base file name, from which the beam file names are made by
+        `beam_filename`
+    :type filename: str
+    :param header: Filterbank header of the voltage channels, such as returned by
+        `sigproc.voltage_header` with n_int=1. Its sample time is scaled by `n_int`.
+    :type header: dict
+    :param weights: Complex weights. See `Beamformer`.
+    :type weights: numpy.ndarray
+    :param n_int: Number of time samples integrated into each output sample
+    :type n_int: int
+    :param incoherent: If True, also write an incoherent beam
+    :type incoherent: bool
+    :param n_threads: Number of threads between which channels are split
+    :type n_threads: int
+    :param voltage_filename: If not None, also write the coherent beams' voltages, as
+        complex64 with dimensions [time, beam, channel, polarization], to this file
+    :type voltage_filename: str
+    """
+    def __init__(self, filename, header, weights, n_int=1, incoherent=False, n_threads=1,
+                 voltage_filename=None):
+        self.beamformer = Beamformer(weights, n_int=n_int, incoherent=incoherent, n_threads=n_threads)
+        header = dict(header, tsamp=header['tsamp'] * n_int, nbits=32, nifs=1)
+        names = list(range(self.beamformer.n_coherent)) + (['inc'] if incoherent else [])
+        self.writers = [sigproc.FilterbankWriter(beam_filename(filename, b), header) for b in names]
+        self.voltage_fh = None if voltage_filename is None else open(voltage_filename, 'wb')
+
+    def process(self, data, valid=None, timestamp=None):
+        """
+        Form the beams of a block of voltages, and append them to the beam files.
+
+        :param data: Voltages, with dimensions [antenna, channel, time, polarization]
+        :type data: numpy.ndarray
+        :param valid: Boolean mask, with dimensions [antenna, channel, time]
+        :type valid: numpy.ndarray
+        :param timestamp: Timestamp of the block. Unused, since blocks are contiguous.
+        :type timestamp: int
+        """
+        if self.voltage_fh is None:
+            power = self.beamformer.process(data, valid)
+        else:
+            power, beams = self.beamformer.process(data, valid, return_voltages=True)
+            self.voltage_fh.write(beams.transpose(2, 0, 1, 3).tobytes())
+        for b, writer in enumerate(self.writers):
+            writer.write(np.ascontiguousarray(power[:, :, b]))
+
+    def close(self):
+        """
+        Close the beam files.
+        """
+        self.beamformer.close()
+        for writer in self.writers:
+            writer.close()
+        if self.voltage_fh is not None:
+            self.voltage_fh.close()
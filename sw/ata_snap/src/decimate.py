@@ -0,0 +1,162 @@
+"""
+Time and frequency decimation of recorded spectra.
+
+Spectra are reduced by summing or averaging `n_time` consecutive spectra and
+`n_chan` adjacent channels. Blocks of spectra are reduced with reshapes
+rather than loops, and spectra left over at the end of a block are carried
+into the next, so blocks need not be multiples of `n_time` long.
+
+Data from packets which were not received (according to the packet mask
+written by `spectra.SpectraRecorder`) are excluded, and the remaining
+data are rescaled to account for them.
+
+Example usage:
+    dec = Decimator(8, 4)
+    for start, chunk, valid in f.iter_chunks(4096):
+        data, mask = dec.process(chunk, f.mask[start:start + len(chunk)])
+"""
+
+import os
+import numpy as np
+
+from . import spectra
+
+#: Ways in which spectra can be decimated
+MODES = ('mean', 'sum')
+
+def decimated_header(header, n_time, n_chan):
+    """
+    Get the SIGPROC header of a decimated file.
+
+    :param header: Header of the full resolution data, as taken by `sigproc.encode_header`
+    :type header: dict
+    :param n_time: Number of spectra combined into each output spectrum
+    :type n_time: int
+    :param n_chan: Number of channels combined into each output channel
+    :type n_chan: int
+
+    :return: Header dictionary
+    :rtype: dict
+    """
+    header = dict(header)
+    header['tsamp'] = header['tsamp'] * n_time
+    # The output channel is centred between the channels combined into it
+    header['fch1'] = header['fch1'] + header['foff'] * (n_chan - 1) / 2.
+    header['foff'] = header['foff'] * n_chan
+    header['nchans'] = header['nchans'] // n_chan
+    return header
+
+def decimated_filename(filename, n_time, n_chan):
+    """
+    Get the name of the file to which decimated data accompanying `filename` are written.
+
+    :param filename: Full resolution data file name, eg. 'obs_1600000000.fil'
+    :type filename: str
+    :param n_time: Number of spectra combined into each output spectrum
+    :type n_time: int
+    :param n_chan: Number of channels combined into each output channel
+    :type n_chan: int
+
+    :return: File name, eg. 'obs_1600000000_t8f4.fil'
+    :rtype: str
+    """
+    root, ext = os.path.splitext(filename)
+    return '%s_t%df%d%s' % (root, n_time, n_chan, ext)
+
+class Decimator(object):
+    """
+    Decimate a stream of spectra in time and frequency.
+
+    Each output channel is made from the channels of a single packet, so `n_chan`
+    must divide the number of channels per packet. The output packet mask has
+    a bit set for each packet whose data were received in all the spectra
+    combined into the output spectrum.
+
+    :param n_time: Number of spectra combined into each output spectrum
+    :type n_time: int
+    :param n_chan: Number of channels combined into each output channel
+    :type n_chan: int
+    :param mode: 'mean' to average the combined values, or 'sum' to sum them. One of MODES.
+        When some values are missing, 'sum' scales the sum of the rest up to the full count.
+    :type mode: str
+    :param n_chans: Number of channels per input spectrum
+    :type n_chans: int
+    :param n_packets_per_spectrum: Number of packets per spectrum
+    :type n_packets_per_spectrum: int
+
+    :ivar n_in: Number of input spectra processed
+    :ivar n_out: Number of output spectra produced
+    """
+    def __init__(self, n_time, n_chan=1, mode='mean', n_chans=spectra.N_CHANS,
+                 n_packets_per_spectrum=spectra.N_PACKETS_PER_SPECTRUM):
+        if mode not in MODES:
+            raise ValueError("Decimation mode must be one of %s" % (MODES,))
+        chans_per_packet = n_chans // n_packets_per_spectrum
+        if chans_per_packet % n_chan != 0:
+            raise ValueError("Channel decimation (%d) must divide the %d channels of each packet" % (
+                             n_chan, chans_per_packet))
+        self.n_time = n_time
+        self.n_chan = n_chan
+        self.mode = mode
+        self.n_chans = n_chans
+        self.n_packets_per_spectrum = n_packets_per_spectrum
+        self.n_in = 0
+        self.n_out = 0
+        # Spectra carried over from the previous block
+        self._data = None
+        self._mask = None
+
+    def process(self, data, mask=None):
+        """
+        Decimate a block of spectra.
+
+        :param data: Spectra, with dimensions [time, channel] or [time, channel, product]
+        :type data: numpy.ndarray
+        :param mask: Packet mask of each spectrum, as written by `spectra.SpectraRecorder`.
+            If None, all data are taken to be valid.
+        :type mask: numpy.ndarray
+
+        :return: data, mask. Decimated spectra, with the same type and number of dimensions
+            as the input, and their packet mask. Spectra which do not complete an output
+            spectrum are held until the next call.
+        :rtype: numpy.ndarray, numpy.ndarray
+        """
+        full = (1 << self.n_packets_per_spectrum) - 1
+        if mask is None:
+            mask = np.full(len(data), full, dtype=np.uint8)
+        self.n_in += len(data)
+        if self._data is not None:
+            data = np.concatenate([self._data, data])
+            mask = np.concatenate([self._mask, mask])
+        n_out = len(data) // self.n_time
+        n_used = n_out * self.n_time
+        if n_used < len(data):
+            self._data = np.array(data[n_used:])
+            self._mask = np.array(mask[n_used:])
+        else:
+            self._data = self._mask = None
+        out_shape = (n_out, self.n_chans // self.n_chan) + data.shape[2:]
+        if n_out == 0:
+            return np.zeros(out_shape, dtype=data.dtype), np.zeros(0, dtype=np.uint8)
+        mask = np.asarray(mask[0:n_used])
+        # Dimensions [output spectrum, spectrum, packet, output channel, channel, product]
+        x = np.asarray(data[0:n_used], dtype=np.float32).reshape(
+            n_out, self.n_time, self.n_packets_per_spectrum, -1, self.n_chan, int(np.prod(data.shape[2:])))
+        received = np.unpackbits(mask[:, None], axis=1, count=self.n_packets_per_spectrum,
+                                 bitorder='little').astype(bool).reshape(n_out, self.n_time, -1)
+        if np.all(mask == full):
+            total = x.sum(axis=(1, 4))
+            count = np.full((n_out, self.n_packets_per_spectrum), self.n_time * self.n_chan)
+        else:
+            total = np.where(received[:, :, :, None, None, None], x, 0).sum(axis=(1, 4))
+            count = received.sum(axis=1) * self.n_chan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.mode == 'mean':
+                scale = 1. / count
+            else:
+                scale = float(self.n_time * self.n_chan) / count
+        scale[count == 0] = 0
+        total *= scale[:, :, None, None]
+        out_mask = np.bitwise_and.reduce(mask.reshape(n_out, self.n_time), axis=1)
+        self.n_out += n_out
+        return total.reshape(out_shape).astype(data.dtype, copy=False), out_mask
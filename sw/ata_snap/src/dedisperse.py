@@ -0,0 +1,242 @@
+"""
+Streaming incoherent dedispersion of spectrometer data.
+
+Each channel is delayed by the dispersion delay of its frequency relative
+to the highest frequency channel, and the channels are summed, for each of
+a list of dispersion measures. Blocks of spectra are processed as they
+arrive, with the last `max_delay` spectra of each block kept as an overlap
+with the next, so the output is a continuous time series per DM.
+
+Adjacent channels which share a delay at a given DM are summed together
+before being shifted, using a cumulative sum over channels, so the cost of
+the shift-and-add scales with the number of distinct delays rather than the
+number of channels. At low DMs, and for the narrow fractional bandwidth of
+the spectrometer, this is a small fraction of the channels.
+
+Example usage:
+    header = sigproc.spectrometer_header(...)
+    dd = Dedisperser.from_header(np.arange(0, 100, 0.5), header)
+    series = dd.process(spectra, mask)
+"""
+
+import os
+import numpy as np
+
+from . import spectra
+from . import sigproc
+
+K_DM = 4.148808e3 # Dispersion constant, in s MHz^2 / (pc cm^-3)
+
+def dispersion_delays(dms, freqs, tsamp):
+    """
+    Compute dispersion delays, relative to the highest frequency.
+
+    :param dms: Dispersion measures, in pc cm^-3
+    :type dms: numpy.ndarray
+    :param freqs: Channel frequencies, in MHz
+    :type freqs: numpy.ndarray
+    :param tsamp: Time between spectra, in seconds
+    :type tsamp: float
+
+    :return: Delays, in spectra, with dimensions [DM, channel]
+    :rtype: numpy.ndarray
+    """
+    freqs = np.asarray(freqs, dtype=np.float64)
+    delay = K_DM * np.outer(dms, freqs**-2 - freqs.max()**-2)
+    return np.round(delay / tsamp).astype(np.int64)
+
+class Dedisperser(object):
+    """
+    Dedisperse a stream of spectra.
+
+    Each channel's running mean is subtracted before summing, so the output
+    time series have zero mean, and data from missing packets contribute
+    nothing. Output sample `i` is the dedispersed signal arriving at the
+    highest frequency channel in input spectrum `i`, so output lags input by
+    `max_delay` spectra.
+
+    :param dms: Dispersion measures, in pc cm^-3
+    :type dms: list
+    :param freqs: Channel frequencies, in MHz
+    :type freqs: numpy.ndarray
+    :param tsamp: Time between spectra, in seconds
+    :type tsamp: float
+    :param products: Product mode of the input spectra. See `spectra.PRODUCT_MODES`.
+        Total power is dedispersed.
+    :type products: str
+    :param baseline_time: Time constant, in seconds, of the running channel means
+    :type baseline_time: float
+    :param max_elements: Maximum number of values gathered at once. Larger blocks are
+        processed in several steps.
+    :type max_elements: int
+
+    :ivar delays: Delay of each channel, in spectra, with dimensions [DM, channel]
+    :ivar max_delay: Largest delay, in spectra
+    :ivar n_out: Number of output samples produced
+    """
+    def __init__(self, dms, freqs, tsamp, products='I', baseline_time=1.0, max_elements=16*1024*1024):
+        self.dms = np.asarray(dms, dtype=np.float64)
+        self.freqs = np.asarray(freqs, dtype=np.float64)
+        self.tsamp = tsamp
+        self.products = products
+        self.n_chans = len(self.freqs)
+        self.delays = dispersion_delays(self.dms, self.freqs, tsamp)
+        self.max_delay = int(self.delays.max()) if self.delays.size > 0 else 0
+        # Runs of adjacent channels with the same delay, flattened over DMs
+        starts = [np.flatnonzero(np.diff(d, prepend=-1) != 0) for d in self.delays]
+        self._run_dm = np.concatenate([[i] * len(st) for i, st in enumerate(starts)]).astype(np.int64)
+        self._run_start = np.concatenate(starts)
+        self._run_end = np.concatenate([np.append(st[1:], self.n_chans) for st in starts])
+        self._run_delay = self.delays[self._run_dm, self._run_start]
+        self.alpha = min(1.0, tsamp / baseline_time)
+        self.max_elements = max_elements
+        self._mean = None
+        self._tail = np.zeros([0, self.n_chans], dtype=np.float32)
+        self.n_out = 0
+
+    @classmethod
+    def from_header(cls, dms, header, **kwargs):
+        """
+        Make a dedisperser for data described by a filterbank header.
+
+        :param dms: Dispersion measures, in pc cm^-3
+        :type dms: list
+        :param header: Filterbank header, such as returned by `sigproc.spectrometer_header`
+        :type header: dict
+        :param kwargs: Other keyword arguments are passed to `Dedisperser`
+
+        :return: Dedisperser
+        :rtype: Dedisperser
+        """
+        return cls(dms, sigproc.channel_freqs(header), header['tsamp'], **kwargs)
+
+    def _normalize(self, x, valid):
+        """
+        Subtract running channel means from a block of total power spectra in place,
+        and zero data which were not received.
+        """
+        n_valid = valid.sum(axis=0)
+        block_mean = np.where(valid, x, 0).sum(axis=0) / np.maximum(n_valid, 1)
+        if self._mean is None:
+            self._mean = block_mean
+        else:
+            # Weight the update by the number of spectra in the block
+            a = 1 - (1 - self.alpha) ** n_valid
+            self._mean += a * (block_mean - self._mean)
+        x -= self._mean
+        x[~valid] = 0
+
+    def process(self, data, mask=None):
+        """
+        Dedisperse a block of spectra.
+
+        :param data: Spectra, with dimensions [time, channel, product], or [time, channel]
+            for total power
+        :type data: numpy.ndarray
+        :param mask: Packet mask of each spectrum, as written by `spectra.SpectraRecorder`.
+            If None, all data are taken to be valid.
+        :type mask: numpy.ndarray
+
+        :return: Dedispersed time series, with dimensions [time, DM]. The number of
+            samples returned is the number of spectra for which all the delayed
+            data have arrived.
+        :rtype: numpy.ndarray
+        """
+        if data.ndim == 3:
+            data = spectra.total_power(data, self.products)
+        x = np.array(data, dtype=np.float32)
+        if mask is None:
+            valid = np.ones(x.shape, dtype=bool)
+        else:
+            valid = spectra.unpack_mask(mask, self.n_chans, spectra.N_PACKETS_PER_SPECTRUM)
+        self._normalize(x, valid)
+        buf = np.concatenate([self._tail, x])
+        n_out = len(buf) - self.max_delay
+        self._tail = buf[max(0, n_out):]
+        out = np.zeros([max(0, n_out), len(self.dms)], dtype=np.float32)
+        if n_out <= 0:
+            return out
+        # Sum of the channels of each run, in each spectrum, from a cumulative sum over channels
+        csum = np.zeros([len(buf), self.n_chans + 1], dtype=np.float64)
+        np.cumsum(buf, axis=1, out=csum[:, 1:])
+        t = np.arange(n_out)[:, None]
+        step = max(1, self.max_elements // n_out)
+        for r0 in range(0, len(self._run_dm), step):
+            r = slice(r0, r0 + step)
+            rows = t + self._run_delay[r]
+            runs = csum[rows, self._run_end[r]] - csum[rows, self._run_start[r]]
+            # Runs are ordered by DM, so each DM's runs are contiguous
+            dms, first = np.unique(self._run_dm[r], return_index=True)
+            out[:, dms] += np.add.reduceat(runs, first, axis=1)
+        self.n_out += n_out
+        return out
+
+def timeseries_filename(filename, dm):
+    """
+    Get the name of the file to which the time series of one DM from
+    the data in `filename` are written.
+
+    :param filename: Data file name, eg. 'obs_1600000000.fil'
+    :type filename: str
+    :param dm: Dispersion measure
+    :type dm: float
+
+    :return: File name, eg. 'obs_1600000000_DM26.76.tim'
+    :rtype: str
+    """
+    return '%s_DM%.2f.tim' % (os.path.splitext(filename)[0], dm)
+
+class TimeSeriesWriter(object):
+    """
+    Dedisperse spectra and write a SIGPROC time series file for each DM.
+    May be used as a processor in a `pipeline.CapturePipeline`.
+
+    :param filename: Data file name, from which the time series file names
+        are made by `timeseries_filename`
+    :type filename: str
+    :param dms: Dispersion measures, in pc cm^-3
+    :type dms: list
+    :param header: Filterbank header of the spectra, such as returned by
+        `sigproc.spectrometer_header`
+    :type header: dict
+    :param kwargs: Other keyword arguments are passed to `Dedisperser`
+    """
+    def __init__(self, filename, dms, header, **kwargs):
+        self.dedisperser = Dedisperser.from_header(dms, header, **kwargs)
+        self.writers = []
+        for dm in self.dedisperser.dms:
+            tim_header = {k: v for k, v in header.items() if k not in ('fch1', 'foff', 'nchans', 'nifs', 'nbits')}
+            tim_header.update({
+                'data_type': 2, # time series
+                'refdm': dm,
+                'fch1': float(self.dedisperser.freqs.max()),
+                'nchans': 1,
+                'nifs': 1,
+                'nbits': 32,
+            })
+            self.writers += [sigproc.FilterbankWriter(timeseries_filename(filename, dm), tim_header)]
+
+    def process(self, data, mask=None, index=None):
+        """
+        Dedisperse a block of spectra, and append the results to the time series files.
+
+        :param data: Spectra, with dimensions [time, channel, product]
+        :type data: numpy.ndarray
+        :param mask: Packet mask of each spectrum
+        :type mask: numpy.ndarray
+        :param index: Index of the first spectrum. Unused, since blocks are contiguous.
+        :type index: int
+        """
+        series = self.dedisperser.process(data, mask)
+        if len(series) == 0:
+            return
+        series = series.T.copy()
+        for writer, s in zip(self.writers, series):
+            writer.write(s)
+
+    def close(self):
+        """
+        Close the time series files.
+        """
+        for writer in self.writers:
+            writer.close()
@@ -0,0 +1,386 @@
+"""
+Multi-socket reception of packets from many SNAP boards.
+
+A `MultiReceiver` opens several sockets bound to the same address with
+SO_REUSEPORT, each served by its own worker process. The kernel
+distributes packets between the sockets by flow, so all the packets from
+a given board arrive at the same worker, and throughput scales with the
+number of workers.
+
+Each worker groups the packets in a batch by a routing key -- the source
+address, F-engine ID, or F-engine ID and channel -- and passes each group
+to a per-stream handler. Per-stream packet and drop counters are kept in
+shared memory, where they can be read by the parent process.
+"""
+
+import time
+import signal
+import logging
+import multiprocessing
+import numpy as np
+
+from . import rx
+from . import spectra
+from . import voltage
+
+#: Routing keys by which packets can be demultiplexed
+ROUTES = ('source', 'feng_id', 'chan')
+
+#: Counters kept for each stream
+STREAM_STATS = (
+    'key',        # Routing key
+    'packets',    # Packets received
+    'bytes',      # Bytes received
+    'first_seq',  # Lowest packet sequence number received
+    'last_seq',   # Highest packet sequence number received
+    'n_seqs',     # Number of sequences interleaved in the stream (eg. voltage channels)
+)
+
+#: Counters kept for each worker
+WORKER_STATS = (
+    'batches',    # Batches received
+    'packets',    # Packets received
+    'invalid',    # Packets discarded because their size was wrong
+    'untracked',  # Packets whose stream could not be given a counter slot
+    'kernel_drops', # Packets dropped by the kernel because the socket buffer was full
+    'rx_queue',   # Bytes waiting in the socket buffer, when last sampled
+    'rcvbuf',     # Socket buffer size, in bytes
+)
+
+#: Interval, in seconds, at which socket statistics are sampled
+SOCKET_STATS_INTERVAL = 1.0
+
+_NO_KEY = -1
+_NO_SEQ = -1
+
+class SpectraFormat(object):
+    """
+    Spectrometer packets. These can only be routed by source address.
+    Each board's packet counter provides a sequence number.
+    """
+    packet_bytes = spectra.PACKET_BYTES
+    routes = ('source',)
+
+    def valid(self, nbytes):
+        return nbytes == self.packet_bytes
+
+    def keys(self, buf, src, route):
+        return src
+
+    def seqs(self, buf, route):
+        return np.ascontiguousarray(buf[:, 0:spectra.HEADER_BYTES]).view('>u8')[:, 0].astype(np.int64)
+
+    def seq_ids(self, buf, route):
+        return None
+
+class VoltageFormat(object):
+    """
+    Voltage packets. These can be routed by source address, F-engine ID,
+    or F-engine ID and channel. The packet timestamp provides a sequence
+    number for each F-engine and channel. When routed by source address or
+    F-engine ID, a stream interleaves the sequences of each of its channels.
+    """
+    packet_bytes = voltage.MAX_PACKET_BYTES
+    routes = ROUTES
+
+    def valid(self, nbytes):
+        return nbytes > voltage.HEADER_BYTES
+
+    def keys(self, buf, src, route):
+        if route == 'source':
+            return src
+        h = voltage.decode_headers(buf)
+        if route == 'feng_id':
+            return h['feng_id'].astype(np.int64)
+        return (h['feng_id'].astype(np.int64) << 16) + h['chan']
+
+    def seqs(self, buf, route):
+        h = voltage.decode_headers(buf)
+        return (h['timestamp'] // voltage.N_TIMES_PER_PACKET).astype(np.int64)
+
+    def seq_ids(self, buf, route):
+        if route == 'chan':
+            return None
+        h = voltage.decode_headers(buf)
+        return (h['feng_id'].astype(np.int64) << 16) + h['chan']
+
+FORMATS = {
+    'spectra': SpectraFormat,
+    'voltage': VoltageFormat,
+}
+
+def key_to_str(route, key):
+    """
+    Get a human-readable name for a stream.
+
+    :param route: Routing used, one of ROUTES
+    :type route: str
+    :param key: Stream routing key
+    :type key: int
+
+    :return: Stream name, eg. '10.11.10.1', 'feng3', or 'feng3_chan512'
+    :rtype: str
+    """
+    if route == 'source':
+        return rx.int_to_ip(key)
+    if route == 'feng_id':
+        return 'feng%d' % key
+    return 'feng%d_chan%d' % (key >> 16, key & 0xffff)
+
+class FilePerStream(object):
+    """
+    A stream factory for `MultiReceiver` which writes each stream to its own file.
+
+    :param template: Filename template, with a single `%s` which is replaced with
+        the stream name, as returned by `key_to_str`.
+    :type template: str
+    :param stream_class: Class to instantiate for each stream. It is called
+        as stream_class(filename, **kwargs) and must provide `process(buf, nbytes)`
+        and `close()` methods.
+    :type stream_class: class
+    """
+    def __init__(self, template, stream_class=spectra.SpectraFileWriter, **kwargs):
+        self.template = template
+        self.stream_class = stream_class
+        self.kwargs = kwargs
+
+    def __call__(self, name):
+        return self.stream_class(self.template % name, **self.kwargs)
+
+def _worker(index, ip, port, fmt, route, rcvbuf, batch, stream_factory,
+            stream_table, worker_table, stop):
+    """
+    Receive packets on one SO_REUSEPORT socket, and demultiplex them into streams.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    receiver = rx.UdpReceiver(ip, port, rcvbuf=rcvbuf, timeout=0.1,
+                              reuseport=True, record_source=(route == 'source'))
+    ring = rx.PacketRing(16 * batch, fmt.packet_bytes)
+    table = np.frombuffer(stream_table, dtype=np.int64).reshape(-1, len(STREAM_STATS))
+    wstats = np.frombuffer(worker_table, dtype=np.int64)
+    rows = {} # key -> row of table
+    streams = {} # key -> stream handler
+    seq_ids = {} # key -> IDs of the sequences seen in the stream
+    KEY, PACKETS, BYTES, FIRST, LAST, N_SEQS = range(len(STREAM_STATS))
+    next_sample = 0
+    while not stop.is_set():
+        now = time.monotonic()
+        if now >= next_sample:
+            sock_stats = receiver.socket_stats()
+            for k in ('kernel_drops', 'rx_queue', 'rcvbuf'):
+                wstats[WORKER_STATS.index(k)] = sock_stats[k]
+            next_sample = now + SOCKET_STATS_INTERVAL
+        s, n = receiver.recv_batch(ring, batch)
+        if n == 0:
+            continue
+        buf = ring.buf[s:s+n]
+        nbytes = ring.nbytes[s:s+n]
+        src = ring.src[s:s+n]
+        wstats[0] += 1
+        wstats[1] += n
+        valid = fmt.valid(nbytes)
+        if not np.all(valid):
+            wstats[2] += n - np.count_nonzero(valid)
+            buf, nbytes, src = buf[valid], nbytes[valid], src[valid]
+            if len(buf) == 0:
+                continue
+        keys = fmt.keys(buf, src, route)
+        seqs = fmt.seqs(buf, route)
+        ids = fmt.seq_ids(buf, route)
+        # Group packets by stream, preserving arrival order within each group
+        order = np.argsort(keys, kind='stable')
+        skeys = keys[order]
+        bounds = np.flatnonzero(skeys[1:] != skeys[:-1]) + 1
+        for start, stop_ in zip(np.r_[0, bounds], np.r_[bounds, len(skeys)]):
+            key = int(skeys[start])
+            idx = order[start:stop_]
+            row = rows.get(key)
+            if row is None:
+                free = np.flatnonzero(table[:, KEY] == _NO_KEY)
+                if len(free) == 0:
+                    wstats[3] += len(idx)
+                    continue
+                row = rows[key] = free[0]
+                table[row, KEY] = key
+                if stream_factory is not None:
+                    streams[key] = stream_factory(key_to_str(route, key))
+            table[row, PACKETS] += len(idx)
+            table[row, BYTES] += int(nbytes[idx].sum())
+            if seqs is not None:
+                seq = seqs[idx]
+                lo, hi = int(seq.min()), int(seq.max())
+                if table[row, FIRST] == _NO_SEQ or lo < table[row, FIRST]:
+                    table[row, FIRST] = lo
+                table[row, LAST] = max(table[row, LAST], hi)
+                if ids is not None:
+                    seen = seq_ids.setdefault(key, set())
+                    seen.update(np.unique(ids[idx]).tolist())
+                    table[row, N_SEQS] = len(seen)
+            if key in streams:
+                streams[key].process(buf[idx], nbytes[idx])
+    for stream in streams.values():
+        stream.close()
+    receiver.close()
+
+class MultiReceiver(object):
+    """
+    Receive packets from many boards on several SO_REUSEPORT sockets, each served
+    by a worker process, and demultiplex them into per-board streams.
+
+    :param ip: IP address on which to receive
+    :type ip: str
+    :param port: UDP port on which to receive
+    :type port: int
+    :param fmt: Packet format. 'spectra' or 'voltage'.
+    :type fmt: str
+    :param n_workers: Number of sockets / worker processes. Default: number of CPUs.
+    :type n_workers: int
+    :param route: How to demultiplex packets. One of ROUTES.
+    :type route: str
+    :param stream_factory: If not None, a callable which is called in the worker
+        process with a stream name (see `key_to_str`) the first time a stream is seen,
+        and which returns an object with `process(buf, nbytes)` and `close()` methods
+        to which that stream's packets are passed. Eg. `FilePerStream`.
+    :type stream_factory: callable
+    :param rcvbuf: If not None, requested receive buffer size for each socket, in bytes.
+    :type rcvbuf: int
+    :param batch: Maximum number of packets to receive at once
+    :type batch: int
+    :param max_streams: Maximum number of streams for which each worker keeps counters.
+    :type max_streams: int
+    """
+    def __init__(self, ip, port, fmt='spectra', n_workers=None, route='source',
+                 stream_factory=None, rcvbuf=None, batch=256, max_streams=256):
+        self.logger = logging.getLogger('MultiReceiver')
+        if fmt not in FORMATS:
+            raise ValueError("Packet format must be one of %s" % list(FORMATS.keys()))
+        self.fmt = FORMATS[fmt]()
+        if route not in self.fmt.routes:
+            raise ValueError("%s packets can only be routed by %s" % (fmt, self.fmt.routes))
+        self.route = route
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.max_streams = max_streams
+        n_stats = len(STREAM_STATS)
+        self._stream_tables = []
+        self._worker_tables = []
+        self._stop = multiprocessing.Event()
+        self._procs = []
+        for i in range(self.n_workers):
+            stream_table = multiprocessing.RawArray('q', max_streams * n_stats)
+            table = np.frombuffer(stream_table, dtype=np.int64).reshape(max_streams, n_stats)
+            table[:] = _NO_SEQ
+            table[:, STREAM_STATS.index('key')] = _NO_KEY
+            table[:, STREAM_STATS.index('packets')] = 0
+            table[:, STREAM_STATS.index('bytes')] = 0
+            table[:, STREAM_STATS.index('n_seqs')] = 1
+            worker_table = multiprocessing.RawArray('q', len(WORKER_STATS))
+            self._stream_tables += [table]
+            self._worker_tables += [np.frombuffer(worker_table, dtype=np.int64)]
+            self._procs += [multiprocessing.Process(target=_worker, name='rx%d' % i,
+                args=(i, ip, port, self.fmt, route, rcvbuf, batch, stream_factory,
+                      stream_table, worker_table, self._stop))]
+
+    def start(self):
+        """
+        Start the worker processes.
+        """
+        for proc in self._procs:
+            proc.start()
+
+    def stop(self):
+        """
+        Tell the worker processes to close their streams and exit,
+        and wait for them to do so.
+        """
+        self._stop.set()
+        for proc in self._procs:
+            proc.join()
+
+    def is_alive(self):
+        """
+        :return: True if any worker process is still running
+        :rtype: bool
+        """
+        return any(proc.is_alive() for proc in self._procs)
+
+    def worker_stats(self):
+        """
+        Get per-worker counters.
+
+        :return: List, with one entry per worker, of dictionaries of the
+            counters in WORKER_STATS.
+        :rtype: list
+        """
+        return [dict(zip(WORKER_STATS, t.tolist())) for t in self._worker_tables]
+
+    def stream_stats(self):
+        """
+        Get per-stream counters, combined over all workers.
+
+        :return: Dictionary, keyed by stream name (see `key_to_str`), of dictionaries
+            with entries 'packets', 'bytes', 'workers' (the indices of the workers which
+            received the stream) and, where packets carry sequence numbers, 'dropped'
+            (the number of packets missing between the first and last received, in each
+            of the sequences interleaved in the stream).
+        :rtype: dict
+        """
+        rv = {}
+        for i, table in enumerate(self._stream_tables):
+            for row in table[table[:, 0] != _NO_KEY]:
+                s = dict(zip(STREAM_STATS, row.tolist()))
+                name = key_to_str(self.route, s['key'])
+                if name not in rv:
+                    rv[name] = {'packets': 0, 'bytes': 0, 'workers': [],
+                                'first_seq': s['first_seq'], 'last_seq': s['last_seq'], 'n_seqs': 1}
+                r = rv[name]
+                r['packets'] += s['packets']
+                r['bytes'] += s['bytes']
+                r['workers'] += [i]
+                if s['first_seq'] != _NO_SEQ:
+                    r['first_seq'] = min(r['first_seq'], s['first_seq'])
+                    r['last_seq'] = max(r['last_seq'], s['last_seq'])
+                    r['n_seqs'] = max(r['n_seqs'], s['n_seqs'])
+        for r in rv.values():
+            first = r.pop('first_seq')
+            last = r.pop('last_seq')
+            n_seqs = r.pop('n_seqs')
+            if first != _NO_SEQ:
+                r['dropped'] = max(0, (last - first + 1) * n_seqs - r['packets'])
+        return rv
+
+    def loss_report(self):
+        """
+        Break down where packets were lost.
+
+        :return: Dictionary with entries:
+            'sequence_gaps': Packets missing from streams with sequence numbers.
+            'kernel_drops': Packets dropped by the kernel because socket buffers were full.
+            'upstream': Packets missing which were not dropped by the kernel, and so
+            were lost before reaching this host.
+            'socket_backlog': Bytes waiting in socket buffers.
+            'rcvbuf': Total socket buffer size, in bytes.
+        :rtype: dict
+        """
+        workers = self.worker_stats()
+        gaps = sum(s.get('dropped', 0) for s in self.stream_stats().values())
+        kernel = sum(w['kernel_drops'] for w in workers)
+        return {
+            'sequence_gaps': gaps,
+            'kernel_drops': kernel,
+            'upstream': max(0, gaps - kernel),
+            'socket_backlog': sum(w['rx_queue'] for w in workers),
+            'rcvbuf': sum(w['rcvbuf'] for w in workers),
+        }
+
+    def log_stats(self):
+        """
+        Log per-stream counters, and a summary of packet loss.
+        """
+        for name, s in sorted(self.stream_stats().items()):
+            self.logger.info("%20s: %10d packets, %14d bytes, %8s dropped (worker %s)" % (
+                             name, s['packets'], s['bytes'], s.get('dropped', '-'),
+                             ','.join(map(str, s['workers']))))
+        loss = self.loss_report()
+        self.logger.info("Loss: %d missing, %d kernel drops, %d upstream. Backlog: %d / %d socket bytes" % (
+                         loss['sequence_gaps'], loss['kernel_drops'], loss['upstream'],
+                         loss['socket_backlog'], loss['rcvbuf']))
@@ -0,0 +1,232 @@
+"""
+Online folding of spectrometer data at a pulsar's period.
+
+Each spectrum's time is computed from its index (its packet counter /
+`spectra.N_PACKETS_PER_SPECTRUM`), the time of the F-engine's last sync
+(see `AtaSnapFengine.sync_get_last_sync_time`) and the spectrum period.
+The pulse phase at that time, from a topocentric period or a polynomial
+ephemeris, selects the phase bin into which the spectrum is added. Phase
+bins are computed for a whole block of spectra at once, and the block is
+accumulated with a single `numpy.bincount`.
+
+The folded profiles are saved to a .npz file periodically, and when folding
+finishes, so that no spectra need be stored.
+
+Example usage:
+    eph = Ephemeris.from_period(0.714519699726)
+    folder = Folder(eph, header, sync_time, n_bins=256, filename='B0329+54.npz')
+    folder.process(spectra, mask, index)
+    folder.close()
+"""
+
+import os
+import math
+import numpy as np
+
+from . import spectra
+from . import sigproc
+
+class Ephemeris(object):
+    """
+    A polynomial pulse phase model, giving the phase at unix time `t` as
+    phase0 + f0 * dt + f1 * dt**2 / 2 + f2 * dt**3 / 6 + ...
+    where dt = t - epoch.
+
+    :param epoch: Reference time, as a unix time
+    :type epoch: float
+    :param freqs: Topocentric pulse frequency, in Hz, and its derivatives (f0, f1, f2, ...)
+    :type freqs: list
+    :param phase0: Pulse phase, in turns, at the reference time
+    :type phase0: float
+    """
+    def __init__(self, epoch, freqs, phase0=0.0):
+        self.epoch = epoch
+        self.freqs = [float(f) for f in freqs]
+        self.phase0 = phase0
+
+    @classmethod
+    def from_period(cls, period, epoch=0.0, pdot=0.0):
+        """
+        Make an ephemeris from a topocentric period.
+
+        :param period: Pulse period, in seconds
+        :type period: float
+        :param epoch: Time, as a unix time, at which the period applies, and at which
+            the phase is 0
+        :type epoch: float
+        :param pdot: Period derivative
+        :type pdot: float
+
+        :return: Ephemeris
+        :rtype: Ephemeris
+        """
+        return cls(epoch, [1. / period, -pdot / period**2])
+
+    def phase(self, dt):
+        """
+        Compute pulse phase.
+
+        :param dt: Seconds since the ephemeris epoch
+        :type dt: numpy.ndarray
+
+        :return: Pulse phase, in turns
+        :rtype: numpy.ndarray
+        """
+        coeffs = [self.phase0] + [f / math.factorial(k + 1) for k, f in enumerate(self.freqs)]
+        return np.polynomial.polynomial.polyval(dt, coeffs)
+
+    def period(self, dt=0.0):
+        """
+        Get the pulse period.
+
+        :param dt: Seconds since the ephemeris epoch
+        :type dt: float
+
+        :return: Period, in seconds
+        :rtype: float
+        """
+        coeffs = [f / math.factorial(k) for k, f in enumerate(self.freqs)]
+        return 1. / np.polynomial.polynomial.polyval(dt, coeffs)
+
+class Folder(object):
+    """
+    Fold spectra into a [phase bin, channel] accumulator.
+
+    The sum of the data and the number of valid spectra contributing
+    to each bin and channel are kept separately, so data from missing
+    packets are excluded, and the mean profile is `sums / counts`.
+
+    :param ephemeris: Pulse phase model
+    :type ephemeris: Ephemeris
+    :param header: Filterbank header of the spectra, such as returned by
+        `sigproc.spectrometer_header`, giving the spectrum period and channel frequencies
+    :type header: dict
+    :param sync_time: Unix time of spectrum index 0, ie. the F-engine's last sync
+    :type sync_time: float
+    :param n_bins: Number of phase bins
+    :type n_bins: int
+    :param products: Product mode of the input spectra. See `spectra.PRODUCT_MODES`.
+        Total power is folded.
+    :type products: str
+    :param filename: If not None, save the folded profiles to this .npz file
+        periodically, and when the folder is closed
+    :type filename: str
+    :param checkpoint_time: Seconds of data between saves
+    :type checkpoint_time: float
+
+    :ivar sums: Sum of data in each bin, with dimensions [phase bin, channel]
+    :ivar counts: Number of spectra in each bin, with dimensions [phase bin, channel]
+    :ivar n_spectra: Number of spectra folded
+    """
+    def __init__(self, ephemeris, header, sync_time, n_bins=128, products='I', filename=None,
+                 checkpoint_time=10.0):
+        self.ephemeris = ephemeris
+        self.tsamp = header['tsamp']
+        self.freqs = sigproc.channel_freqs(header)
+        self.n_chans = len(self.freqs)
+        self.sync_time = sync_time
+        self.n_bins = n_bins
+        self.products = products
+        self.filename = filename
+        self.checkpoint_spectra = max(1, int(checkpoint_time / self.tsamp))
+        self.sums = np.zeros([n_bins, self.n_chans], dtype=np.float64)
+        self.counts = np.zeros([n_bins, self.n_chans], dtype=np.int64)
+        self.n_spectra = 0
+        self.first_index = None
+        self.last_index = None
+        self._next_checkpoint = self.checkpoint_spectra
+        # Channel offsets within each row of the accumulator
+        self._chans = np.arange(self.n_chans)
+
+    def phase_bins(self, index, n):
+        """
+        Compute the phase bins of consecutive spectra.
+
+        :param index: Index of the first spectrum
+        :type index: int
+        :param n: Number of spectra
+        :type n: int
+
+        :return: Phase bin of each spectrum
+        :rtype: numpy.ndarray
+        """
+        # Spectra are timestamped at the middle of their accumulation. The offset from the
+        # ephemeris epoch is computed first, to keep the precision of the time within the scan
+        dt = (self.sync_time - self.ephemeris.epoch) + (index + np.arange(n) + 0.5) * self.tsamp
+        phase = self.ephemeris.phase(dt)
+        return (np.floor((phase - np.floor(phase)) * self.n_bins).astype(np.int64)) % self.n_bins
+
+    def process(self, data, mask=None, index=0):
+        """
+        Fold a block of consecutive spectra.
+
+        :param data: Spectra, with dimensions [time, channel, product], or [time, channel]
+            for total power
+        :type data: numpy.ndarray
+        :param mask: Packet mask of each spectrum, as written by `spectra.SpectraRecorder`.
+            If None, all data are taken to be valid.
+        :type mask: numpy.ndarray
+        :param index: Index of the first spectrum
+        :type index: int
+        """
+        if data.ndim == 3:
+            data = spectra.total_power(data, self.products)
+        n = len(data)
+        if n == 0:
+            return
+        bins = self.phase_bins(index, n)
+        idx = (bins[:, None] * self.n_chans + self._chans).ravel()
+        size = self.n_bins * self.n_chans
+        if mask is None or np.all(mask == (1 << spectra.N_PACKETS_PER_SPECTRUM) - 1):
+            weights = np.asarray(data, dtype=np.float64).ravel()
+            self.counts += np.bincount(bins, minlength=self.n_bins)[:, None]
+        else:
+            valid = spectra.unpack_mask(mask, self.n_chans, spectra.N_PACKETS_PER_SPECTRUM)
+            weights = np.where(valid, data, 0).ravel()
+            self.counts += np.bincount(idx[valid.ravel()], minlength=size).reshape(self.n_bins, self.n_chans)
+        self.sums += np.bincount(idx, weights=weights, minlength=size).reshape(self.n_bins, self.n_chans)
+        if self.first_index is None:
+            self.first_index = index
+        self.last_index = index + n - 1
+        self.n_spectra += n
+        if self.filename is not None and self.n_spectra >= self._next_checkpoint:
+            self.save()
+            self._next_checkpoint = self.n_spectra + self.checkpoint_spectra
+
+    def profile(self):
+        """
+        Get the mean folded profile.
+
+        :return: Mean of the data in each bin, with dimensions [phase bin, channel].
+            NaN where no data were folded.
+        :rtype: numpy.ndarray
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums / self.counts
+
+    def save(self, filename=None):
+        """
+        Save the folded profiles. The file is replaced atomically, so a reader
+        never sees a partially written file.
+
+        :param filename: File to write. Default: the filename given when the
+            folder was made.
+        :type filename: str
+        """
+        filename = filename or self.filename
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, sums=self.sums, counts=self.counts, freqs=self.freqs,
+                     n_spectra=self.n_spectra, tsamp=self.tsamp, sync_time=self.sync_time,
+                     first_index=-1 if self.first_index is None else self.first_index,
+                     last_index=-1 if self.last_index is None else self.last_index,
+                     epoch=self.ephemeris.epoch, ephemeris_freqs=self.ephemeris.freqs,
+                     phase0=self.ephemeris.phase0)
+        os.replace(tmp, filename)
+
+    def close(self):
+        """
+        Save the final folded profiles, if a filename was given.
+        """
+        if self.filename is not None:
+            self.save()
@@ -0,0 +1,458 @@
+"""
+Recording of F-engine voltages in GUPPI raw format.
+
+A GUPPI raw file is a sequence of blocks, each of which is an ASCII header
+followed by a fixed-size block of data. The header is a series of 80
+character "cards", as in FITS, each holding a `KEY = value` pair, and ending
+with an `END` card. The header describes the data block which follows it,
+including its sky frequency (OBSFREQ, CHAN_BW), number of channels
+(OBSNCHAN), bits per sample (NBITS) and data size (BLOCSIZE), and counts
+the packets since the start of the stream (PKTIDX), from which the time of
+each block follows. If DIRECTIO is 1, the header and the data are each
+padded to a multiple of 512 bytes.
+
+Voltage blocks from a `assemble.VoltageAssembler` are written with
+dimensions [antenna, channel, time, polarization], keeping the F-engine's
+4+4 bit complex samples (NBITS = 4), with the real part in the four most
+significant bits of each byte. OBSNCHAN counts the channels of all the
+antennas, and NANTS gives the number of antennas, as in multi-antenna
+GUPPI raw files. Assembling with out_format='packed' avoids decoding and
+re-packing the samples.
+
+Each block, header and data, is packed into a page-aligned buffer and
+written with a single write. Optionally, files are opened with O_DIRECT,
+bypassing the page cache, in which case blocks are padded to a multiple of
+the device's block size.
+
+Example usage:
+    header = sigproc.voltage_header('B0329+54', ra, dec, srate, rfc, ifc, tstart, chans)
+    writer = RawWriter('obs', header, asm.feng_ids, chans, block_times=8192, direct_io=True)
+    for block in asm.get():
+        writer.process(block.data, block.valid(), block.timestamp)
+        asm.free(block)
+    writer.close()
+
+    f = RawFile('obs.0000.raw')
+    x = f.read_block(0) # [antenna, channel, time, polarization] of complex64
+"""
+
+import os
+import mmap
+import logging
+import numpy as np
+
+from . import voltage
+from . import sigproc
+
+CARD_BYTES = 80
+DIRECTIO_ALIGN = 512 # Padding of headers and data blocks when DIRECTIO = 1
+
+_END = b'END'.ljust(CARD_BYTES)
+
+def _roundup(n, align):
+    return -(-n // align) * align
+
+def _encode_value(value):
+    if isinstance(value, str):
+        return ("'%-8s'" % value).ljust(20)
+    if isinstance(value, (bool, np.bool_)):
+        return ('T' if value else 'F').rjust(20)
+    if isinstance(value, (int, np.integer)):
+        return ('%d' % value).rjust(20)
+    return repr(float(value)).rjust(20)
+
+def encode_header(cards):
+    """
+    Encode a GUPPI raw header.
+
+    :param cards: Header values, keyed by keyword of up to 8 characters. Values may be
+        strings, integers or floats.
+    :type cards: dict
+
+    :return: Header, including the END card
+    :rtype: bytes
+    """
+    lines = []
+    for key, value in cards.items():
+        if len(key) > 8:
+            raise ValueError("Header keyword %s is longer than 8 characters" % key)
+        line = '%-8s= %s' % (key, _encode_value(value))
+        if len(line) > CARD_BYTES:
+            raise ValueError("Header value of %s is too long" % key)
+        lines += [line.ljust(CARD_BYTES)]
+    return ''.join(lines).encode('ascii') + _END
+
+def _decode_value(s):
+    s = s.strip()
+    if s.startswith("'"):
+        return s[1:].rsplit("'", 1)[0].rstrip()
+    for t in (int, float):
+        try:
+            return t(s)
+        except ValueError:
+            pass
+    return s
+
+def decode_header(buf, offset=0):
+    """
+    Decode a GUPPI raw header.
+
+    :param buf: Buffer containing the header
+    :type buf: bytes or mmap.mmap
+    :param offset: Position of the header in the buffer
+    :type offset: int
+
+    :return: cards, header_bytes. Dictionary of header values, and the length of
+        the header, including the END card but not any padding.
+    :rtype: dict, int
+    """
+    cards = {}
+    pos = offset
+    while True:
+        card = bytes(buf[pos:pos + CARD_BYTES])
+        if len(card) < CARD_BYTES:
+            raise ValueError("Header at offset %d has no END card" % offset)
+        pos += CARD_BYTES
+        if card == _END:
+            return cards, pos - offset
+        key, sep, value = card.decode('ascii').partition('=')
+        if sep:
+            cards[key.strip()] = _decode_value(value)
+
+def raw_filename(filename, seq):
+    """
+    Get the name of a file of a recording which is split into several files.
+
+    :param filename: Base file name, eg. 'obs_1600000000'
+    :type filename: str
+    :param seq: File number
+    :type seq: int
+
+    :return: File name, eg. 'obs_1600000000.0000.raw'
+    :rtype: str
+    """
+    return '%s.%04d.raw' % (filename, seq)
+
+def raw_header(header, feng_ids, chans, block_times, n_chans_f=voltage.N_CHANS_F):
+    """
+    Build the GUPPI raw header values which are common to all the blocks of a recording.
+
+    :param header: Filterbank header of the voltage channels, such as returned by
+        `sigproc.voltage_header` with n_int=1
+    :type header: dict
+    :param feng_ids: F-engine IDs of the antennas, in antenna order
+    :type feng_ids: list
+    :param chans: F-engine channels in each block. These must be contiguous.
+    :type chans: list
+    :param block_times: Number of time samples per block
+    :type block_times: int
+    :param n_chans_f: Number of channels generated by the F-engine
+    :type n_chans_f: int
+
+    :return: Header values, suitable for passing to `encode_header`
+    :rtype: dict
+    """
+    n_chans = len(chans)
+    freqs = sigproc.channel_freqs(dict(header, nchans=n_chans))
+    cards = {
+        'BACKEND': 'ATASNAP',
+        'TELESCOP': 'ATA',
+        'SRC_NAME': header.get('source_name', ''),
+        'OBSFREQ': float(freqs.mean()),
+        'OBSBW': header['foff'] * n_chans,
+        'CHAN_BW': header['foff'],
+        'TBIN': header['tsamp'],
+        'OBSNCHAN': len(feng_ids) * n_chans,
+        'NANTS': len(feng_ids),
+        'NPOL': voltage.N_POLS,
+        'NBITS': 4,
+        'SCHAN': int(chans[0]),
+        'FENCHAN': n_chans_f,
+        'FENGIDS': ','.join('%d' % f for f in feng_ids),
+        'PIPERBLK': block_times // voltage.N_TIMES_PER_PACKET,
+    }
+    if 'tstart' in header:
+        cards['STT_IMJD'] = int(header['tstart'])
+        cards['STT_SMJD'] = int((header['tstart'] % 1) * 86400)
+        cards['STT_OFFS'] = float((header['tstart'] % 1) * 86400 % 1)
+    return cards
+
+class RawWriter(object):
+    """
+    Write voltage blocks to GUPPI raw files.
+
+    :param filename: Base file name, from which file names are made by `raw_filename`
+    :type filename: str
+    :param header: Filterbank header of the voltage channels, such as returned by
+        `sigproc.voltage_header` with n_int=1. Its start time is that of the first
+        block written.
+    :type header: dict
+    :param feng_ids: F-engine IDs of the antennas, in antenna order
+    :type feng_ids: list
+    :param chans: F-engine channels in each block. These must be contiguous.
+    :type chans: list
+    :param block_times: Number of time samples per block
+    :type block_times: int
+    :param blocks_per_file: Number of blocks written to each file before starting the
+        next. If None, all blocks are written to one file.
+    :type blocks_per_file: int
+    :param direct_io: If True, open files with O_DIRECT, and pad the headers and data
+        blocks (DIRECTIO = 1)
+    :type direct_io: bool
+    :param align: With direct_io, the size, in bytes, of which every block written is a
+        multiple. This should be a multiple of the device's logical block size, and
+        of DIRECTIO_ALIGN.
+    :type align: int
+    :param cards: Other header values, eg. {'OBSERVER': 'me'}
+    :type cards: dict
+
+    :ivar n_blocks: Number of blocks written
+    :ivar nbytes: Number of bytes written
+    """
+    def __init__(self, filename, header, feng_ids, chans, block_times, blocks_per_file=None,
+                 direct_io=False, align=4096, cards=None):
+        self.logger = logging.getLogger('RawWriter')
+        if align % DIRECTIO_ALIGN != 0:
+            raise ValueError("Alignment must be a multiple of %d bytes" % DIRECTIO_ALIGN)
+        self.filename = filename
+        self.blocks_per_file = blocks_per_file
+        self.direct_io = direct_io
+        self.align = align if direct_io else 1
+        self.cards = raw_header(header, feng_ids, chans, block_times)
+        self.cards.update(cards or {})
+        self.shape = (len(feng_ids), len(chans), block_times, voltage.N_POLS)
+        self.blocsize = int(np.prod(self.shape))
+        self.cards.update({
+            'BLOCSIZE': self.blocsize,
+            'DIRECTIO': int(direct_io),
+            'PKTIDX': 0,
+            'PKTSTART': 0,
+            'DROPBLK': 0.0,
+        })
+        self._padding = 0
+        self._buf = None
+        self.fd = None
+        self.seq = 0
+        self.n_blocks = 0
+        self.nbytes = 0
+
+    def _header(self, pktidx, drop):
+        """
+        Encode a block's header. With direct_io, the header is padded so that the
+        whole block is a multiple of `align`.
+        """
+        self.cards['PKTIDX'] = pktidx
+        self.cards['DROPBLK'] = drop
+        encoded = encode_header(self.cards)
+        if not self.direct_io:
+            return encoded
+        data_bytes = _roundup(self.blocsize, DIRECTIO_ALIGN)
+        # Pad with extra cards, rather than blanks, since readers find the data by
+        # rounding the header's length up to a multiple of DIRECTIO_ALIGN
+        pad = encode_header({'PADDING': 0})[0:CARD_BYTES]
+        while True:
+            padded = encoded[:-CARD_BYTES] + pad * self._padding + _END
+            size = _roundup(len(padded), DIRECTIO_ALIGN)
+            if (size + data_bytes) % self.align == 0:
+                return padded.ljust(size, b' ')
+            self._padding += 1
+
+    def _open(self):
+        """
+        Open the next file.
+        """
+        name = raw_filename(self.filename, self.seq)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if self.direct_io:
+            try:
+                self.fd = os.open(name, flags | os.O_DIRECT, 0o644)
+                return
+            except (OSError, AttributeError) as e:
+                self.logger.warning("Could not open %s with O_DIRECT (%s). Using buffered writes" % (name, e))
+        self.fd = os.open(name, flags, 0o644)
+
+    def write(self, data, timestamp, valid=None):
+        """
+        Write a voltage block.
+
+        :param data: Voltages, with dimensions [antenna, channel, time, polarization] of
+            packed uint8 or complex64, or [antenna, channel, time, polarization, real/imag]
+            of int8
+        :type data: numpy.ndarray
+        :param timestamp: Timestamp, in samples, of the block's first time sample
+        :type timestamp: int
+        :param valid: Boolean mask, with dimensions [antenna, channel, time], which is True
+            where data were received. Data which were not received are zeroed.
+            If None, all data are valid.
+        :type valid: numpy.ndarray
+        """
+        n_valid = self.blocsize // voltage.N_POLS if valid is None else int(np.count_nonzero(valid))
+        drop = 1. - n_valid / (self.blocsize // voltage.N_POLS)
+        pktidx = int(timestamp) // voltage.N_TIMES_PER_PACKET
+        if self.n_blocks == 0:
+            self.cards['PKTSTART'] = pktidx
+        header = self._header(pktidx, drop)
+        size = len(header) + (_roundup(self.blocsize, DIRECTIO_ALIGN) if self.direct_io else self.blocsize)
+        if self._buf is None or len(self._buf) < size:
+            # An anonymous map is page aligned, as O_DIRECT requires
+            self._buf = mmap.mmap(-1, size)
+        buf = np.frombuffer(self._buf, dtype=np.uint8, count=size)
+        buf[0:len(header)] = np.frombuffer(header, dtype=np.uint8)
+        out = buf[len(header):len(header) + self.blocsize].reshape(self.shape)
+        voltage.to_packed(data, out=out)
+        if valid is not None and n_valid < valid.size:
+            out *= valid[..., None]
+        buf[len(header) + self.blocsize:size] = 0
+        if self.fd is None:
+            self._open()
+        view = memoryview(self._buf)[0:size]
+        while len(view) > 0:
+            view = view[os.write(self.fd, view):]
+        self.n_blocks += 1
+        self.nbytes += size
+        if self.blocks_per_file is not None and self.n_blocks % self.blocks_per_file == 0:
+            os.close(self.fd)
+            self.fd = None
+            self.seq += 1
+
+    def process(self, data, valid=None, timestamp=0):
+        """
+        Write a voltage block. See `write`.
+        """
+        self.write(data, timestamp, valid)
+
+    def close(self):
+        """
+        Close the file.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class RawFile(object):
+    """
+    Memory-mapped access to the blocks of a GUPPI raw file.
+
+    :param filename: File to open
+    :type filename: str
+
+    :ivar headers: Header values of each block
+    :ivar offsets: Position of each block's data in the file
+    :ivar n_blocks: Number of complete blocks in the file
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        self.headers = []
+        self.offsets = []
+        pos = 0
+        while pos < size:
+            try:
+                cards, n = decode_header(self._mmap, pos)
+            except ValueError:
+                break
+            directio = cards.get('DIRECTIO', 0)
+            pos += _roundup(n, DIRECTIO_ALIGN) if directio else n
+            if pos + cards['BLOCSIZE'] > size:
+                break
+            self.headers += [cards]
+            self.offsets += [pos]
+            pos += _roundup(cards['BLOCSIZE'], DIRECTIO_ALIGN) if directio else cards['BLOCSIZE']
+        self.n_blocks = len(self.headers)
+
+    def shape(self, i=0):
+        """
+        Get the dimensions of a block's data.
+
+        :param i: Block index
+        :type i: int
+
+        :return: Dimensions [antenna, channel, time, polarization]
+        :rtype: tuple
+        """
+        h = self.headers[i]
+        n_ants = h.get('NANTS', 1)
+        n_chans = h['OBSNCHAN'] // n_ants
+        n_pols = h['NPOL']
+        n_times = h['BLOCSIZE'] * 8 // (h['OBSNCHAN'] * n_pols * 2 * h['NBITS'])
+        return (n_ants, n_chans, n_times, n_pols)
+
+    def block(self, i):
+        """
+        Get a block's packed data.
+
+        :param i: Block index
+        :type i: int
+
+        :return: Packed samples, as a read-only array view of the file, with dimensions
+            [antenna, channel, time, polarization] of uint8
+        :rtype: numpy.ndarray
+        """
+        if self.headers[i]['NBITS'] != 4:
+            raise ValueError("Only 4-bit data can be read")
+        return np.frombuffer(self._mmap, dtype=np.uint8, count=self.headers[i]['BLOCSIZE'],
+                             offset=self.offsets[i]).reshape(self.shape(i))
+
+    def read_block(self, i, out_format='complex64'):
+        """
+        Decode a block's data.
+
+        :param i: Block index
+        :type i: int
+        :param out_format: Sample format. One of voltage.OUTPUT_FORMATS.
+        :type out_format: str
+
+        :return: Samples, with dimensions [antenna, channel, time, polarization], as
+            described in `voltage.decode_payloads`
+        :rtype: numpy.ndarray
+        """
+        if out_format not in voltage.OUTPUT_FORMATS:
+            raise ValueError("Output format must be one of %s" % (list(voltage.OUTPUT_FORMATS),))
+        return voltage.OUTPUT_FORMATS[out_format][self.block(i)]
+
+    def timestamp(self, i):
+        """
+        Get a block's timestamp.
+
+        :param i: Block index
+        :type i: int
+
+        :return: Timestamp, in samples, of the block's first time sample
+        :rtype: int
+        """
+        return self.headers[i]['PKTIDX'] * voltage.N_TIMES_PER_PACKET
+
+    def freqs(self, i=0):
+        """
+        Get the channel centre frequencies of a block.
+
+        :param i: Block index
+        :type i: int
+
+        :return: Frequencies, in MHz
+        :rtype: numpy.ndarray
+        """
+        h = self.headers[i]
+        n_chans = self.shape(i)[1]
+        return h['OBSFREQ'] + h['CHAN_BW'] * (np.arange(n_chans) - (n_chans - 1) / 2.)
+
+    def close(self):
+        """
+        Close the file.
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
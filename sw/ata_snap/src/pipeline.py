@@ -0,0 +1,661 @@
+"""
+Multi-process capture pipeline for SNAP spectrometer data.
+
+Capture is split into three processes:
+
+  1. receive: reads packets from the socket into blocks of a shared memory packet ring
+  2. reduce: decodes packet blocks and assembles spectra into blocks of a shared
+     memory spectrum ring
+  3. write: optionally flags RFI in spectrum blocks, writes them to disk, and
+     optionally decimates them and writes the decimated spectra to a second
+     file. Other processing of the spectra, such as dedispersion, can be added
+     to this stage.
+
+Blocks are passed between processes by slot index and sequence number, so data
+are never copied through a pipe. A slow disk write only delays the writer, and
+the rings absorb the delay. If the rings fill completely, the receiver keeps
+draining the socket, and discards (and counts) the packets it cannot store,
+rather than letting the kernel drop them silently.
+"""
+
+import time
+import queue
+import signal
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+from . import rx
+from . import spectra
+from . import sigproc
+from . import decimate
+from . import rfi
+
+#: Names of the statistics kept for each pipeline stage
+STAGE_STATS = (
+    'blocks',       # Blocks output by the stage
+    'consumed',     # Blocks taken from the stage's input ring
+    'packets',      # Packets handled by the stage
+    'busy',         # Seconds spent processing (not kept for the receive stage, which mostly waits on the socket)
+    'latency',      # Sum of the times blocks spent queued before this stage took them
+    'max_latency',  # Longest time a block spent queued before this stage took it
+    'stalls',       # Number of times the stage waited for a free output block
+    'stall',        # Seconds spent waiting for free output blocks
+    'dropped',      # Packets discarded because no output block was free
+    'spectra',      # Spectra output
+    'decimated',    # Decimated spectra output
+    'flagged',      # Samples ([spectrum, channel] pairs) flagged as RFI
+    'missing',      # Packets missing from output spectra
+    'late',         # Packets arriving after their spectra were output
+    'invalid',      # Spectra output with missing packets
+    'kernel_drops', # Packets dropped by the kernel because the socket buffer was full
+    'rx_queue',     # Bytes waiting in the socket buffer, when last sampled
+    'rcvbuf',       # Socket buffer size, in bytes
+)
+
+#: Interval, in seconds, at which socket statistics are sampled
+SOCKET_STATS_INTERVAL = 1.0
+
+STAGES = ('receive', 'reduce', 'write')
+
+class ShmRing(object):
+    """
+    A ring of fixed-size blocks in shared memory, handed between a producer
+    process and a consumer process.
+
+    Each block holds one array per field in `fields`. Free and filled block indices
+    are passed through queues, and each filled block carries a sequence number,
+    the number of valid entries it contains, and the time it was published.
+
+    :param n_blocks: Number of blocks in the ring
+    :type n_blocks: int
+    :param fields: Dictionary, keyed by field name, of (shape, dtype) tuples
+        describing the arrays held in each block.
+    :type fields: dict
+    :param name: If None, create a new shared memory segment. Otherwise, attach to the
+        existing segment with this name.
+    :type name: str
+    """
+    _CONTROL = 3 # published, released, max occupancy
+
+    def __init__(self, n_blocks, fields, name=None, free=None, full=None):
+        self.n_blocks = n_blocks
+        self.fields = {k: (tuple(shape), np.dtype(dtype)) for k, (shape, dtype) in fields.items()}
+        layout = []
+        offset = 0
+        for k, (shape, dtype) in self.fields.items():
+            layout += [(k, (n_blocks,) + shape, dtype, offset)]
+            offset += n_blocks * int(np.prod(shape)) * dtype.itemsize
+        for k, dtype in (('seq', np.int64), ('length', np.int64), ('t', np.float64)):
+            layout += [('_' + k, (n_blocks,), np.dtype(dtype), offset)]
+            offset += n_blocks * 8
+        layout += [('_control', (self._CONTROL,), np.dtype(np.int64), offset)]
+        offset += self._CONTROL * 8
+        self._owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self._owner, size=offset)
+        self.name = self.shm.name
+        self._arrays = {}
+        for k, shape, dtype, off in layout:
+            self._arrays[k] = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=off)
+        self.seq = self._arrays['_seq']
+        self.length = self._arrays['_length']
+        self.t = self._arrays['_t']
+        self._control = self._arrays['_control']
+        if self._owner:
+            self._control[:] = 0
+            self.free = multiprocessing.Queue()
+            self.full = multiprocessing.Queue()
+            for i in range(n_blocks):
+                self.free.put(i)
+        else:
+            self.free = free
+            self.full = full
+        self._next_seq = 0
+
+    def __getstate__(self):
+        return {'n_blocks': self.n_blocks, 'fields': self.fields, 'name': self.name,
+                'free': self.free, 'full': self.full}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __getitem__(self, field):
+        """
+        Get the array of field `field`, with the block index as the first axis.
+        """
+        return self._arrays[field]
+
+    @property
+    def occupancy(self):
+        """
+        Number of blocks published and not yet released.
+        """
+        return int(self._control[0] - self._control[1])
+
+    @property
+    def max_occupancy(self):
+        """
+        Largest occupancy seen when publishing a block.
+        """
+        return int(self._control[2])
+
+    def acquire(self, timeout=None):
+        """
+        Get a free block to fill.
+
+        :param timeout: Seconds to wait for a free block. If 0, don't wait.
+            If None, wait forever.
+        :type timeout: float
+
+        :return: Block index, or None if no block became free
+        :rtype: int
+        """
+        try:
+            if timeout == 0:
+                return self.free.get_nowait()
+            return self.free.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def publish(self, block, length):
+        """
+        Hand a filled block to the consumer.
+
+        :param block: Block index, as returned by `acquire`
+        :type block: int
+        :param length: Number of valid entries in the block
+        :type length: int
+        """
+        self.seq[block] = self._next_seq
+        self.length[block] = length
+        self.t[block] = time.monotonic()
+        self._next_seq += 1
+        self._control[0] += 1
+        self._control[2] = max(self._control[2], self.occupancy)
+        self.full.put((block, int(self.seq[block])))
+
+    def end(self):
+        """
+        Tell the consumer that no more blocks will be published.
+        """
+        self.full.put((None, self._next_seq))
+
+    def get(self, timeout=None):
+        """
+        Get the next filled block.
+
+        :param timeout: Seconds to wait for a block. If None, wait forever.
+        :type timeout: float
+
+        :return: block, seq. Block index and sequence number. block is None
+            if the producer has ended the stream. Returns (None, None) on timeout.
+        :rtype: int, int
+        """
+        try:
+            block, seq = self.full.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+        if block is not None:
+            assert self.seq[block] == seq, "Block %d sequence number %d doesn't match %d" % (
+                                           block, self.seq[block], seq)
+        return block, seq
+
+    def release(self, block):
+        """
+        Return a consumed block to the free pool.
+
+        :param block: Block index, as returned by `get`
+        :type block: int
+        """
+        self._control[1] += 1
+        self.free.put(block)
+
+    def close(self):
+        """
+        Detach from the shared memory, and free it if this ring created it.
+        """
+        self._arrays = {}
+        self.seq = self.length = self.t = self._control = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+class _StageStats(object):
+    """
+    Per-stage statistics, in shared memory so they can be read by the parent process.
+    """
+    def __init__(self):
+        self.values = multiprocessing.Array('d', len(STAGE_STATS), lock=False)
+
+    def add(self, key, value):
+        self.values[STAGE_STATS.index(key)] += value
+
+    def set(self, key, value):
+        self.values[STAGE_STATS.index(key)] = value
+
+    def get(self, key):
+        return self.values[STAGE_STATS.index(key)]
+
+    def consumed(self, ring, block):
+        """
+        Record the queueing latency of a block taken from `ring`.
+        """
+        latency = time.monotonic() - ring.t[block]
+        self.add('consumed', 1)
+        self.add('latency', latency)
+        self.set('max_latency', max(self.get('max_latency'), latency))
+
+    def as_dict(self):
+        return dict(zip(STAGE_STATS, self.values[:]))
+
+class _PendingWrite(object):
+    """
+    File-like object which holds the last buffer written to it.
+    """
+    buf = None
+
+    def write(self, buf):
+        self.buf = buf
+
+class _SpectrumSink(object):
+    """
+    File-like object which copies the spectra written to it by a
+    `spectra.SpectraRecorder` into blocks of a ring. The recorder writes
+    each block's packet mask (to `mask`) before its spectra, so the mask
+    is held until the spectra arrive. The index of each block's first spectrum
+    is taken from `recorder`, which must be set to the recorder writing to the sink.
+    """
+    def __init__(self, ring, stats):
+        self.ring = ring
+        self.stats = stats
+        self.mask = _PendingWrite()
+        self.recorder = None
+
+    def write(self, buf):
+        data = self.ring['data']
+        s = np.frombuffer(buf, dtype=data.dtype).reshape((-1,) + data.shape[2:])
+        t0 = time.monotonic()
+        block = self.ring.acquire(timeout=0)
+        if block is None:
+            self.stats.add('stalls', 1)
+            block = self.ring.acquire()
+            self.stats.add('stall', time.monotonic() - t0)
+        data[block, 0:len(s)] = s
+        self.ring['mask'][block, 0:len(s)] = np.frombuffer(self.mask.buf, dtype=np.uint8)
+        # The recorder counts the block's spectra after writing them
+        self.ring['index'][block] = self.recorder.start_spectrum + self.recorder.n_spectra
+        self.ring.publish(block, len(s))
+        self.stats.add('blocks', 1)
+        self.stats.add('spectra', len(s))
+
+def _sample_socket(receiver, stats):
+    for key, value in receiver.socket_stats().items():
+        stats.set(key, value)
+
+def _receive(ip, port, rcvbuf, packets, duration, flush_time, stats):
+    """
+    Receive stage. Fill packet blocks from the socket until `duration` has elapsed.
+    """
+    receiver = rx.UdpReceiver(ip, port, rcvbuf=rcvbuf, timeout=flush_time)
+    _sample_socket(receiver, stats)
+    next_sample = time.monotonic() + SOCKET_STATS_INTERVAL
+    n_packets, slot_bytes = packets['buf'].shape[1:]
+    rings = [rx.PacketRing(n_packets, slot_bytes, buf=packets['buf'][i], nbytes=packets['nbytes'][i])
+             for i in range(packets.n_blocks)]
+    # Scratch space into which packets are drained when the pipeline is full
+    spill = rx.PacketRing(n_packets, slot_bytes)
+    block = None
+    stop = time.monotonic() + duration
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= stop:
+                break
+            if now >= next_sample:
+                _sample_socket(receiver, stats)
+                next_sample = now + SOCKET_STATS_INTERVAL
+            if block is None:
+                block = packets.acquire(timeout=0)
+                if block is None:
+                    stats.add('stalls', 1)
+                    s, n = receiver.recv_batch(spill, n_packets)
+                    stats.add('dropped', n)
+                    stats.add('stall', time.monotonic() - now)
+                    continue
+                ring = rings[block]
+                ring.write_index = 0
+                block_start = now
+            s, n = receiver.recv_batch(ring, n_packets - ring.write_index)
+            stats.add('packets', n)
+            if ring.write_index == n_packets or (ring.write_index > 0 and now - block_start > flush_time):
+                packets.publish(block, ring.write_index)
+                stats.add('blocks', 1)
+                block = None
+    except KeyboardInterrupt:
+        pass
+    if block is not None and ring.write_index > 0:
+        packets.publish(block, ring.write_index)
+        stats.add('blocks', 1)
+    _sample_socket(receiver, stats)
+    packets.end()
+    receiver.close()
+
+def _reduce(packets, spectrum_ring, recorder_kwargs, stats):
+    """
+    Reduce stage. Decode packet blocks and assemble them into spectrum blocks.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sink = _SpectrumSink(spectrum_ring, stats)
+    recorder = spectra.SpectraRecorder(sink, mask_fh=sink.mask, **recorder_kwargs)
+    sink.recorder = recorder
+    while True:
+        block, seq = packets.get()
+        if block is None:
+            break
+        stats.consumed(packets, block)
+        t0 = time.monotonic()
+        n = packets.length[block]
+        headers, data = spectra.decode_packets(packets['buf'][block, 0:n], packets['nbytes'][block, 0:n],
+                                               recorder.dtype)
+        stall = stats.get('stall')
+        recorder.process(headers, data)
+        packets.release(block)
+        stats.add('packets', n)
+        stats.add('busy', time.monotonic() - t0 - (stats.get('stall') - stall))
+        stats.set('missing', recorder.n_missing)
+        stats.set('late', recorder.n_late)
+        stats.set('invalid', recorder.n_invalid)
+    recorder.finish()
+    stats.set('missing', recorder.n_missing)
+    stats.set('late', recorder.n_late)
+    stats.set('invalid', recorder.n_invalid)
+    spectrum_ring.end()
+
+def _open_output(filename, header, write_mask):
+    """
+    Open a data file (as a filterbank file, if `header` is not None) and,
+    if `write_mask` is True, its packet mask file.
+    """
+    mask_fh = open(spectra.mask_filename(filename), 'wb') if write_mask else None
+    if header is not None:
+        return sigproc.FilterbankWriter(filename, header), mask_fh
+    return open(filename, 'wb'), mask_fh
+
+def _write(spectrum_ring, filename, header, write_mask, decimation, rfi_kwargs, processors, stats):
+    """
+    Write stage. Write spectrum blocks to `filename` (as a filterbank file,
+    if `header` is not None), and their packet masks to the corresponding mask file.
+    If `decimation` is not None, also decimate the spectra and write them to
+    `decimation['filename']`. Full resolution spectra are not written if
+    `filename` is None. Each block is also passed to the processors made by
+    the factories in `processors`. If `rfi_kwargs` is not None, blocks are first
+    flagged by an `rfi.RfiFlagger` made with these arguments, and the flags are
+    written alongside the full resolution spectra.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    outputs = []
+    flagger = None
+    rfi_fh = None
+    if rfi_kwargs is not None:
+        flagger = rfi.RfiFlagger(n_chans=spectrum_ring['data'].shape[2], **rfi_kwargs)
+    if filename is not None:
+        outputs += [_open_output(filename, header, write_mask) + (None,)]
+        if flagger is not None:
+            rfi_fh = open(rfi.rfi_filename(filename), 'wb')
+    if decimation is not None:
+        dec = decimate.Decimator(decimation['n_time'], decimation['n_chan'], decimation['mode'],
+                                 n_chans=spectrum_ring['data'].shape[2])
+        dec_header = None
+        if header is not None:
+            dec_header = decimate.decimated_header(header, dec.n_time, dec.n_chan)
+        outputs += [_open_output(decimation['filename'], dec_header, write_mask) + (dec,)]
+    processors = [factory() for factory in processors]
+    while True:
+        block, seq = spectrum_ring.get()
+        if block is None:
+            break
+        stats.consumed(spectrum_ring, block)
+        t0 = time.monotonic()
+        n = spectrum_ring.length[block]
+        if flagger is not None:
+            flags = flagger.process(spectrum_ring['data'][block, 0:n], spectrum_ring['mask'][block, 0:n])
+            stats.add('flagged', np.count_nonzero(flags))
+            if rfi_fh is not None:
+                rfi_fh.write(memoryview(rfi.pack_flags(flags)))
+        for fh, mask_fh, dec in outputs:
+            data = spectrum_ring['data'][block, 0:n]
+            mask = spectrum_ring['mask'][block, 0:n]
+            if dec is not None:
+                data, mask = dec.process(data, mask)
+                stats.add('decimated', len(data))
+            fh.write(memoryview(data))
+            if mask_fh is not None:
+                mask_fh.write(memoryview(mask))
+        for processor in processors:
+            processor.process(spectrum_ring['data'][block, 0:n], spectrum_ring['mask'][block, 0:n],
+                              int(spectrum_ring['index'][block]))
+        spectrum_ring.release(block)
+        stats.add('blocks', 1)
+        stats.add('spectra', n)
+        stats.add('busy', time.monotonic() - t0)
+    for fh, mask_fh, dec in outputs:
+        fh.close()
+        if mask_fh is not None:
+            mask_fh.close()
+    for processor in processors:
+        processor.close()
+    if rfi_fh is not None:
+        rfi_fh.close()
+
+class CapturePipeline(object):
+    """
+    Record spectrometer packets to disk, using separate receive, reduce and
+    write processes linked by shared memory rings.
+
+    :param ip: IP address on which to receive
+    :type ip: str
+    :param port: UDP port on which to receive
+    :type port: int
+    :param filename: File to which spectra should be written
+    :type filename: str
+    :param duration: Number of seconds to record for
+    :type duration: float
+    :param rcvbuf: If not None, requested socket receive buffer size, in bytes.
+    :type rcvbuf: int
+    :param block_packets: Number of packets per packet ring block
+    :type block_packets: int
+    :param n_packet_blocks: Number of blocks in the packet ring
+    :type n_packet_blocks: int
+    :param block_spectra: Number of spectra per spectrum ring block (and per disk write)
+    :type block_spectra: int
+    :param n_spectrum_blocks: Number of blocks in the spectrum ring
+    :type n_spectrum_blocks: int
+    :param flush_time: Maximum time, in seconds, a partially filled packet block is held
+        before it is passed on.
+    :type flush_time: float
+    :param window_blocks: Number of spectrum blocks in the reordering window.
+        See `spectra.SpectraRecorder`.
+    :type window_blocks: int
+    :param fill: How to fill in data from missing packets.
+        See `spectra.SpectraRecorder`.
+    :type fill: str
+    :param write_mask: If True, write a mask of received packets to the file
+        given by `spectra.mask_filename`.
+    :type write_mask: bool
+    :param header: If not None, write a SIGPROC filterbank file with this header,
+        as taken by `sigproc.encode_header`. Otherwise write raw spectra. The header's
+        `nifs` and `nbits` fields are set to match `products` and `out_dtype`.
+    :type header: dict
+    :param products: Products to record. See `spectra.SpectraRecorder`.
+    :type products: str
+    :param out_dtype: Data type of the recorded products. See `spectra.SpectraRecorder`.
+    :type out_dtype: numpy.dtype
+    :param scale: Factor by which to multiply the products. See `spectra.SpectraRecorder`.
+    :type scale: float
+    :param decimation: If not None, a tuple (n_time, n_chan) of the number of spectra
+        and channels to combine into each spectrum and channel of a decimated output.
+        See `decimate.Decimator`.
+    :type decimation: tuple
+    :param decimate_mode: How spectra are decimated. One of `decimate.MODES`.
+    :type decimate_mode: str
+    :param decimate_filename: File to which decimated spectra are written.
+        Default: given by `decimate.decimated_filename`.
+    :type decimate_filename: str
+    :param keep_full: If False, don't write full resolution spectra, only the
+        outputs of decimation and `processors`.
+    :type keep_full: bool
+    :param rfi_flagging: If not None, a dictionary of keyword arguments for an
+        `rfi.RfiFlagger`, which flags (and optionally replaces) RFI in the spectra before
+        they are written, decimated or processed. The flags are written to the file given by
+        `rfi.rfi_filename`. Since decimation and processors take only the packet mask
+        as a mark of missing data, flagged data may not be replaced with NaNs if either
+        is used.
+    :type rfi_flagging: dict
+    :param processors: Functions, each called with no arguments in the write process,
+        returning a processor to which every block of spectra is passed, such as a
+        `dedisperse.TimeSeriesWriter`. Processors must provide `process(data, mask, index)`
+        and `close()` methods, where `data` has dimensions [spectrum, channel, product],
+        `mask` is the packet mask of each spectrum, and `index` is the index of the first
+        spectrum (its packet counter / `spectra.N_PACKETS_PER_SPECTRUM`).
+    :type processors: list
+    """
+    def __init__(self, ip, port, filename, duration, rcvbuf=None,
+                 block_packets=256, n_packet_blocks=64,
+                 block_spectra=64, n_spectrum_blocks=64, flush_time=0.1,
+                 window_blocks=2, fill='zero', write_mask=True, header=None,
+                 products='I', out_dtype=np.float32, scale=1.0,
+                 decimation=None, decimate_mode='mean', decimate_filename=None, keep_full=True,
+                 rfi_flagging=None, processors=()):
+        self.logger = logging.getLogger('CapturePipeline')
+        self.filename = filename
+        if rfi_flagging is not None and rfi_flagging.get('replace') == 'nan' and (decimation or processors):
+            raise ValueError("RFI cannot be replaced with NaNs when spectra are decimated or processed")
+        n_products = len(spectra.PRODUCT_MODES[products])
+        out_dtype = np.dtype(out_dtype)
+        if header is not None:
+            header = dict(header, nifs=n_products, nbits=8 * out_dtype.itemsize)
+        self.packets = ShmRing(n_packet_blocks, {
+            'buf': ((block_packets, spectra.PACKET_BYTES), np.uint8),
+            'nbytes': ((block_packets,), np.int64),
+        })
+        self.spectra = ShmRing(n_spectrum_blocks, {
+            'data': ((block_spectra, spectra.N_CHANS, n_products), out_dtype),
+            'mask': ((block_spectra,), np.uint8),
+            'index': ((), np.int64),
+        })
+        self.decimate_filename = None
+        if decimation is not None:
+            n_time, n_chan = decimation
+            self.decimate_filename = decimate_filename or decimate.decimated_filename(filename, n_time, n_chan)
+            decimation = {'n_time': n_time, 'n_chan': n_chan, 'mode': decimate_mode,
+                          'filename': self.decimate_filename}
+        elif not keep_full and not processors:
+            raise ValueError("Full resolution spectra must be kept if there is no other output")
+        recorder_kwargs = {'block_spectra': block_spectra, 'window_blocks': window_blocks, 'fill': fill,
+                           'products': products, 'out_dtype': out_dtype, 'scale': scale}
+        self._stats = {stage: _StageStats() for stage in STAGES}
+        self._procs = [
+            multiprocessing.Process(target=_receive, name='receive',
+                args=(ip, port, rcvbuf, self.packets, duration, flush_time, self._stats['receive'])),
+            multiprocessing.Process(target=_reduce, name='reduce',
+                args=(self.packets, self.spectra, recorder_kwargs, self._stats['reduce'])),
+            multiprocessing.Process(target=_write, name='write',
+                args=(self.spectra, filename if keep_full else None, header, write_mask, decimation,
+                      None if rfi_flagging is None else dict(rfi_flagging, products=products),
+                      list(processors), self._stats['write'])),
+        ]
+
+    def start(self):
+        """
+        Start the pipeline processes.
+        """
+        for proc in self._procs:
+            proc.start()
+
+    def is_alive(self):
+        """
+        :return: True if any pipeline process is still running
+        :rtype: bool
+        """
+        return any(proc.is_alive() for proc in self._procs)
+
+    def join(self, timeout=None):
+        """
+        Wait for all pipeline processes to finish, and release the shared memory.
+
+        :param timeout: Seconds to wait for each process. If None, wait forever.
+        :type timeout: float
+        """
+        for proc in self._procs:
+            proc.join(timeout)
+        if not self.is_alive():
+            self.packets.close()
+            self.spectra.close()
+
+    def stats(self):
+        """
+        Get pipeline statistics.
+
+        :return: Dictionary, keyed by stage name ('receive', 'reduce', 'write'), of
+            dictionaries of the statistics in STAGE_STATS, with additional 'occupancy'
+            and 'max_occupancy' entries giving the number of filled blocks in the
+            stage's output ring, and 'mean_latency', the average time blocks were
+            queued before reaching the stage.
+        :rtype: dict
+        """
+        rv = {stage: self._stats[stage].as_dict() for stage in STAGES}
+        for stage, ring in (('receive', self.packets), ('reduce', self.spectra)):
+            if ring.seq is not None:
+                rv[stage]['occupancy'] = ring.occupancy
+                rv[stage]['max_occupancy'] = ring.max_occupancy
+        for stage in STAGES:
+            rv[stage]['mean_latency'] = rv[stage]['latency'] / max(1, rv[stage]['consumed'])
+        return rv
+
+    def loss_report(self):
+        """
+        Break down where packets were lost.
+
+        :return: Dictionary with entries:
+            'sequence_gaps': Packets missing from the recorded spectra.
+            'kernel_drops': Packets dropped by the kernel because the socket buffer was full.
+            'app_drops': Packets discarded by the receiver because the pipeline was full.
+            'upstream': Packets missing which were dropped by neither the kernel
+            nor the pipeline, and so were lost before reaching this host.
+            'socket_backlog': Bytes waiting in the socket buffer.
+            'rcvbuf': Socket buffer size, in bytes.
+            'packet_backlog', 'spectrum_backlog': Filled blocks waiting in the
+            packet and spectrum rings.
+        :rtype: dict
+        """
+        s = self.stats()
+        gaps = int(s['reduce']['missing'])
+        kernel = int(s['receive']['kernel_drops'])
+        app = int(s['receive']['dropped'])
+        return {
+            'sequence_gaps': gaps,
+            'kernel_drops': kernel,
+            'app_drops': app,
+            'upstream': max(0, gaps - kernel - app),
+            'socket_backlog': int(s['receive']['rx_queue']),
+            'rcvbuf': int(s['receive']['rcvbuf']),
+            'packet_backlog': s['receive'].get('occupancy', 0),
+            'spectrum_backlog': s['reduce'].get('occupancy', 0),
+        }
+
+    def log_stats(self):
+        """
+        Log a one-line summary of each stage's statistics, and of packet loss.
+        """
+        for stage, s in self.stats().items():
+            self.logger.info("%8s: %6d blocks, %9d packets, %8d spectra, busy %6.2fs, "
+                             "latency %6.1f ms (max %6.1f ms), occupancy %s, stalls %d (%.2fs), dropped %d" % (
+                             stage, s['blocks'], s['packets'], s['spectra'], s['busy'],
+                             1e3 * s['mean_latency'], 1e3 * s['max_latency'],
+                             s.get('occupancy', '-'), s['stalls'], s['stall'], s['dropped']))
+        loss = self.loss_report()
+        self.logger.info("    loss: %d missing = %d kernel + %d pipeline + %d upstream. "
+                         "Backlog: %d / %d socket bytes, %s packet blocks, %s spectrum blocks" % (
+                         loss['sequence_gaps'], loss['kernel_drops'], loss['app_drops'], loss['upstream'],
+                         loss['socket_backlog'], loss['rcvbuf'], loss['packet_backlog'], loss['spectrum_backlog']))
@@ -0,0 +1,299 @@
+"""
+Monitoring of the 4-bit quantization of F-engine voltage output.
+
+A `QuantizationMonitor` histograms the 16 quantization levels of the real
+and imaginary parts of every channel and polarization of the voltage
+packets it is given, straight from the packet payloads. Each batch of
+packets is added to the histograms with a single `numpy.bincount`, indexed
+by board, channel, polarization and level.
+
+At a fixed interval, the histograms give each channel's RMS (in units of
+one 4-bit least significant bit) and the fraction of samples at the
+extreme levels, which indicates clipping. A compact per-board summary is
+published, and the histograms restart. Since the RMS is measured after
+quantization, it can be used to correct the EQ coefficients with which the
+F-engine scales each channel before quantization (see
+`QuantizationMonitor.update_eq`), without reading spectra from the board.
+
+Example usage:
+    mon = QuantizationMonitor([1, 2, 3], range(1024, 2048), 256, interval=10)
+    while True:
+        s, n = receiver.recv_batch(ring, 256)
+        mon.add_packets(ring.buf[s:s + n], ring.nbytes[s:s + n])
+        mon.poll()
+"""
+
+import time
+import logging
+import numpy as np
+
+from . import voltage
+
+N_LEVELS = 16 # Number of 4-bit quantization levels
+
+#: Value of each quantization level, in LSBs, indexed by (nibble XOR 8)
+LEVELS = np.arange(-N_LEVELS // 2, N_LEVELS // 2)
+
+#: Quantization levels counted as clipped
+CLIP_LEVELS = (-8, -7, 7)
+
+def corrected_eq_coeffs(coeffs, chans, factors, n_coeff_shared=4):
+    """
+    Apply per-channel correction factors to a set of EQ coefficients.
+    Channels which share a coefficient are corrected by the geometric mean
+    of their factors.
+
+    :param coeffs: Current coefficients of all F-engine channels, as returned by
+        `AtaSnapFengine.eq_read_coeffs` with return_float=True
+    :type coeffs: numpy.ndarray
+    :param chans: Channels to which `factors` apply
+    :type chans: list
+    :param factors: Factor by which to multiply the coefficient of each channel.
+        Channels with NaN factors are left unchanged.
+    :type factors: numpy.ndarray
+    :param n_coeff_shared: Number of adjacent channels sharing a coefficient
+    :type n_coeff_shared: int
+
+    :return: New coefficients of all F-engine channels, suitable for passing to
+        `AtaSnapFengine.eq_load_coeffs`
+    :rtype: numpy.ndarray
+    """
+    coeffs = np.array(coeffs, dtype=np.float64)
+    log_factor = np.zeros(len(coeffs))
+    count = np.zeros(len(coeffs))
+    valid = np.isfinite(factors) & (np.asarray(factors) > 0)
+    chans = np.asarray(chans)[valid]
+    log_factor[chans] = np.log(np.asarray(factors)[valid])
+    count[chans] = 1
+    # Geometric mean of the factors of each coefficient's channels
+    log_factor = log_factor.reshape(-1, n_coeff_shared).sum(axis=1)
+    count = count.reshape(-1, n_coeff_shared).sum(axis=1)
+    group = np.exp(log_factor / np.maximum(count, 1))
+    return coeffs * np.repeat(group, n_coeff_shared)
+
+class QuantizationMonitor(object):
+    """
+    Keep quantization statistics of voltage packets.
+
+    :param feng_ids: F-engine IDs of the boards to monitor
+    :type feng_ids: list
+    :param chans: Channels to monitor. These must be contiguous. Default: all
+        F-engine channels.
+    :type chans: list
+    :param n_chans_per_packet: Number of channels in each packet
+    :type n_chans_per_packet: int
+    :param interval: Seconds between summaries
+    :type interval: float
+    :param publish: If not None, a function to which each summary (see `summary`)
+        is passed. Otherwise, summaries are logged.
+    :type publish: callable
+
+    :ivar hist: Counts of each quantization level of the current interval, real and
+        imaginary parts combined, with dimensions [board, channel, polarization, level]
+    :ivar last_hist: Counts of the last complete interval
+    :ivar n_packets: Number of packets added
+    :ivar n_invalid: Number of packets discarded because of their size, F-engine ID or channel
+    """
+    def __init__(self, feng_ids, chans=None, n_chans_per_packet=256, interval=10.0, publish=None):
+        self.logger = logging.getLogger('QuantizationMonitor')
+        chans = np.arange(voltage.N_CHANS_F) if chans is None else np.asarray(chans)
+        if not np.all(np.diff(chans) == 1):
+            raise ValueError("Channels must be contiguous")
+        self.feng_ids = list(feng_ids)
+        self.chans = chans
+        self.start_chan = int(chans[0])
+        self.n_chans = len(chans)
+        self.n_chans_per_packet = n_chans_per_packet
+        self.interval = interval
+        self.publish = publish
+        shape = (len(self.feng_ids), self.n_chans, voltage.N_POLS, N_LEVELS)
+        self.hist = np.zeros(shape, dtype=np.int64)
+        self.last_hist = None
+        self._ant = np.full(2**16, -1, dtype=np.int64)
+        self._ant[self.feng_ids] = np.arange(len(self.feng_ids))
+        # Histogram offset of each payload byte, relative to the packet's first channel
+        self._offsets = ((np.arange(n_chans_per_packet)[:, None, None] * voltage.N_POLS
+                          + np.arange(voltage.N_POLS)[None, None, :]) * N_LEVELS
+                         + np.zeros(voltage.N_TIMES_PER_PACKET, dtype=np.int64)[None, :, None]).ravel()
+        self._size = self.hist.size
+        self._last_publish = time.monotonic()
+        self.n_packets = 0
+        self.n_invalid = 0
+
+    def add_packets(self, buf, nbytes=None):
+        """
+        Add a batch of packets to the histograms.
+
+        :param buf: Packets, as a 2D array of shape [n_packets, >= packet size] of uint8,
+            such as a batch of slots in a `rx.PacketRing`
+        :type buf: numpy.ndarray
+        :param nbytes: Size of each packet. If None, all packets are taken to be of the
+            expected size.
+        :type nbytes: numpy.ndarray
+        """
+        size = voltage.payload_bytes(self.n_chans_per_packet)
+        headers = voltage.decode_headers(buf)
+        ant = self._ant[headers['feng_id']]
+        group, offset = np.divmod(headers['chan'].astype(np.int64) - self.start_chan, self.n_chans_per_packet)
+        ok = ((headers['n_chans'] == self.n_chans_per_packet) & (ant >= 0) & (offset == 0)
+              & (group >= 0) & (group * self.n_chans_per_packet < self.n_chans))
+        if nbytes is not None:
+            ok &= np.asarray(nbytes) == voltage.HEADER_BYTES + size
+        self.n_invalid += int(np.count_nonzero(~ok))
+        if not np.any(ok):
+            return
+        payload = buf[ok, voltage.HEADER_BYTES:voltage.HEADER_BYTES + size]
+        base = ((ant[ok] * self.n_chans + group[ok] * self.n_chans_per_packet)
+                * voltage.N_POLS * N_LEVELS)
+        idx = base[:, None] + self._offsets
+        # XOR with 8 maps two's complement nibbles -8..7 to level indices 0..15
+        hi = (payload >> 4) ^ 8
+        lo = (payload & 0xf) ^ 8
+        counts = np.bincount((idx + hi).ravel(), minlength=self._size)
+        counts += np.bincount((idx + lo).ravel(), minlength=self._size)
+        self.hist += counts.reshape(self.hist.shape)
+        self.n_packets += len(payload)
+
+    def rms(self, hist=None):
+        """
+        Compute the RMS of each channel.
+
+        :param hist: Histograms, with dimensions [..., level]. Default: the current
+            interval's histograms
+        :type hist: numpy.ndarray
+
+        :return: RMS, in LSBs, with dimensions [board, channel, polarization].
+            NaN where there are no samples.
+        :rtype: numpy.ndarray
+        """
+        hist = self.hist if hist is None else hist
+        n = hist.sum(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt((hist * LEVELS**2).sum(axis=-1) / n)
+
+    def clipped_fraction(self, hist=None):
+        """
+        Compute the fraction of each channel's samples at the extreme levels (CLIP_LEVELS).
+
+        :param hist: Histograms, with dimensions [..., level]. Default: the current
+            interval's histograms
+        :type hist: numpy.ndarray
+
+        :return: Clipped fraction, with dimensions [board, channel, polarization].
+            NaN where there are no samples.
+        :rtype: numpy.ndarray
+        """
+        hist = self.hist if hist is None else hist
+        clipped = np.isin(LEVELS, CLIP_LEVELS)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return hist[..., clipped].sum(axis=-1) / hist.sum(axis=-1)
+
+    def summary(self, hist=None):
+        """
+        Get a compact summary of the quantization statistics.
+
+        :param hist: Histograms. Default: the current interval's histograms
+        :type hist: numpy.ndarray
+
+        :return: Dictionary, keyed by F-engine ID, of dictionaries with entries
+            'samples' (number of samples in each polarization),
+            'rms' (median RMS over channels, of each polarization),
+            'clipped' (mean clipped fraction over channels, of each polarization),
+            'worst_chan' (channel with the highest clipped fraction, of each polarization)
+        :rtype: dict
+        """
+        hist = self.hist if hist is None else hist
+        rms = self.rms(hist)
+        clipped = self.clipped_fraction(hist)
+        rv = {}
+        for i, f in enumerate(self.feng_ids):
+            samples = hist[i].sum(axis=(0, 2))
+            if samples.sum() == 0:
+                continue
+            worst = np.nan_to_num(clipped[i], nan=-1).argmax(axis=0)
+            rv[f] = {
+                'samples': [int(s) for s in samples],
+                'rms': [float(np.nanmedian(rms[i, :, p])) for p in range(voltage.N_POLS)],
+                'clipped': [float(np.nanmean(clipped[i, :, p])) for p in range(voltage.N_POLS)],
+                'worst_chan': [int(self.chans[w]) for w in worst],
+            }
+        return rv
+
+    def poll(self, now=None):
+        """
+        Publish a summary, and start a new interval, if the interval has elapsed.
+
+        :param now: Current time, as returned by time.monotonic(). Default: the current time.
+        :type now: float
+
+        :return: The summary published, or None
+        :rtype: dict
+        """
+        now = time.monotonic() if now is None else now
+        if now - self._last_publish < self.interval:
+            return None
+        summary = self.summary()
+        if self.publish is not None:
+            self.publish(summary)
+        else:
+            for f, s in summary.items():
+                self.logger.info("feng %d: RMS %.2f, %.2f LSB; clipped %.2e, %.2e" % (
+                                 f, s['rms'][0], s['rms'][1], s['clipped'][0], s['clipped'][1]))
+        self.last_hist = self.hist
+        self.hist = np.zeros_like(self.last_hist)
+        self._last_publish = now
+        return summary
+
+    def eq_corrections(self, feng_id, target_rms=1.0, min_samples=1000, max_step=2.0):
+        """
+        Compute factors by which to scale the EQ coefficients of a board's channels
+        to bring their RMS to a target, from the last complete interval.
+
+        Clipping makes the measured RMS of an overloaded channel lower than that of the
+        unquantized signal, and a channel with an RMS well below one LSB is measured
+        poorly, so each correction is limited to `max_step`, and corrections should be
+        applied iteratively.
+
+        :param feng_id: F-engine ID of the board
+        :type feng_id: int
+        :param target_rms: Target RMS, in 4-bit LSBs
+        :type target_rms: float
+        :param min_samples: Minimum number of samples in a channel for it to be corrected
+        :type min_samples: int
+        :param max_step: Largest factor by which a coefficient is changed
+        :type max_step: float
+
+        :return: Correction factors, with dimensions [polarization, channel]. NaN for
+            channels without enough samples.
+        :rtype: numpy.ndarray
+        """
+        if self.last_hist is None:
+            raise RuntimeError("No complete interval of statistics is available")
+        hist = self.last_hist[self.feng_ids.index(feng_id)]
+        rms = self.rms(hist)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            factors = np.clip(target_rms / rms, 1. / max_step, max_step)
+        factors[hist.sum(axis=-1) < min_samples] = np.nan
+        return factors.T
+
+    def update_eq(self, feng, target_rms=1.0, **kwargs):
+        """
+        Correct a board's EQ coefficients using the last complete interval's statistics.
+
+        :param feng: F-engine of the board
+        :type feng: AtaSnapFengine
+        :param target_rms: Target RMS, in 4-bit LSBs
+        :type target_rms: float
+        :param kwargs: Other keyword arguments are passed to `eq_corrections`
+
+        :return: The coefficients loaded for each polarization, as returned by
+            `AtaSnapFengine.eq_load_coeffs`
+        :rtype: list
+        """
+        factors = self.eq_corrections(feng.feng_id, target_rms=target_rms, **kwargs)
+        rv = []
+        for pol in range(voltage.N_POLS):
+            coeffs = feng.eq_read_coeffs(pol, return_float=True)
+            new = corrected_eq_coeffs(coeffs, self.chans, factors[pol], feng.n_coeff_shared)
+            rv += [feng.eq_load_coeffs(pol, new)]
+        return rv
@@ -0,0 +1,254 @@
+"""
+Memory-mapped access to spectra recorded by the SNAP receivers.
+
+Both raw (.raw) and SIGPROC filterbank (.fil) files are supported. Files
+are memory-mapped rather than read, so slicing in time or frequency returns
+NumPy views without reading the whole file, and recordings much larger
+than the available memory can be processed in chunks at disk speed.
+
+If a packet mask file (see `spectra.mask_filename`) accompanies a
+recording, it is used to flag the spectra and channels whose packets were
+lost. Likewise, an RFI flag file (see `rfi.rfi_filename`) is used to flag
+data affected by RFI.
+
+Example usage:
+    f = SpectraFile('obs_1600000000.fil')
+    for start, chunk, valid in f.iter_chunks(4096, overlap=256, fill=np.nan):
+        process(chunk)
+"""
+
+import os
+import mmap
+import struct
+import numpy as np
+
+from . import spectra
+from . import sigproc
+from . import rfi
+
+_NBITS_DTYPES = {8: np.uint8, 16: np.float16, 32: np.float32}
+
+class SpectraFile(object):
+    """
+    A memory-mapped recording of spectra.
+
+    :param filename: File to open. If it begins with a SIGPROC header, the
+        header describes the data. Otherwise the file is treated as raw
+        spectra, described by `n_chans`, `nifs` and `dtype`.
+    :type filename: str
+    :param n_chans: Number of channels per spectrum in a raw file
+    :type n_chans: int
+    :param nifs: Number of IFs (eg. polarization products) per channel in a raw file
+    :type nifs: int
+    :param dtype: Data type of a raw file
+    :type dtype: numpy.dtype
+    :param n_packets_per_spectrum: Number of packets per spectrum, used to
+        interpret the packet mask file
+    :type n_packets_per_spectrum: int
+    :param use_mask: If True, and packet mask or RFI flag files exist, load them.
+    :type use_mask: bool
+
+    :ivar header: SIGPROC header dictionary. Empty for raw files.
+    :ivar data: Data, as a read-only array view of the file, with dimensions
+        [time, channel, IF]. As written by `spectra.SpectraRecorder`, the IFs
+        (products) of each channel are stored together.
+    :ivar mask: Packet mask, with one entry per spectrum, or None if there is no mask.
+    :ivar rfi: Bit-packed RFI flags, with dimensions [time, channel / 8], or None if
+        there are no flags.
+    """
+    def __init__(self, filename, n_chans=spectra.N_CHANS, nifs=1, dtype=np.float32,
+                 n_packets_per_spectrum=spectra.N_PACKETS_PER_SPECTRUM, use_mask=True):
+        self.filename = filename
+        self.n_packets_per_spectrum = n_packets_per_spectrum
+        with open(filename, 'rb') as fh:
+            try:
+                self.header, self.header_bytes = sigproc.decode_header(fh.read(4096))
+            except (ValueError, struct.error):
+                self.header, self.header_bytes = {}, 0
+            size = os.fstat(fh.fileno()).st_size
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        if self.header:
+            n_chans = self.header['nchans']
+            nifs = self.header.get('nifs', 1)
+            dtype = _NBITS_DTYPES[self.header['nbits']]
+        self.n_chans = n_chans
+        self.nifs = nifs
+        self.dtype = np.dtype(dtype)
+        spectrum_bytes = n_chans * nifs * self.dtype.itemsize
+        self.n_spectra = (size - self.header_bytes) // spectrum_bytes
+        if self._mmap is None:
+            self.data = np.zeros([0, n_chans, nifs], dtype=self.dtype)
+        else:
+            self.data = np.frombuffer(self._mmap, dtype=self.dtype, count=self.n_spectra * n_chans * nifs,
+                                      offset=self.header_bytes).reshape(self.n_spectra, n_chans, nifs)
+        self.mask = None
+        mask_filename = spectra.mask_filename(filename)
+        if use_mask and os.path.exists(mask_filename) and os.path.getsize(mask_filename) > 0:
+            self.mask = np.memmap(mask_filename, dtype=np.uint8, mode='r')[0:self.n_spectra]
+        self.rfi = None
+        rfi_filename = rfi.rfi_filename(filename)
+        if use_mask and os.path.exists(rfi_filename) and os.path.getsize(rfi_filename) > 0:
+            self.rfi = np.memmap(rfi_filename, dtype=np.uint8, mode='r').reshape(-1, n_chans // 8)[0:self.n_spectra]
+
+    @property
+    def tsamp(self):
+        """
+        Time between spectra, in seconds, or None if unknown.
+        """
+        return self.header.get('tsamp')
+
+    @property
+    def freqs(self):
+        """
+        Channel centre frequencies, in MHz, or None if unknown.
+        """
+        if 'fch1' not in self.header:
+            return None
+        return sigproc.channel_freqs(self.header)
+
+    def times(self, start=0, stop=None):
+        """
+        Get the times of spectra, as seconds since the start of the file,
+        or spectrum indices if the sample time is unknown.
+
+        :param start: First spectrum index
+        :type start: int
+        :param stop: Spectrum index after the last. Default: the end of the file.
+        :type stop: int
+
+        :return: Times
+        :rtype: numpy.ndarray
+        """
+        t = np.arange(start, self.n_spectra if stop is None else stop, dtype=np.float64)
+        return t * self.tsamp if self.tsamp is not None else t
+
+    def __len__(self):
+        return self.n_spectra
+
+    def __getitem__(self, index):
+        """
+        Slice the data, with dimensions [time, channel, IF]. Basic slices return
+        views of the file.
+        """
+        return self.data[index]
+
+    def select(self, tstart=None, tstop=None, fstart=None, fstop=None):
+        """
+        Get a view of the data within a time and frequency range.
+
+        :param tstart: Start time, in seconds from the start of the file
+        :type tstart: float
+        :param tstop: Stop time, in seconds from the start of the file
+        :type tstop: float
+        :param fstart: One edge of the frequency range, in MHz
+        :type fstart: float
+        :param fstop: The other edge of the frequency range, in MHz
+        :type fstop: float
+
+        :raises ValueError: If the file's header doesn't describe its times or frequencies
+
+        :return: t_slice, f_slice, data. The time and channel index ranges selected,
+            and a view of the data, with dimensions [time, channel, IF].
+        :rtype: slice, slice, numpy.ndarray
+        """
+        t_slice = slice(0, self.n_spectra)
+        f_slice = slice(0, self.n_chans)
+        if tstart is not None or tstop is not None:
+            if self.tsamp is None:
+                raise ValueError("File has no sample time. Slice by spectrum index instead")
+            t0 = 0 if tstart is None else max(0, int(np.floor(tstart / self.tsamp)))
+            t1 = self.n_spectra if tstop is None else min(self.n_spectra, int(np.ceil(tstop / self.tsamp)))
+            t_slice = slice(t0, t1)
+        if fstart is not None or fstop is not None:
+            freqs = self.freqs
+            if freqs is None:
+                raise ValueError("File has no frequency information. Slice by channel index instead")
+            lo = freqs.min() if fstart is None else fstart
+            hi = freqs.max() if fstop is None else fstop
+            lo, hi = min(lo, hi), max(lo, hi)
+            chans = np.flatnonzero((freqs >= lo) & (freqs <= hi))
+            f_slice = slice(int(chans[0]), int(chans[-1]) + 1) if len(chans) > 0 else slice(0, 0)
+        return t_slice, f_slice, self.data[t_slice, f_slice]
+
+    def valid(self, start=0, stop=None, channels=False):
+        """
+        Get data validity flags from the packet mask and RFI flags.
+
+        :param start: First spectrum index
+        :type start: int
+        :param stop: Spectrum index after the last. Default: the end of the file.
+        :type stop: int
+        :param channels: If True, return a flag per channel, rather than per spectrum.
+        :type channels: bool
+
+        :return: Boolean array, of dimensions [time] or [time, channel], which is True
+            where all the data were received and are not flagged as RFI. All True if
+            there is no mask or RFI flags.
+        :rtype: numpy.ndarray
+        """
+        stop = self.n_spectra if stop is None else min(stop, self.n_spectra)
+        n = max(0, stop - start)
+        if self.mask is None:
+            valid = np.ones([n, self.n_chans], dtype=bool)
+        else:
+            valid = spectra.unpack_mask(self.mask[start:stop], self.n_chans, self.n_packets_per_spectrum)
+        if self.rfi is not None:
+            valid &= ~rfi.unpack_flags(np.asarray(self.rfi[start:stop]), self.n_chans)
+        return valid if channels else valid.all(axis=1)
+
+    def iter_chunks(self, chunk_spectra, overlap=0, start=0, stop=None, fill=None):
+        """
+        Iterate over the data in chunks of spectra.
+
+        :param chunk_spectra: Number of new spectra in each chunk
+        :type chunk_spectra: int
+        :param overlap: Number of extra spectra from the start of the next chunk to
+            append to each chunk, eg. for algorithms which need a lookahead. The last
+            chunk has no overlap.
+        :type overlap: int
+        :param start: First spectrum index
+        :type start: int
+        :param stop: Spectrum index after the last. Default: the end of the file.
+        :type stop: int
+        :param fill: If None, yield views of the file. Otherwise, yield copies in which
+            data which were not received (according to the packet mask), or which are
+            flagged as RFI, are replaced with this value, eg. `numpy.nan`.
+        :type fill: float
+
+        :return: Generator of (index, data, valid) tuples, where `index` is the index of
+            the first spectrum in the chunk, `data` has dimensions [time, channel, IF], and
+            `valid` is a boolean array of dimensions [time, channel].
+        :rtype: generator
+        """
+        stop = self.n_spectra if stop is None else min(stop, self.n_spectra)
+        if self._mmap is not None and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        for i in range(start, stop, chunk_spectra):
+            j = min(stop, i + chunk_spectra + overlap)
+            data = self.data[i:j]
+            valid = self.valid(i, j, channels=True)
+            if fill is not None and (self.mask is not None or self.rfi is not None):
+                data = data.copy()
+                data[np.broadcast_to(~valid[:, :, None], data.shape)] = fill
+            yield i, data, valid
+
+    def close(self):
+        """
+        Release the file. If views of the data are still in use, the file
+        remains mapped until they are deleted.
+        """
+        self.data = None
+        self.mask = None
+        self.rfi = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
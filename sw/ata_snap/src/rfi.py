@@ -0,0 +1,240 @@
+"""
+Streaming RFI flagging of spectrometer data.
+
+A running robust estimate of each channel's level and spread (median and
+median absolute deviation) is kept, updated from the median and MAD of
+each block of spectra. Against these, each block is flagged for:
+
+  - single samples which are outliers in their channel
+  - spectra whose mean deviation across the band is an outlier (broadband,
+    impulsive RFI)
+  - channels whose mean deviation across the block is an outlier
+    (narrowband RFI which comes and goes)
+  - channels whose running median is an outlier from the spectral baseline,
+    a running median over neighbouring channels (narrowband RFI which is
+    always present, and so is part of the channel's own running statistics)
+
+Flags are returned per [spectrum, channel], and are written bit-packed
+(one bit per channel, eight channels per byte, first channel in the least
+significant bit) to the file given by `rfi_filename`.
+
+Example usage:
+    flagger = RfiFlagger(threshold=5)
+    flags = flagger.process(spectra, mask)
+"""
+
+import warnings
+import numpy as np
+
+from . import spectra
+
+MAD_TO_STD = 1.4826 # Ratio of standard deviation to MAD, for Gaussian noise
+
+#: Values with which flagged data can be replaced
+REPLACE_POLICIES = ('zero', 'nan', 'median')
+
+def rfi_filename(filename):
+    """
+    Get the name of the RFI flag file which accompanies a data file.
+
+    :param filename: Data file name
+    :type filename: str
+
+    :return: RFI flag file name
+    :rtype: str
+    """
+    return filename + '.rfi'
+
+def pack_flags(flags):
+    """
+    Bit-pack RFI flags.
+
+    :param flags: Boolean flags, with dimensions [spectrum, channel]
+    :type flags: numpy.ndarray
+
+    :return: Packed flags, with dimensions [spectrum, channel / 8]
+    :rtype: numpy.ndarray
+    """
+    return np.packbits(flags, axis=1, bitorder='little')
+
+def unpack_flags(packed, n_chans=spectra.N_CHANS):
+    """
+    Unpack bit-packed RFI flags.
+
+    :param packed: Packed flags, with dimensions [spectrum, channel / 8]
+    :type packed: numpy.ndarray
+    :param n_chans: Number of channels
+    :type n_chans: int
+
+    :return: Boolean flags, with dimensions [spectrum, channel]
+    :rtype: numpy.ndarray
+    """
+    return np.unpackbits(packed, axis=1, count=n_chans, bitorder='little').astype(bool)
+
+class RfiFlagger(object):
+    """
+    Flag RFI in a stream of spectra.
+
+    :param n_chans: Number of channels per spectrum
+    :type n_chans: int
+    :param products: Product mode of the input spectra. See `spectra.PRODUCT_MODES`.
+        Flags are computed from total power, and apply to all products.
+    :type products: str
+    :param threshold: Threshold, in robust standard deviations, for flagging single samples
+    :type threshold: float
+    :param spectrum_threshold: Threshold, in standard errors of the band mean, for flagging
+        whole spectra. If None, spectra are not flagged.
+    :type spectrum_threshold: float
+    :param channel_threshold: Threshold, in standard errors of the block mean, for flagging
+        whole channels of a block. If None, channels are not flagged.
+    :type channel_threshold: float
+    :param baseline_chans: Number of neighbouring channels over which the running medians
+        are median filtered to give the spectral baseline. Channels whose running median
+        deviates from the baseline, relative to the baseline, by more than `threshold`
+        robust standard deviations of the relative deviations of all channels are
+        flagged. If None, this test is not made.
+    :type baseline_chans: int
+    :param memory: Number of blocks over which the running statistics are averaged
+    :type memory: int
+    :param replace: If not None, replace flagged data with zeros ('zero'), NaNs ('nan'),
+        or the running median of the channel ('median'). One of REPLACE_POLICIES.
+    :type replace: str
+
+    :ivar median: Running median of each channel's total power
+    :ivar mad: Running MAD of each channel's total power
+    :ivar baseline: Spectral baseline of the running median, or None
+    :ivar n_spectra: Number of spectra processed
+    :ivar n_flagged: Number of samples ([spectrum, channel] pairs) flagged
+    """
+    def __init__(self, n_chans=spectra.N_CHANS, products='I', threshold=5.0, spectrum_threshold=5.0,
+                 channel_threshold=5.0, baseline_chans=33, memory=16, replace=None):
+        if replace is not None and replace not in REPLACE_POLICIES:
+            raise ValueError("Replacement policy must be one of %s" % (REPLACE_POLICIES,))
+        self.n_chans = n_chans
+        self.products = products
+        self.threshold = threshold
+        self.spectrum_threshold = spectrum_threshold
+        self.channel_threshold = channel_threshold
+        self.baseline_chans = baseline_chans
+        self.alpha = 1. / memory
+        self.replace = replace
+        self.median = None
+        self.mad = None
+        self.baseline = None
+        self._product_median = None
+        self.n_spectra = 0
+        self.n_flagged = 0
+
+    def _update(self, running, block):
+        """
+        Move a running statistic towards its value in the latest block. Channels
+        with no valid data in the block (NaN) are left unchanged.
+        """
+        if running is None:
+            return block
+        update = np.isfinite(block) & np.isfinite(running)
+        running[update] += self.alpha * (block[update] - running[update])
+        fresh = np.isfinite(block) & ~np.isfinite(running)
+        running[fresh] = block[fresh]
+        return running
+
+    def _line_flags(self):
+        """
+        Flag channels whose running median is an outlier from the spectral baseline.
+        Deviations are taken relative to the baseline, since the noise of a
+        channel's power, and so of its running median, scales with its level.
+        """
+        half = self.baseline_chans // 2
+        padded = np.pad(self.median, half, mode='edge')
+        windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * half + 1)
+        with warnings.catch_warnings():
+            # Channels with no valid data yet have NaN medians
+            warnings.simplefilter('ignore', RuntimeWarning)
+            self.baseline = np.nanmedian(windows, axis=1)
+            baseline = np.where(self.baseline > 0, self.baseline, np.nan)
+            resid = self.median / baseline - 1
+            sigma = MAD_TO_STD * np.nanmedian(np.abs(resid))
+        if not sigma > 0:
+            return np.zeros(self.n_chans, dtype=bool)
+        with np.errstate(invalid='ignore'):
+            return np.abs(resid) > self.threshold * sigma
+
+    def process(self, data, mask=None):
+        """
+        Flag a block of spectra, replacing flagged data if a replacement policy was given.
+
+        :param data: Spectra, with dimensions [time, channel, product], or [time, channel]
+            for total power. If replacing flagged data, this must be writable.
+        :type data: numpy.ndarray
+        :param mask: Packet mask of each spectrum, as written by `spectra.SpectraRecorder`.
+            Data which were not received are ignored, and not flagged. If None, all data
+            are taken to be valid.
+        :type mask: numpy.ndarray
+
+        :return: Flags, with dimensions [time, channel], which are True where data are flagged
+        :rtype: numpy.ndarray
+        """
+        power = spectra.total_power(data, self.products) if data.ndim == 3 else data
+        power = np.asarray(power, dtype=np.float32)
+        n = len(power)
+        if n == 0:
+            return np.zeros([0, self.n_chans], dtype=bool)
+        if mask is None or np.all(mask == (1 << spectra.N_PACKETS_PER_SPECTRUM) - 1):
+            valid = None
+            x = power
+            block_median = np.median(x, axis=0)
+            block_mad = np.median(np.abs(x - block_median), axis=0)
+        else:
+            valid = spectra.unpack_mask(mask, self.n_chans, spectra.N_PACKETS_PER_SPECTRUM)
+            x = np.where(valid, power, np.nan)
+            with warnings.catch_warnings():
+                # Channels with no valid data have NaN statistics
+                warnings.simplefilter('ignore', RuntimeWarning)
+                block_median = np.nanmedian(x, axis=0)
+                block_mad = np.nanmedian(np.abs(x - block_median), axis=0)
+        self.median = self._update(self.median, block_median.astype(np.float64))
+        self.mad = self._update(self.mad, block_mad.astype(np.float64))
+        sigma = MAD_TO_STD * self.mad
+        sigma = np.where(sigma > 0, sigma, np.inf)
+        z = (x - self.median) / sigma
+        with np.errstate(invalid='ignore'):
+            flags = np.abs(z) > self.threshold
+            z = np.where(flags, 0, z)
+            if valid is not None:
+                z[~valid] = 0
+            n_chans = self.n_chans if valid is None else valid.sum(axis=1)
+            n_spectra = n if valid is None else valid.sum(axis=0)
+            if self.spectrum_threshold is not None:
+                # Mean deviation of each spectrum, in units of its standard error
+                band = z.sum(axis=1) / np.sqrt(np.maximum(n_chans, 1))
+                flags |= (np.abs(band) > self.spectrum_threshold)[:, None]
+            if self.channel_threshold is not None:
+                chan = z.sum(axis=0) / np.sqrt(np.maximum(n_spectra, 1))
+                flags |= (np.abs(chan) > self.channel_threshold)[None, :]
+        if self.baseline_chans is not None:
+            flags |= self._line_flags()[None, :]
+        if valid is not None:
+            flags &= valid
+        if self.replace is not None:
+            self._replace(data, flags)
+        self.n_spectra += n
+        self.n_flagged += np.count_nonzero(flags)
+        return flags
+
+    def _replace(self, data, flags):
+        """
+        Replace flagged data according to the replacement policy.
+        """
+        if self.replace == 'zero':
+            data[flags] = 0
+        elif self.replace == 'nan':
+            data[flags] = np.nan
+        elif data.ndim == 2:
+            data[flags] = np.broadcast_to(self.median, data.shape)[flags]
+        else:
+            # Keep a running median of each product, for replacement
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                block_median = np.nanmedian(np.where(flags[:, :, None], np.nan, data), axis=0)
+            self._product_median = self._update(self._product_median, block_median.astype(np.float64))
+            data[flags] = np.broadcast_to(self._product_median, data.shape)[flags]
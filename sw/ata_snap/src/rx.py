@@ -0,0 +1,406 @@
+"""
+Batched UDP packet reception for SNAP data streams.
+
+Packets are received directly into a preallocated ring of fixed-size
+NumPy packet slots, many packets per call, so that downstream code can
+decode whole batches of packets with vectorized operations rather than
+handling packets one at a time.
+
+Receivers also keep track of where packets are lost. Packets dropped by
+the kernel because the socket buffer was full are counted using the
+SO_RXQ_OVFL socket option and /proc/net/udp, and the number of bytes
+waiting in the socket buffer gives the application's backlog. Packets
+missing from the data stream which were not dropped in the kernel (or by
+the application) were lost before they reached this host.
+"""
+
+import os
+import socket
+import select
+import struct
+import time
+import logging
+import numpy as np
+
+# Linux socket option, not exposed by the socket module
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+
+# The kernel charges packets against the socket buffer by their allocated
+# size, which can be up to twice the payload size for jumbo frames
+RCVBUF_OVERHEAD_FACTOR = 2
+
+def rcvbuf_for_rate(packet_rate, packet_bytes, buffer_time=0.5, min_bytes=4*1024*1024):
+    """
+    Compute a socket receive buffer size large enough to absorb `buffer_time`
+    seconds of packets, should the receiver stall.
+
+    :param packet_rate: Expected packet rate, in packets per second
+    :type packet_rate: float
+    :param packet_bytes: Packet payload size, in bytes
+    :type packet_bytes: int
+    :param buffer_time: Number of seconds of data the buffer should hold
+    :type buffer_time: float
+    :param min_bytes: Minimum buffer size to return
+    :type min_bytes: int
+
+    :return: Buffer size, in bytes
+    :rtype: int
+    """
+    return max(min_bytes, int(packet_rate * buffer_time * packet_bytes * RCVBUF_OVERHEAD_FACTOR))
+
+def read_proc_net_udp(inodes=None, path='/proc/net/udp'):
+    """
+    Read per-socket UDP statistics from /proc/net/udp.
+
+    :param inodes: If not None, only return sockets with these inode numbers
+    :type inodes: list
+    :param path: File to read
+    :type path: str
+
+    :return: Dictionary, keyed by socket inode, of dictionaries with entries
+        'rx_queue' (bytes waiting to be read) and 'drops' (packets dropped by the kernel)
+    :rtype: dict
+    """
+    rv = {}
+    with open(path, 'r') as fh:
+        fh.readline() # Column titles
+        for line in fh:
+            fields = line.split()
+            inode = int(fields[9])
+            if inodes is not None and inode not in inodes:
+                continue
+            rv[inode] = {
+                'rx_queue': int(fields[4].split(':')[1], 16),
+                'drops': int(fields[12]),
+            }
+    return rv
+
+def ip_to_int(ip):
+    """
+    Convert a dotted-quad IPv4 address to an integer.
+
+    :param ip: IP address, eg. '10.11.10.1'
+    :type ip: str
+
+    :return: Integer representation of the address
+    :rtype: int
+    """
+    return struct.unpack('>I', socket.inet_aton(ip))[0]
+
+def int_to_ip(ip):
+    """
+    Convert an integer to a dotted-quad IPv4 address.
+
+    :param ip: Integer representation of the address
+    :type ip: int
+
+    :return: IP address, eg. '10.11.10.1'
+    :rtype: str
+    """
+    return socket.inet_ntoa(struct.pack('>I', ip))
+
+class PacketRing(object):
+    """
+    A preallocated ring of fixed-size packet slots.
+
+    Batches are always written to contiguous slots, so that any batch can
+    be viewed as a single 2D array. A batch which would run past the end
+    of the ring starts again at slot 0.
+
+    :param n_slots: Number of packet slots in the ring
+    :type n_slots: int
+    :param slot_bytes: Size of each slot, in bytes. Packets larger than this are truncated.
+    :type slot_bytes: int
+    :param buf: If not None, an existing uint8 array of shape [n_slots, slot_bytes]
+        to use as packet storage, eg. a block of a shared memory buffer.
+    :type buf: numpy.ndarray
+    :param nbytes: If not None, an existing array of length n_slots in which
+        to record packet sizes.
+    :type nbytes: numpy.ndarray
+
+    :ivar buf: Packet data, as an array of shape [n_slots, slot_bytes] of uint8
+    :ivar nbytes: Number of bytes received into each slot
+    :ivar src: Source IPv4 address of each slot's packet, as an integer, if recorded
+        by the receiver.
+    """
+    def __init__(self, n_slots, slot_bytes, buf=None, nbytes=None):
+        self.n_slots = n_slots
+        self.slot_bytes = slot_bytes
+        if buf is None:
+            buf = np.zeros([n_slots, slot_bytes], dtype=np.uint8)
+        if nbytes is None:
+            nbytes = np.zeros(n_slots, dtype=np.int64)
+        assert buf.shape == (n_slots, slot_bytes)
+        assert nbytes.shape == (n_slots,)
+        self.buf = buf
+        self.nbytes = nbytes
+        self.src = np.zeros(n_slots, dtype=np.int64)
+        self._views = [memoryview(self.buf[i]) for i in range(n_slots)]
+        self.write_index = 0
+
+    def claim(self, max_packets):
+        """
+        Get the index of the slot at which the next batch of at most
+        `max_packets` packets should be written.
+
+        :param max_packets: Maximum number of packets in the batch
+        :type max_packets: int
+
+        :return: start, n. The first slot, and the number of contiguous slots available
+        :rtype: int, int
+        """
+        if self.write_index >= self.n_slots:
+            self.write_index = 0
+        n = min(max_packets, self.n_slots - self.write_index)
+        return self.write_index, n
+
+    def commit(self, n):
+        """
+        Mark `n` slots following the write index as filled.
+
+        :param n: Number of slots filled
+        :type n: int
+        """
+        self.write_index += n
+
+class UdpReceiver(object):
+    """
+    A UDP socket which receives batches of packets into a PacketRing.
+
+    :param ip: IP address on which to receive
+    :type ip: str
+    :param port: UDP port on which to receive
+    :type port: int
+    :param rcvbuf: If not None, requested socket receive buffer size, in bytes.
+        See `set_rcvbuf`.
+    :type rcvbuf: int
+    :param timeout: Time, in seconds, to wait for the first packet of a batch.
+    :type timeout: float
+    :param reuseport: If True, set SO_REUSEPORT, so that several receivers can bind
+        the same address and port, with the kernel sharing packets between them
+        by flow.
+    :type reuseport: bool
+    :param record_source: If True, record the source address of each packet
+        in the ring's `src` array.
+    :type record_source: bool
+
+    :ivar rcvbuf: The socket receive buffer size, in bytes
+    :ivar kernel_drops: Number of packets dropped by the kernel because the
+        socket buffer was full, as of the most recent batch.
+    """
+    def __init__(self, ip, port, rcvbuf=None, timeout=1.0, reuseport=False, record_source=False):
+        self.logger = logging.getLogger('UdpReceiver')
+        self.ip = ip
+        self.port = port
+        self.record_source = record_source
+        self._addrs = {} # Cache of source address integer representations
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.inode = os.fstat(self.sock.fileno()).st_ino
+        self.kernel_drops = 0
+        # Ask the kernel to attach its drop counter to received packets,
+        # which is read from the first packet of each batch
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self._ancbufsize = socket.CMSG_SPACE(4)
+        except OSError:
+            self._ancbufsize = None
+        if rcvbuf is not None:
+            self.set_rcvbuf(rcvbuf)
+        self.rcvbuf = self.get_rcvbuf()
+        if reuseport:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind((ip, port))
+        # The socket is non-blocking, so that queued packets are drained
+        # without waiting. The timeout applies only to the first packet of
+        # a batch, for which the socket is polled.
+        self.sock.setblocking(False)
+        self.timeout = timeout
+        self._timeout_ms = None if timeout is None else int(timeout * 1000)
+        self._poll = select.poll()
+        self._poll.register(self.sock, select.POLLIN)
+
+    def recv_batch(self, ring, max_packets):
+        """
+        Receive up to `max_packets` packets into contiguous slots of `ring`.
+        Block (up to the socket timeout) for the first packet, and then
+        take whatever further packets are already queued on the socket,
+        without blocking.
+
+        :param ring: Ring into which packets are received
+        :type ring: PacketRing
+        :param max_packets: Maximum number of packets to receive
+        :type max_packets: int
+
+        :return: start, n. The first slot written, and the number of packets received.
+            `n` is 0 if no packets arrived before the timeout.
+        :rtype: int, int
+        """
+        if self.record_source:
+            return self._recv_batch_with_source(ring, max_packets)
+        start, n_max = ring.claim(max_packets)
+        views = ring._views
+        nbytes = ring.nbytes
+        n = 0
+        try:
+            nbytes[start], addr = self._recv_first(views[start])
+            n = 1
+            while n < n_max:
+                nbytes[start + n] = self.sock.recv_into(views[start + n])
+                n += 1
+        except (BlockingIOError, socket.timeout):
+            pass
+        ring.commit(n)
+        return start, n
+
+    def _recv_batch_with_source(self, ring, max_packets):
+        """
+        As `recv_batch`, but also record each packet's source address.
+        """
+        start, n_max = ring.claim(max_packets)
+        views = ring._views
+        nbytes = ring.nbytes
+        src = ring.src
+        addrs = self._addrs
+        n = 0
+        try:
+            nbytes[start], addr = self._recv_first(views[start])
+            src[start] = addrs.get(addr[0]) or addrs.setdefault(addr[0], ip_to_int(addr[0]))
+            n = 1
+            while n < n_max:
+                nbytes[start + n], addr = self.sock.recvfrom_into(views[start + n])
+                src[start + n] = addrs.get(addr[0]) or addrs.setdefault(addr[0], ip_to_int(addr[0]))
+                n += 1
+        except (BlockingIOError, socket.timeout):
+            pass
+        ring.commit(n)
+        return start, n
+
+    def _recv_first(self, view):
+        """
+        Wait up to the timeout for a packet, receive it, and update the kernel
+        drop counter, if available.
+
+        :return: nbytes, address
+        """
+        if not self._poll.poll(self._timeout_ms):
+            raise socket.timeout
+        if self._ancbufsize is None:
+            return self.sock.recvfrom_into(view)
+        nbytes, ancdata, flags, addr = self.sock.recvmsg_into([view], self._ancbufsize)
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                self.kernel_drops = struct.unpack('=I', data[0:4])[0]
+        return nbytes, addr
+
+    def set_rcvbuf(self, nbytes):
+        """
+        Set the socket receive buffer size. SO_RCVBUFFORCE is used if the process
+        has the privileges to do so, otherwise the size is limited by the
+        net.core.rmem_max sysctl, and a warning is logged if the buffer is
+        smaller than requested.
+
+        :param nbytes: Requested buffer size, in bytes
+        :type nbytes: int
+
+        :return: The buffer size set, in bytes
+        :rtype: int
+        """
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUFFORCE, nbytes)
+        except (AttributeError, OSError):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, nbytes)
+        self.rcvbuf = self.get_rcvbuf()
+        if self.rcvbuf < nbytes:
+            self.logger.warning("Requested a %d byte receive buffer but got %d bytes. "
+                                "Increase net.core.rmem_max to allow larger buffers" % (nbytes, self.rcvbuf))
+        return self.rcvbuf
+
+    def get_rcvbuf(self):
+        """
+        Get the socket receive buffer size.
+
+        :return: Buffer size, in bytes
+        :rtype: int
+        """
+        # Linux reports double the requested size, to allow for its bookkeeping overhead
+        return self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+
+    def socket_stats(self):
+        """
+        Get kernel statistics for this socket.
+
+        :return: Dictionary with entries 'rcvbuf' (receive buffer size, in bytes),
+            'rx_queue' (bytes waiting to be read) and 'kernel_drops' (packets dropped
+            because the receive buffer was full)
+        :rtype: dict
+        """
+        rv = {'rcvbuf': self.rcvbuf, 'rx_queue': 0, 'kernel_drops': self.kernel_drops}
+        try:
+            udp = read_proc_net_udp(inodes=[self.inode]).get(self.inode)
+        except (IOError, IndexError, ValueError):
+            udp = None
+        if udp is not None:
+            rv['rx_queue'] = udp['rx_queue']
+            rv['kernel_drops'] = max(self.kernel_drops, udp['drops'])
+        return rv
+
+    def close(self):
+        """
+        Close the underlying socket.
+        """
+        self.sock.close()
+
+def replay_packets(packets, ip, port, rate=None, duration=None, count=None, counter_offset=None):
+    """
+    Repeatedly send a set of packets to a UDP destination, eg. to test
+    receiver performance over the loopback interface.
+
+    :param packets: Packets to send, as a 2D array of shape [n_packets, packet_bytes].
+        Packets are sent cyclically.
+    :type packets: numpy.ndarray
+    :param ip: Destination IP address
+    :type ip: str
+    :param port: Destination UDP port
+    :type port: int
+    :param rate: Target packet rate, in packets per second. If None, send as fast as possible.
+    :type rate: float
+    :param duration: Stop after this many seconds.
+    :type duration: float
+    :param count: Stop after this many packets.
+    :type count: int
+    :param counter_offset: If not None, overwrite the 8 bytes at this offset in each
+        packet with a big-endian packet counter, incrementing for each packet sent, so
+        that replayed packets look like a continuous stream.
+    :type counter_offset: int
+
+    :return: n_sent, elapsed. The number of packets sent, and the time taken to send them.
+    :rtype: int, float
+    """
+    assert duration is not None or count is not None, "One of duration or count must be specified"
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    views = [memoryview(np.array(p, dtype=np.uint8)) for p in packets]
+    n_views = len(views)
+    dest = (ip, port)
+    # Pace in bursts, so that timing overhead doesn't limit the achievable rate
+    burst = 64
+    n_sent = 0
+    start = time.monotonic()
+    try:
+        while True:
+            n_burst = burst if count is None else min(burst, count - n_sent)
+            for i in range(n_burst):
+                v = views[n_sent % n_views]
+                if counter_offset is not None:
+                    struct.pack_into('>Q', v, counter_offset, n_sent)
+                sock.sendto(v, dest)
+                n_sent += 1
+            now = time.monotonic()
+            if (count is not None and n_sent >= count) or (duration is not None and now - start >= duration):
+                break
+            if rate is not None:
+                wait = n_sent / float(rate) - (now - start)
+                if wait > 0:
+                    time.sleep(wait)
+    finally:
+        sock.close()
+    return n_sent, time.monotonic() - start
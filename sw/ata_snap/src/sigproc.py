@@ -0,0 +1,375 @@
+"""
+Reading and writing SIGPROC filterbank files.
+
+A filterbank file comprises a header of keyword / value pairs, followed
+by raw data. Strings (including keywords) are encoded as a 32-bit
+length followed by the string's characters, integers as 32-bit values and
+floating point values as 64-bit doubles, all little-endian.
+
+Example usage:
+    header = spectrometer_header('B0329+54', '03:32:59.37', '54:34:43.6',
+                                 acc_len=1024, srate=838.8608, rfc=3500.0,
+                                 ifc=629.1452, tstart=time.time())
+    with FilterbankWriter('obs.fil', header) as fil:
+        fil.write(spectra)
+"""
+
+import os
+import shutil
+import struct
+import numpy as np
+
+#: Header keywords, and the types of their values
+HEADER_KEYS = {
+    'telescope_id': 'int',
+    'machine_id': 'int',
+    'data_type': 'int',
+    'rawdatafile': 'str',
+    'source_name': 'str',
+    'barycentric': 'int',
+    'pulsarcentric': 'int',
+    'az_start': 'double',
+    'za_start': 'double',
+    'src_raj': 'double',
+    'src_dej': 'double',
+    'tstart': 'double',
+    'tsamp': 'double',
+    'nbits': 'int',
+    'nsamples': 'int',
+    'fch1': 'double',
+    'foff': 'double',
+    'nchans': 'int',
+    'nifs': 'int',
+    'nbeams': 'int',
+    'ibeam': 'int',
+    'refdm': 'double',
+    'period': 'double',
+}
+
+_FORMATS = {'int': '<i', 'double': '<d'}
+
+TELESCOPE_ID_ATA = 9 # SIGPROC's telescope ID for the ATA
+MJD_UNIX_EPOCH = 40587.0 # MJD of the unix epoch
+
+def _encode_str(s):
+    s = s.encode()
+    return struct.pack('<i', len(s)) + s
+
+def encode_header(header):
+    """
+    Encode a filterbank header.
+
+    :param header: Dictionary of header values, keyed by keyword.
+        Keys must be in HEADER_KEYS, and are written in the dictionary's order.
+    :type header: dict
+
+    :raises KeyError: If a keyword is not recognized
+
+    :return: encoded, offsets. The encoded header, and a dictionary of the
+        offsets of each numeric value within it, keyed by keyword.
+    :rtype: bytes, dict
+    """
+    encoded = _encode_str('HEADER_START')
+    offsets = {}
+    for key, value in header.items():
+        kind = HEADER_KEYS[key]
+        encoded += _encode_str(key)
+        if kind == 'str':
+            encoded += _encode_str(value)
+        else:
+            offsets[key] = len(encoded)
+            encoded += struct.pack(_FORMATS[kind], value)
+    encoded += _encode_str('HEADER_END')
+    return encoded, offsets
+
+def decode_header(buf):
+    """
+    Decode a filterbank header.
+
+    :param buf: Bytes, beginning with a filterbank header
+    :type buf: bytes
+
+    :raises ValueError: If `buf` does not start with a valid header
+
+    :return: header, nbytes. A dictionary of header values, keyed by keyword,
+        and the length of the header in bytes.
+    :rtype: dict, int
+    """
+    offset = 0
+    def read_str():
+        nonlocal offset
+        n, = struct.unpack_from('<i', buf, offset)
+        if n < 0 or n > 256 or offset + 4 + n > len(buf):
+            raise ValueError("Invalid filterbank header string at offset %d" % offset)
+        s = bytes(buf[offset + 4:offset + 4 + n]).decode()
+        offset += 4 + n
+        return s
+    if len(buf) < 16 or read_str() != 'HEADER_START':
+        raise ValueError("Filterbank header does not begin with HEADER_START")
+    header = {}
+    while True:
+        key = read_str()
+        if key == 'HEADER_END':
+            return header, offset
+        if key not in HEADER_KEYS:
+            raise ValueError("Unknown filterbank header keyword %s" % key)
+        kind = HEADER_KEYS[key]
+        if kind == 'str':
+            header[key] = read_str()
+        else:
+            header[key], = struct.unpack_from(_FORMATS[kind], buf, offset)
+            offset += struct.calcsize(_FORMATS[kind])
+
+def read_header(filename, max_bytes=4096):
+    """
+    Read the header of a filterbank file.
+
+    :param filename: Filterbank file
+    :type filename: str
+    :param max_bytes: Maximum header length to read
+    :type max_bytes: int
+
+    :return: header, nbytes. A dictionary of header values, keyed by keyword,
+        and the length of the header in bytes.
+    :rtype: dict, int
+    """
+    with open(filename, 'rb') as fh:
+        return decode_header(fh.read(max_bytes))
+
+def sexagesimal_to_sigproc(s):
+    """
+    Convert a sexagesimal coordinate to SIGPROC's convention of
+    a floating point number with the form (-)ddmmss.s
+
+    :param s: Coordinate string, eg. '-12:34:56.7'
+    :type s: str
+
+    :return: Coordinate, eg. -123456.7
+    :rtype: float
+    """
+    sign = -1 if s.strip().startswith('-') else 1
+    d, m, sec = (abs(float(x)) for x in s.strip().lstrip('+-').split(':'))
+    return sign * (d * 10000 + m * 100 + sec)
+
+def spectrometer_header(source, ra, dec, acc_len, srate, rfc, ifc, tstart, n_chans=2048,
+                        nbits=32, nifs=1, rawdatafile=None):
+    """
+    Build a filterbank header for SNAP spectrometer data.
+
+    :param source: Source name. A leading 'psr' is removed, and the name is upper-cased.
+    :type source: str
+    :param ra: Source RA, as an 'hh:mm:ss.s' string
+    :type ra: str
+    :param dec: Source declination, as a 'dd:mm:ss.s' string
+    :type dec: str
+    :param acc_len: Accumulation length, in spectra
+    :type acc_len: int
+    :param srate: ADC sample rate, in MHz
+    :type srate: float
+    :param rfc: RF centre frequency, in MHz
+    :type rfc: float
+    :param ifc: IF centre frequency, in MHz
+    :type ifc: float
+    :param tstart: Unix time of the first spectrum
+    :type tstart: float
+    :param n_chans: Number of channels per spectrum
+    :type n_chans: int
+    :param nbits: Number of bits per sample
+    :type nbits: int
+    :param nifs: Number of IFs (eg. polarization products) per channel. The SNAP
+        receivers store the IFs of each channel together.
+    :type nifs: int
+    :param rawdatafile: If not None, the name of the file containing the data
+    :type rawdatafile: str
+
+    :return: Header dictionary, suitable for passing to `encode_header`
+    :rtype: dict
+    """
+    header = {
+        'telescope_id': TELESCOPE_ID_ATA,
+        'machine_id': 0,
+        'data_type': 1, # filterbank
+        'source_name': source.strip('psr').upper(),
+        'src_raj': sexagesimal_to_sigproc(ra),
+        'src_dej': sexagesimal_to_sigproc(dec),
+        'tstart': tstart / 86400. + MJD_UNIX_EPOCH,
+        'tsamp': acc_len * n_chans * 2 / (srate * 1e6),
+        'fch1': rfc - srate / 2. + ifc,
+        'foff': -srate / 2. / n_chans,
+        'nbits': nbits,
+        'nchans': n_chans,
+        'nifs': nifs,
+        'nsamples': 0, # Patched when the file is closed
+    }
+    if rawdatafile is not None:
+        header['rawdatafile'] = rawdatafile
+    return header
+
+def voltage_header(source, ra, dec, srate, rfc, ifc, tstart, chans, n_int=1, n_chans_f=4096,
+                   nbits=32, nifs=1):
+    """
+    Build a filterbank header for data derived from F-engine voltages,
+    such as detected beams, covering a range of F-engine channels.
+
+    :param source: Source name
+    :type source: str
+    :param ra: Source RA, as an 'hh:mm:ss.s' string
+    :type ra: str
+    :param dec: Source declination, as a 'dd:mm:ss.s' string
+    :type dec: str
+    :param srate: ADC sample rate, in MHz
+    :type srate: float
+    :param rfc: RF centre frequency, in MHz
+    :type rfc: float
+    :param ifc: IF centre frequency, in MHz
+    :type ifc: float
+    :param tstart: Unix time of the first sample
+    :type tstart: float
+    :param chans: F-engine channels in the data. These must be contiguous.
+    :type chans: list
+    :param n_int: Number of F-engine spectra per sample
+    :type n_int: int
+    :param n_chans_f: Number of channels generated by the F-engine
+    :type n_chans_f: int
+    :param nbits: Number of bits per sample
+    :type nbits: int
+    :param nifs: Number of IFs per channel
+    :type nifs: int
+
+    :return: Header dictionary, suitable for passing to `encode_header`
+    :rtype: dict
+    """
+    header = spectrometer_header(source, ra, dec, n_int, srate, rfc, ifc, tstart, n_chans=n_chans_f,
+                                 nbits=nbits, nifs=nifs)
+    header['fch1'] += header['foff'] * chans[0]
+    header['nchans'] = len(chans)
+    return header
+
+def channel_freqs(header):
+    """
+    Get the centre frequencies of the channels described by a filterbank header.
+
+    :param header: Header dictionary, with `fch1`, `foff` and `nchans` fields,
+        such as returned by `spectrometer_header`
+    :type header: dict
+
+    :return: Channel centre frequencies, in MHz
+    :rtype: numpy.ndarray
+    """
+    return header['fch1'] + header['foff'] * np.arange(header['nchans'])
+
+class FilterbankWriter(object):
+    """
+    Stream data into a filterbank file. The header is written when the file is
+    opened, and its numeric fields can be updated with `patch` at any time.
+    If the header has an `nsamples` field, it is set to the number of
+    samples written when the file is closed.
+
+    :param filename: File to write
+    :type filename: str
+    :param header: Dictionary of header values, as taken by `encode_header`
+    :type header: dict
+    """
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = dict(header)
+        encoded, self._offsets = encode_header(self.header)
+        self.header_bytes = len(encoded)
+        self.sample_bytes = self.header['nchans'] * self.header.get('nifs', 1) * self.header['nbits'] // 8
+        self.nbytes = 0
+        self.fh = open(filename, 'wb')
+        self.fh.write(encoded)
+
+    def write(self, data):
+        """
+        Append data to the file.
+
+        :param data: Data to write, as bytes or a numpy array
+        :type data: bytes or numpy.ndarray
+        """
+        buf = memoryview(data).cast('B')
+        self.fh.write(buf)
+        self.nbytes += len(buf)
+
+    def patch(self, **fields):
+        """
+        Update numeric header fields, which must have been present in the header
+        when the file was opened.
+
+        :param fields: New values, keyed by keyword
+        """
+        pos = self.fh.tell()
+        for key, value in fields.items():
+            if key not in self._offsets:
+                raise KeyError("Field %s is not a numeric field of this file's header" % key)
+            self.fh.seek(self._offsets[key])
+            self.fh.write(struct.pack(_FORMATS[HEADER_KEYS[key]], value))
+            self.header[key] = value
+        self.fh.seek(pos)
+
+    @property
+    def nsamples(self):
+        """
+        Number of complete samples written.
+        """
+        return self.nbytes // self.sample_bytes
+
+    def close(self):
+        """
+        Update the `nsamples` header field, if present, and close the file.
+        """
+        if self.fh.closed:
+            return
+        if 'nsamples' in self._offsets:
+            self.patch(nsamples=self.nsamples)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def attach_header(raw_filename, fil_filename, header, chunk_bytes=64*1024*1024):
+    """
+    Make a filterbank file from a header and an existing file of raw data,
+    without reading the raw data into memory. Where the OS supports it, the
+    data are copied within the kernel. Otherwise they are copied in chunks.
+
+    If the header has an `nsamples` field, it is set from the raw file size.
+
+    :param raw_filename: File of raw data
+    :type raw_filename: str
+    :param fil_filename: Filterbank file to write
+    :type fil_filename: str
+    :param header: Dictionary of header values, as taken by `encode_header`
+    :type header: dict
+    :param chunk_bytes: Number of bytes to copy at a time
+    :type chunk_bytes: int
+
+    :return: Number of data bytes copied
+    :rtype: int
+    """
+    with open(raw_filename, 'rb') as src, FilterbankWriter(fil_filename, header) as fil:
+        fil.fh.flush()
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src.fileno(), fil.fh.fileno(), min(chunk_bytes, size - copied))
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                # Eg. not supported between these filesystems. Fall back
+                # to copying the remainder in user space
+                pass
+        if copied < size:
+            src.seek(copied)
+            fil.fh.seek(fil.header_bytes + copied)
+            shutil.copyfileobj(src, fil.fh, chunk_bytes)
+            copied = size
+        fil.fh.seek(fil.header_bytes + copied)
+        fil.nbytes = copied
+    return copied
@@ -0,0 +1,167 @@
+"""
+Spectral kurtosis (SK) RFI detection on voltage streams.
+
+For each channel and polarization, the powers P = |x|^2 of M consecutive
+voltage samples are accumulated as S1 = sum(P) and S2 = sum(P^2), and the
+SK estimator
+
+    SK = (M + 1) / (M - 1) * (M * S2 / S1^2 - 1)
+
+is computed (Nita & Gary 2010, for unaveraged power spectra, N = d = 1).
+For Gaussian noise, SK has an expected value of 1, whatever the noise
+power, and a variance of 4 M^2 / ((M - 1) (M + 2) (M + 3)). Impulsive or
+intermittent RFI raises SK, and continuous-wave RFI lowers it. A channel
+is flagged when the SK of either polarization lies more than `n_sigma`
+standard deviations from 1. This symmetric Gaussian threshold approximates
+the exact thresholds well for large M. SK is skewed at small M, so the
+upper threshold is then too low, and gives somewhat more false alarms than
+the Gaussian tail probability suggests.
+
+Samples are accumulated across blocks, so M need not divide the block
+length, and samples which were not received are excluded, with the SK
+and its thresholds computed from the number of samples which were.
+
+Example usage:
+    sk = SpectralKurtosis(m=1024)
+    for block in assembler.get():
+        flags = sk.process(block.data, block.valid())
+        beams = beamformer.process(block.data, flags_to_valid(flags, block.valid()))
+"""
+
+import numpy as np
+
+from . import voltage
+
+def sk_estimate(s1, s2, m):
+    """
+    Compute the spectral kurtosis estimator.
+
+    :param s1: Sum of powers
+    :type s1: numpy.ndarray
+    :param s2: Sum of squared powers
+    :type s2: numpy.ndarray
+    :param m: Number of samples summed
+    :type m: numpy.ndarray
+
+    :return: SK. NaN where fewer than two samples, or no power, were summed.
+    :rtype: numpy.ndarray
+    """
+    m = np.asarray(m, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sk = (m + 1) / (m - 1) * (m * s2 / s1**2 - 1)
+    return np.where((m > 1) & (s1 > 0), sk, np.nan)
+
+def sk_std(m):
+    """
+    Get the standard deviation of the SK estimator for Gaussian noise.
+
+    :param m: Number of samples summed
+    :type m: numpy.ndarray
+
+    :return: Standard deviation of SK
+    :rtype: numpy.ndarray
+    """
+    m = np.asarray(m, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(4 * m**2 / ((m - 1) * (m + 2) * (m + 3)))
+
+def flags_to_valid(flags, valid=None, n_times=None):
+    """
+    Apply channel flags to a voltage validity mask, so that flagged channels
+    are excluded by stages such as `beamform.Beamformer` and `xengine.Correlator`.
+
+    :param flags: Channel flags, with dimensions [..., channel], as returned by
+        `SpectralKurtosis.process`
+    :type flags: numpy.ndarray
+    :param valid: Boolean mask, with dimensions [..., channel, time]. If None, all
+        data are taken to be valid, and `n_times` must be given.
+    :type valid: numpy.ndarray
+    :param n_times: Number of time samples in the block, if `valid` is None
+    :type n_times: int
+
+    :return: Boolean mask, with dimensions [..., channel, time], which is True where
+        data were received and not flagged
+    :rtype: numpy.ndarray
+    """
+    if valid is None:
+        return np.repeat(~flags[..., None], n_times, axis=-1)
+    return valid & ~flags[..., None]
+
+class SpectralKurtosis(object):
+    """
+    Compute the spectral kurtosis of a stream of voltage blocks, and flag
+    channels containing RFI.
+
+    :param m: Number of samples per SK estimate
+    :type m: int
+    :param n_sigma: Threshold, in standard deviations of SK from 1, beyond which
+        a channel is flagged
+    :type n_sigma: float
+
+    :ivar sk: SK of the windows completed by the last block, with dimensions
+        [..., window, channel, polarization]
+    :ivar flags: Channel flags of the last block, with dimensions [..., channel]
+    :ivar n_windows: Number of SK windows computed, for each channel
+    :ivar n_flagged: Number of channel-windows flagged
+    """
+    def __init__(self, m=1024, n_sigma=3.0):
+        self.m = m
+        self.n_sigma = n_sigma
+        self.sk = None
+        self.flags = None
+        self.n_windows = 0
+        self.n_flagged = 0
+        # Powers and validity of samples which do not yet fill a window
+        self._power = None
+        self._valid = None
+
+    def process(self, data, valid=None):
+        """
+        Accumulate a block of voltages, and flag channels.
+
+        :param data: Voltages, with dimensions [..., channel, time, polarization] of
+            complex64, or [..., channel, time, polarization, real/imag] of int8, eg.
+            [antenna, channel, time, polarization]
+        :type data: numpy.ndarray
+        :param valid: Boolean mask, with dimensions [..., channel, time], which is True
+            where data were received. If None, all data are valid.
+        :type valid: numpy.ndarray
+
+        :return: Channel flags, with dimensions [..., channel], which are True for channels
+            in which any SK window completed by this block was flagged. If no window was
+            completed, the flags of the previous block are returned.
+        :rtype: numpy.ndarray
+        """
+        x = voltage.to_complex(data)
+        power = (x.real**2 + x.imag**2).astype(np.float32)
+        if valid is None:
+            valid = np.ones(power.shape[:-1], dtype=bool)
+        if self._power is not None:
+            power = np.concatenate([self._power, power], axis=-2)
+            valid = np.concatenate([self._valid, valid], axis=-1)
+        n_times = power.shape[-2]
+        n_win = n_times // self.m
+        n_used = n_win * self.m
+        self._power = power[..., n_used:, :].copy()
+        self._valid = valid[..., n_used:].copy()
+        lead = power.shape[:-2]
+        if self.flags is None:
+            self.flags = np.zeros(lead, dtype=bool)
+        if n_win == 0:
+            return self.flags
+        # Dimensions [..., channel, window, sample, polarization]
+        p = power[..., 0:n_used, :].reshape(lead + (n_win, self.m, power.shape[-1]))
+        v = valid[..., 0:n_used].reshape(lead + (n_win, self.m, 1))
+        p = np.where(v, p, 0).astype(np.float64)
+        s1 = p.sum(axis=-2)
+        s2 = (p * p).sum(axis=-2)
+        m = v.sum(axis=-2)
+        sk = sk_estimate(s1, s2, m)
+        with np.errstate(invalid='ignore'):
+            flagged = np.abs(sk - 1) > self.n_sigma * sk_std(m)
+        # Dimensions [..., window, channel, polarization]
+        self.sk = np.moveaxis(sk, -2, -3)
+        self.flags = flagged.any(axis=(-2, -1))
+        self.n_windows += n_win
+        self.n_flagged += int(np.count_nonzero(flagged.any(axis=-1)))
+        return self.flags
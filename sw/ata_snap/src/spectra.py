@@ -0,0 +1,482 @@
+"""
+Reception and recording of SNAP spectrometer packets.
+
+Each spectrum is sent as `N_PACKETS_PER_SPECTRUM` packets. Each packet
+comprises an 8-byte big-endian header, holding a packet counter
+(spectrum index * N_PACKETS_PER_SPECTRUM + sub-spectrum index),
+followed by `N_PRODUCTS` big-endian 32-bit integers per channel:
+XX, YY, real(XY*), imag(XY*).
+
+Recorded spectra hold a selection of products computed from these, given
+by one of PRODUCT_MODES, with the products of each channel stored together
+(ie. with dimensions [spectrum, channel, product]).
+
+Packets are decoded a batch at a time with structured dtypes, and spectra
+are assembled in blocks which are written to disk with single large writes.
+"""
+
+import time
+import logging
+import numpy as np
+
+N_CHANS = 2048 # Channels per spectrum
+N_PACKETS_PER_SPECTRUM = 4 # Packets per spectrum
+N_PRODUCTS = 4 # XX, YY, real(XY*), imag(XY*)
+HEADER_BYTES = 8
+
+#: Products which can be recorded. Each mode is a tuple of (name, weights) pairs,
+#: where a product is the weighted sum of XX, YY, real(XY*) and imag(XY*).
+PRODUCT_MODES = {
+    'I': (
+        ('I', (1, 1, 0, 0)),
+    ),
+    'XXYY': (
+        ('XX', (1, 0, 0, 0)),
+        ('YY', (0, 1, 0, 0)),
+    ),
+    'IQUV': (
+        ('I', (1, 1, 0, 0)),
+        ('Q', (1, -1, 0, 0)),
+        ('U', (0, 0, 2, 0)),
+        ('V', (0, 0, 0, 2)),
+    ),
+    'raw': (
+        ('XX', (1, 0, 0, 0)),
+        ('YY', (0, 1, 0, 0)),
+        ('XYr', (0, 0, 1, 0)),
+        ('XYi', (0, 0, 0, 1)),
+    ),
+}
+
+#: Data types in which products can be recorded
+PRODUCT_DTYPES = (np.float32, np.float16)
+
+def packet_dtype(n_chans=N_CHANS, n_packets_per_spectrum=N_PACKETS_PER_SPECTRUM):
+    """
+    Get the structured dtype of a spectrometer packet.
+
+    :param n_chans: Number of channels per spectrum
+    :type n_chans: int
+    :param n_packets_per_spectrum: Number of packets per spectrum
+    :type n_packets_per_spectrum: int
+
+    :return: dtype with fields `header` (packet counter) and `data`
+        (array of shape [channels per packet, N_PRODUCTS])
+    :rtype: numpy.dtype
+    """
+    assert n_chans % n_packets_per_spectrum == 0
+    return np.dtype([
+        ('header', '>u8'),
+        ('data', '>i4', (n_chans // n_packets_per_spectrum, N_PRODUCTS)),
+    ])
+
+PACKET_DTYPE = packet_dtype()
+PACKET_BYTES = PACKET_DTYPE.itemsize
+
+def packet_rate(acc_len, srate, n_chans=N_CHANS, n_packets_per_spectrum=N_PACKETS_PER_SPECTRUM):
+    """
+    Compute the rate at which a spectrometer sends packets.
+
+    :param acc_len: Accumulation length, in spectra
+    :type acc_len: int
+    :param srate: ADC sample rate, in MHz
+    :type srate: float
+    :param n_chans: Number of channels per spectrum
+    :type n_chans: int
+    :param n_packets_per_spectrum: Number of packets per spectrum
+    :type n_packets_per_spectrum: int
+
+    :return: Packets per second
+    :rtype: float
+    """
+    return srate * 1e6 / (2 * n_chans * acc_len) * n_packets_per_spectrum
+
+def decode_packets(buf, nbytes=None, dtype=PACKET_DTYPE):
+    """
+    Decode a batch of spectrometer packets.
+
+    :param buf: Packets, as a 2D array of shape [n_packets, >= packet bytes] of uint8,
+        such as a batch of slots in a `rx.PacketRing`.
+    :type buf: numpy.ndarray
+    :param nbytes: If not None, the received size of each packet. Packets whose size
+        does not match `dtype` are discarded.
+    :type nbytes: numpy.ndarray
+    :param dtype: Packet dtype, as returned by `packet_dtype`
+    :type dtype: numpy.dtype
+
+    :return: headers, data. headers is an array of packet counters.
+        data is an array of shape [n_packets, channels per packet, N_PRODUCTS]
+        of big-endian 32-bit integers.
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    if nbytes is not None:
+        buf = buf[nbytes == dtype.itemsize]
+    pkts = np.ascontiguousarray(buf[:, 0:dtype.itemsize]).view(dtype)[:, 0]
+    return pkts['header'], pkts['data']
+
+def product_names(products):
+    """
+    Get the names of the products recorded in a given mode.
+
+    :param products: Product mode. One of PRODUCT_MODES
+    :type products: str
+
+    :return: Product names, eg. ('I', 'Q', 'U', 'V')
+    :rtype: tuple
+    """
+    return tuple(name for name, weights in PRODUCT_MODES[products])
+
+def compute_products(data, products='I', scale=1.0):
+    """
+    Compute output products from a batch of packet payloads.
+
+    :param data: Packet payloads, as returned by `decode_packets`, with
+        N_PRODUCTS values in the last axis.
+    :type data: numpy.ndarray
+    :param products: Product mode. One of PRODUCT_MODES
+    :type products: str
+    :param scale: Factor by which to multiply the products, eg. to keep them
+        within the range of float16 values.
+    :type scale: float
+
+    :return: Array of float32 products, with the last axis of `data` replaced by
+        an axis of length len(PRODUCT_MODES[products])
+    :rtype: numpy.ndarray
+    """
+    weights = np.array([w for name, w in PRODUCT_MODES[products]], dtype=np.float32) * scale
+    return np.matmul(data.astype(np.float32), weights.T)
+
+def total_power(data, products='I'):
+    """
+    Get the total power (XX + YY) of recorded spectra.
+
+    :param data: Spectra, with dimensions [..., channel, product]
+    :type data: numpy.ndarray
+    :param products: Product mode in which the spectra were recorded. One of PRODUCT_MODES
+    :type products: str
+
+    :return: Total power, with dimensions [..., channel]. A view of `data`, where possible.
+    :rtype: numpy.ndarray
+    """
+    names = product_names(products)
+    if 'I' in names:
+        return data[..., names.index('I')]
+    return data[..., names.index('XX')] + data[..., names.index('YY')]
+
+#: Ways in which data from missing packets can be filled in
+FILL_POLICIES = ('zero', 'nan', 'repeat')
+
+def mask_filename(filename):
+    """
+    Get the name of the packet mask file which accompanies a data file.
+
+    :param filename: Data file name
+    :type filename: str
+
+    :return: Mask file name
+    :rtype: str
+    """
+    return filename + '.mask'
+
+def unpack_mask(mask, n_chans=N_CHANS, n_packets_per_spectrum=N_PACKETS_PER_SPECTRUM):
+    """
+    Expand a packet mask, as written by `SpectraRecorder`, into per-channel flags.
+
+    :param mask: Packet mask, with one byte per spectrum
+    :type mask: numpy.ndarray
+    :param n_chans: Number of channels per spectrum
+    :type n_chans: int
+    :param n_packets_per_spectrum: Number of packets per spectrum
+    :type n_packets_per_spectrum: int
+
+    :return: Boolean array of dimensions [spectrum, channel], which is True where
+        the data were received
+    :rtype: numpy.ndarray
+    """
+    received = np.unpackbits(np.asarray(mask, dtype=np.uint8)[:, None], axis=1,
+                             count=n_packets_per_spectrum, bitorder='little').astype(bool)
+    return np.repeat(received, n_chans // n_packets_per_spectrum, axis=1)
+
+class SpectraRecorder(object):
+    """
+    Assemble spectrometer packets into spectra of the products given by
+    `products` (by default, total power, XX + YY), and write them to a file
+    as values of type `out_dtype`, in blocks of `block_spectra` spectra. Each
+    spectrum has dimensions [channel, product].
+
+    Packets are placed into a window of `window_blocks` blocks according to
+    their headers, so packets may arrive out of order, provided they arrive
+    before their block leaves the window. The oldest block is written out when
+    a packet arrives which is beyond the end of the window. Packets which never
+    arrive are filled according to `fill`, and the output always has one
+    spectrum per spectrum period. Recording starts with the first packet
+    which begins a spectrum.
+
+    If `mask_fh` is provided, a mask of received packets is written to it, with
+    one byte per spectrum, in which bit `i` is set if the spectrum's
+    `i` th packet was received. A spectrum is valid if all its bits are set.
+
+    :param fh: File object to write to
+    :type fh: file
+    :param n_chans: Number of channels per spectrum
+    :type n_chans: int
+    :param n_packets_per_spectrum: Number of packets per spectrum (at most 8)
+    :type n_packets_per_spectrum: int
+    :param block_spectra: Number of spectra written per write.
+    :type block_spectra: int
+    :param window_blocks: Number of blocks in the reordering window
+    :type window_blocks: int
+    :param fill: How to fill in data from missing packets. One of FILL_POLICIES:
+        'zero' writes zeros, 'nan' writes NaNs, and 'repeat' repeats the same
+        channels of the most recent spectrum in which they were received.
+    :type fill: str
+    :param mask_fh: File object to which the packet mask should be written
+    :type mask_fh: file
+    :param products: Products to record. One of PRODUCT_MODES
+    :type products: str
+    :param out_dtype: Data type of the recorded products. One of PRODUCT_DTYPES
+    :type out_dtype: numpy.dtype
+    :param scale: Factor by which to multiply the products. With float16
+        output, values beyond about 65504 are recorded as infinite, so spectrometer
+        outputs should usually be scaled down.
+    :type scale: float
+
+    :ivar dtype: Packet dtype expected by `process`
+    :ivar n_packets: Number of packets recorded
+    :ivar n_missing: Number of packets which were missing from written spectra
+    :ivar n_late: Number of packets discarded because their spectra had already been written
+    :ivar n_spectra: Number of spectra written
+    :ivar n_invalid: Number of spectra written with missing packets
+    :ivar start_spectrum: Index (packet counter / n_packets_per_spectrum) of the first
+        spectrum written, or None if recording has not started. Spectrum `i` of the output
+        has index `start_spectrum + i`.
+    """
+    def __init__(self, fh, n_chans=N_CHANS, n_packets_per_spectrum=N_PACKETS_PER_SPECTRUM, block_spectra=64,
+                 window_blocks=2, fill='zero', mask_fh=None, products='I', out_dtype=np.float32, scale=1.0):
+        if fill not in FILL_POLICIES:
+            raise ValueError("Fill policy must be one of %s" % (FILL_POLICIES,))
+        if products not in PRODUCT_MODES:
+            raise ValueError("Products must be one of %s" % (tuple(PRODUCT_MODES),))
+        if np.dtype(out_dtype) not in PRODUCT_DTYPES:
+            raise ValueError("Data type must be one of %s" % (PRODUCT_DTYPES,))
+        assert n_packets_per_spectrum <= 8, "Packet mask only supports up to 8 packets per spectrum"
+        self.fh = fh
+        self.mask_fh = mask_fh
+        self.fill = fill
+        self.n_chans = n_chans
+        self.n_packets_per_spectrum = n_packets_per_spectrum
+        self.block_spectra = block_spectra
+        self.block_packets = block_spectra * n_packets_per_spectrum
+        self.window_blocks = window_blocks
+        self.window_packets = window_blocks * self.block_packets
+        self.dtype = packet_dtype(n_chans, n_packets_per_spectrum)
+        self.products = products
+        self.n_products = len(PRODUCT_MODES[products])
+        self.scale = scale
+        self.out_dtype = np.dtype(out_dtype)
+        chans_per_packet = n_chans // n_packets_per_spectrum
+        self.blocks = np.zeros([window_blocks, block_spectra, n_chans, self.n_products], dtype=out_dtype)
+        # View of the window with one row per packet
+        self._rows = self.blocks.reshape(self.window_packets, chans_per_packet * self.n_products)
+        self._received = np.zeros(self.window_packets, dtype=bool)
+        # Most recently received data for each packet of a spectrum, for 'repeat' filling
+        self._last = np.zeros([n_packets_per_spectrum, chans_per_packet * self.n_products], dtype=out_dtype)
+        self._have_last = np.zeros(n_packets_per_spectrum, dtype=bool)
+        self.head = 0 # Window index of the oldest block
+        self.base = None # Packet counter of the first packet in the oldest block
+        self.start_spectrum = None
+        self.n_packets = 0
+        self.n_missing = 0
+        self.n_late = 0
+        self.n_spectra = 0
+        self.n_invalid = 0
+        self.logger = logging.getLogger('SpectraRecorder')
+
+    def process(self, headers, data):
+        """
+        Place a batch of packets into the window, writing out
+        blocks as they leave it.
+
+        :param headers: Packet counters, as returned by `decode_packets`
+        :type headers: numpy.ndarray
+        :param data: Packet payloads, as returned by `decode_packets`
+        :type data: numpy.ndarray
+        """
+        pos = headers.astype(np.int64)
+        if self.base is None:
+            starts = np.flatnonzero(pos % self.n_packets_per_spectrum == 0)
+            if len(starts) == 0:
+                return
+            self.base = int(pos[starts[0]])
+            self.start_spectrum = self.base // self.n_packets_per_spectrum
+            self.logger.info("Starting recording at packet %d" % self.base)
+        pos = pos - self.base
+        keep = pos >= 0
+        self.n_late += np.count_nonzero(~keep)
+        pos = pos[keep]
+        if self.products == 'I':
+            power = data[keep, :, 0].astype(np.float32)
+            power += data[keep, :, 1]
+            if self.scale != 1:
+                power *= self.scale
+        else:
+            power = compute_products(data[keep], self.products, self.scale)
+        power = power.reshape(len(pos), -1)
+        self.n_packets += len(pos)
+        while len(pos) > 0:
+            in_window = pos < self.window_packets
+            rows = (pos[in_window] + self.head * self.block_packets) % self.window_packets
+            self._rows[rows] = power[in_window]
+            self._received[rows] = True
+            if np.all(in_window):
+                break
+            self._write_block(self.block_spectra)
+            pos = pos[~in_window] - self.block_packets
+            power = power[~in_window]
+
+    def _fill_missing(self, block, received):
+        """
+        Fill in the data of missing packets in a block, according to the fill policy.
+
+        :param block: Block, with axes [spectrum, packet, channel * product]
+        :param received: Packet received flags, with axes [spectrum, packet]
+        """
+        if self.fill == 'nan':
+            block[~received] = np.nan
+        elif self.fill == 'repeat':
+            # Index of the most recent spectrum (in this block) in which each packet was received
+            last = np.where(received, np.arange(len(received))[:, None], -1)
+            np.maximum.accumulate(last, axis=0, out=last)
+            s, p = np.nonzero(~received & (last >= 0))
+            block[s, p] = block[last[s, p], p]
+            # Packets not received earlier in this block come from earlier blocks
+            s, p = np.nonzero(last < 0)
+            block[s, p] = np.where(self._have_last[p, None], self._last[p], 0)
+            received_any = last[-1] >= 0
+            self._last[received_any] = block[-1, received_any]
+            self._have_last |= received_any
+
+    def _write_block(self, n_spectra):
+        """
+        Write the first `n_spectra` spectra of the oldest block in the window
+        to disk, and move the window on by one block.
+        """
+        n_packets = n_spectra * self.n_packets_per_spectrum
+        rows = slice(self.head * self.block_packets, self.head * self.block_packets + n_packets)
+        received = self._received[rows].reshape(n_spectra, self.n_packets_per_spectrum)
+        block = self.blocks[self.head, 0:n_spectra]
+        self._fill_missing(block.reshape(received.shape + (-1,)), received)
+        if self.mask_fh is not None:
+            self.mask_fh.write(memoryview(np.packbits(received, axis=1, bitorder='little')[:, 0]))
+        self.fh.write(memoryview(block))
+        self.n_missing += received.size - np.count_nonzero(received)
+        self.n_invalid += n_spectra - np.count_nonzero(received.all(axis=1))
+        self.n_spectra += n_spectra
+        self.blocks[self.head] = 0
+        self._received[self.head * self.block_packets:(self.head + 1) * self.block_packets] = False
+        self.head = (self.head + 1) % self.window_blocks
+        self.base += self.block_packets
+
+    def finish(self):
+        """
+        Write any spectra in the window up to the last which has received at least one packet.
+        If the last spectrum is incomplete it is filled according to the fill policy.
+
+        :return: Number of packets in the final spectrum which were filled
+        :rtype: int
+        """
+        if self.base is None or not np.any(self._received):
+            return 0
+        # Received flags in window order, oldest first
+        received = np.roll(self._received, -self.head * self.block_packets)
+        last_packet = int(np.flatnonzero(received)[-1])
+        n_spectra = last_packet // self.n_packets_per_spectrum + 1
+        n_padded = n_spectra * self.n_packets_per_spectrum - last_packet - 1
+        while n_spectra > 0:
+            n = min(n_spectra, self.block_spectra)
+            self._write_block(n)
+            n_spectra -= n
+        self.n_missing -= n_padded
+        return n_padded
+
+def record(receiver, ring, recorder, duration, batch_packets=256, status_interval=None):
+    """
+    Receive spectrometer packets and record them until `duration` seconds have passed.
+
+    :param receiver: Socket from which to receive packets
+    :type receiver: rx.UdpReceiver
+    :param ring: Ring into which packets are received. Its slots should be at least
+        one packet long.
+    :type ring: rx.PacketRing
+    :param recorder: Recorder to which decoded packets are passed.
+    :type recorder: SpectraRecorder
+    :param duration: Number of seconds to record for
+    :type duration: float
+    :param batch_packets: Maximum number of packets to receive and decode at once
+    :type batch_packets: int
+    :param status_interval: If not None, log progress every `status_interval` seconds.
+    :type status_interval: float
+    """
+    logger = logging.getLogger('SpectraRecorder')
+    start = time.monotonic()
+    stop = start + duration
+    next_status = start + (status_interval or duration)
+    last_spectra = 0
+    last_status = start
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= stop:
+                break
+            if status_interval is not None and now >= next_status:
+                logger.info("Recorded %d spectra (%d in the last %.1f seconds). %d packets missing" % (
+                            recorder.n_spectra, recorder.n_spectra - last_spectra, now - last_status,
+                            recorder.n_missing))
+                last_spectra = recorder.n_spectra
+                last_status = now
+                next_status = now + status_interval
+            s, n = receiver.recv_batch(ring, batch_packets)
+            if n == 0:
+                continue
+            headers, data = decode_packets(ring.buf[s:s+n], ring.nbytes[s:s+n], recorder.dtype)
+            recorder.process(headers, data)
+    except KeyboardInterrupt:
+        pass
+
+class SpectraFileWriter(object):
+    """
+    Record the packets of a single spectrometer to a file, eg. as one of the
+    per-board streams of a `demux.MultiReceiver`.
+
+    :param filename: File to write to
+    :type filename: str
+    :param write_mask: If True, write a mask of received packets to the file
+        given by `mask_filename`.
+    :type write_mask: bool
+    :param kwargs: Other keyword arguments are passed to `SpectraRecorder`
+    """
+    def __init__(self, filename, write_mask=True, **kwargs):
+        self.fh = open(filename, 'wb')
+        self.mask_fh = open(mask_filename(filename), 'wb') if write_mask else None
+        self.recorder = SpectraRecorder(self.fh, mask_fh=self.mask_fh, **kwargs)
+
+    def process(self, buf, nbytes):
+        """
+        Record a batch of packets.
+
+        :param buf: Packets, as a 2D array of uint8
+        :type buf: numpy.ndarray
+        :param nbytes: The received size of each packet
+        :type nbytes: numpy.ndarray
+        """
+        headers, data = decode_packets(buf, nbytes, self.recorder.dtype)
+        self.recorder.process(headers, data)
+
+    def close(self):
+        """
+        Write any remaining spectra, and close the file.
+        """
+        self.recorder.finish()
+        self.fh.close()
+        if self.mask_fh is not None:
+            self.mask_fh.close()
@@ -0,0 +1,216 @@
+"""
+Fine channelization ("upchannelization") of F-engine voltages.
+
+Each selected coarse channel's voltage time series is split into frames of
+`n_fft` samples, which are Fourier transformed to give `n_fft` fine
+channels. Frames may be windowed, or passed through a polyphase filter bank
+front end of `n_taps` taps, which sharpens the fine channels' response. The
+fine channels' power is summed over polarizations (optionally) and over
+`n_int` consecutive spectra.
+
+Blocks are processed as they arrive. The samples at the end of each block
+which are still needed -- the last (n_taps - 1) frames, and any samples
+which do not make a whole frame -- are saved and prepended to the next
+block, so the output is the same as if the whole stream were processed at
+once, and blocks need not be multiples of `n_fft` long.
+
+Fine channels are output in frequency order within each coarse channel,
+in the same sense as the coarse channels, so the fine channels of
+consecutive coarse channels form a continuous band (see `upchannelized_header`).
+
+Example usage:
+    up = Upchannelizer(1024, n_taps=4, n_int=16)
+    for block in assembler.get():
+        power = up.process(block.data[0], block.valid()[0])
+        assembler.free(block)
+"""
+
+import numpy as np
+
+from . import voltage
+from . import sigproc
+
+#: Windows which can be applied to each frame, or to the PFB filter
+WINDOWS = {
+    None: np.ones,
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+}
+
+def pfb_coeffs(n_fft, n_taps=1, window='hann'):
+    """
+    Compute polyphase filter bank coefficients.
+
+    :param n_fft: FFT length
+    :type n_fft: int
+    :param n_taps: Number of taps. If 1, the coefficients are simply the window.
+    :type n_taps: int
+    :param window: Window name. One of WINDOWS.
+    :type window: str
+
+    :return: Coefficients, with dimensions [tap, n_fft]
+    :rtype: numpy.ndarray
+    """
+    if window not in WINDOWS:
+        raise ValueError("Window must be one of %s" % (list(WINDOWS),))
+    n = n_taps * n_fft
+    coeffs = WINDOWS[window](n)
+    if n_taps > 1:
+        coeffs = coeffs * np.sinc((np.arange(n) - n / 2. + 0.5) / n_fft)
+    return coeffs.reshape(n_taps, n_fft).astype(np.float32)
+
+def upchannelized_header(header, n_fft, n_int=1):
+    """
+    Get the filterbank header of upchannelized data.
+
+    :param header: Filterbank header of the coarse channels, such as returned by
+        `sigproc.voltage_header` with n_int=1
+    :type header: dict
+    :param n_fft: FFT length
+    :type n_fft: int
+    :param n_int: Number of fine spectra summed into each output spectrum
+    :type n_int: int
+
+    :return: Header dictionary
+    :rtype: dict
+    """
+    header = dict(header)
+    # Fine channel k of a coarse channel is offset from its centre by (k - n_fft / 2) fine channels
+    header['fch1'] = header['fch1'] - header['foff'] / 2.
+    header['foff'] = header['foff'] / n_fft
+    header['nchans'] = header['nchans'] * n_fft
+    header['tsamp'] = header['tsamp'] * n_fft * n_int
+    return header
+
+class Upchannelizer(object):
+    """
+    Fine-channelize a stream of voltage blocks.
+
+    :param n_fft: FFT length, ie. the number of fine channels per coarse channel
+    :type n_fft: int
+    :param n_taps: Number of PFB taps. If 1, each frame is windowed and transformed.
+    :type n_taps: int
+    :param window: Window applied to each frame, or to the PFB filter. One of WINDOWS.
+    :type window: str
+    :param n_int: Number of fine spectra summed into each output spectrum
+    :type n_int: int
+    :param chans: If not None, indices of the coarse channels of each block to process
+    :type chans: list
+    :param sum_pols: If True, sum the power of the two polarizations. Otherwise, output
+        each polarization's power separately.
+    :type sum_pols: bool
+
+    :ivar n_frames: Number of fine spectra computed
+    :ivar n_out: Number of output spectra produced
+    """
+    def __init__(self, n_fft, n_taps=1, window='hann', n_int=1, chans=None, sum_pols=True):
+        self.n_fft = n_fft
+        self.n_taps = n_taps
+        self.coeffs = pfb_coeffs(n_fft, n_taps, window)
+        self.n_int = n_int
+        self.chans = chans
+        self.sum_pols = sum_pols
+        self._history = None
+        self._pending = None
+        self.n_frames = 0
+        self.n_out = 0
+
+    def process(self, data, valid=None):
+        """
+        Upchannelize a block of voltages.
+
+        :param data: Voltages, with dimensions [..., channel, time, polarization] of
+            complex64, or [..., channel, time, polarization, real/imag] of int8, eg.
+            [antenna, channel, time, polarization]
+        :type data: numpy.ndarray
+        :param valid: Boolean mask, with dimensions [..., channel, time], which is True
+            where data were received. Data which were not received are zeroed.
+            If None, all data are valid.
+        :type valid: numpy.ndarray
+
+        :return: Power, with dimensions [..., spectrum, channel x fine channel], with
+            a final polarization dimension if polarizations are not summed. Samples which
+            do not complete an output spectrum are held until the next call.
+        :rtype: numpy.ndarray
+        """
+        x = voltage.to_complex(data)
+        if self.chans is not None:
+            x = x[..., self.chans, :, :]
+            if valid is not None:
+                valid = valid[..., self.chans, :]
+        x = x.astype(np.complex64, copy=valid is not None)
+        if valid is not None:
+            x *= valid[..., None]
+        if self._history is not None:
+            x = np.concatenate([self._history, x], axis=-2)
+        n_fft = self.n_fft
+        n_frames = max(0, x.shape[-2] // n_fft - (self.n_taps - 1))
+        self._history = x[..., n_frames * n_fft:, :].copy()
+        lead = x.shape[:-3]
+        n_chans = x.shape[-3]
+        # Dimensions [..., channel, frame, sample, polarization]
+        frames = np.zeros(lead + (n_chans, n_frames, n_fft, x.shape[-1]), dtype=np.complex64)
+        if n_frames > 0:
+            segs = x[..., 0:(n_frames + self.n_taps - 1) * n_fft, :].reshape(
+                lead + (n_chans, n_frames + self.n_taps - 1, n_fft, x.shape[-1]))
+            for k in range(self.n_taps):
+                frames += segs[..., k:k + n_frames, :, :] * self.coeffs[k][:, None]
+        spec = np.fft.fftshift(np.fft.fft(frames, axis=-2), axes=-2)
+        power = spec.real**2 + spec.imag**2
+        if self.sum_pols:
+            power = power.sum(axis=-1)
+            # Dimensions [..., frame, channel, fine channel]
+            power = np.moveaxis(power, -2, -3)
+        else:
+            power = np.moveaxis(power, -3, -4)
+        self.n_frames += n_frames
+        # Sum spectra in groups of n_int, carrying the remainder to the next block
+        if self._pending is not None:
+            power = np.concatenate([self._pending, power], axis=len(lead))
+        n_out = power.shape[len(lead)] // self.n_int
+        self._pending = np.take(power, range(n_out * self.n_int, power.shape[len(lead)]), axis=len(lead))
+        power = np.take(power, range(0, n_out * self.n_int), axis=len(lead))
+        power = power.reshape(lead + (n_out, self.n_int) + power.shape[len(lead) + 1:]).sum(axis=len(lead) + 1)
+        self.n_out += n_out
+        out_shape = lead + (n_out, n_chans * n_fft) + (() if self.sum_pols else (x.shape[-1],))
+        return power.reshape(out_shape).astype(np.float32, copy=False)
+
+class UpchannelizedWriter(object):
+    """
+    Upchannelize voltage blocks, and write the power, summed over antennas
+    and polarizations, to a SIGPROC filterbank file.
+
+    :param filename: File to write
+    :type filename: str
+    :param header: Filterbank header of the coarse channels processed, such as returned
+        by `sigproc.voltage_header` with n_int=1
+    :type header: dict
+    :param n_fft: FFT length
+    :type n_fft: int
+    :param kwargs: Other keyword arguments are passed to `Upchannelizer`
+    """
+    def __init__(self, filename, header, n_fft, **kwargs):
+        self.upchannelizer = Upchannelizer(n_fft, sum_pols=True, **kwargs)
+        header = upchannelized_header(header, n_fft, self.upchannelizer.n_int)
+        self.writer = sigproc.FilterbankWriter(filename, dict(header, nbits=32, nifs=1))
+
+    def process(self, data, valid=None, timestamp=None):
+        """
+        Upchannelize a block of voltages, and append the spectra to the file.
+
+        :param data: Voltages, with dimensions [antenna, channel, time, polarization]
+        :type data: numpy.ndarray
+        :param valid: Boolean mask, with dimensions [antenna, channel, time]
+        :type valid: numpy.ndarray
+        :param timestamp: Timestamp of the block. Unused, since blocks are contiguous.
+        :type timestamp: int
+        """
+        power = self.upchannelizer.process(data, valid)
+        self.writer.write(np.ascontiguousarray(power.sum(axis=0)))
+
+    def close(self):
+        """
+        Close the file.
+        """
+        self.writer.close()
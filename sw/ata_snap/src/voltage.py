@@ -0,0 +1,302 @@
+"""
+Decoding of SNAP voltage packets.
+
+Each packet comprises a 16-byte network-endian header, followed by
+a payload of 4+4 bit complex samples with dimensions
+[channel x time x polarization]. See the firmware manual for details.
+
+Each payload byte holds one complex sample, with the real part in the
+four most significant bits and the imaginary part in the four least
+significant bits, each a two's complement integer in the range -8..7.
+Payloads are decoded a batch of packets at a time by indexing a 256-entry
+lookup table with the payload bytes, so that a batch is decoded by vectorized
+gathers rather than by shifting and masking each nibble. NumPy converts
+indices to intp before gathering, so batches are decoded a few packets at a
+time through a small, reused index buffer which stays in cache.
+
+Example usage:
+    decoder = VoltageDecoder(n_chans_per_packet=256)
+    headers, data = decoder.decode(ring.buf[0:n])
+"""
+
+import numpy as np
+
+N_TIMES_PER_PACKET = 16 # Time samples per packet
+N_POLS = 2 # Polarizations per packet
+HEADER_BYTES = 16
+MAX_PAYLOAD_BYTES = 8192
+MAX_PACKET_BYTES = HEADER_BYTES + MAX_PAYLOAD_BYTES
+N_CHANS_F = 4096 # Channels produced by the F-engine
+
+#: Voltage packet header
+HEADER_DTYPE = np.dtype([
+    ('version', 'u1'),
+    ('type', 'u1'),
+    ('n_chans', '>u2'),
+    ('chan', '>u2'),
+    ('feng_id', '>u2'),
+    ('timestamp', '>u8'),
+])
+
+def _nibble(x):
+    """
+    Interpret 4-bit values as two's complement integers.
+    """
+    return np.where(x > 7, x - 16, x)
+
+_BYTES = np.arange(256)
+
+#: Complex value of each payload byte
+LUT_COMPLEX = (_nibble(_BYTES >> 4) + 1j * _nibble(_BYTES & 0xf)).astype(np.complex64)
+
+#: Real and imaginary parts of each payload byte, with dimensions [byte, 2]
+LUT_INT8 = np.stack([_nibble(_BYTES >> 4), _nibble(_BYTES & 0xf)], axis=1).astype(np.int8)
+
+#: Payload bytes, unchanged, for keeping samples packed at 4 bits
+LUT_PACKED = _BYTES.astype(np.uint8)
+
+#: Output formats of decoded samples, and the lookup table used for each
+OUTPUT_FORMATS = {
+    'complex64': LUT_COMPLEX,
+    'int8': LUT_INT8,
+    'packed': LUT_PACKED,
+}
+
+DECODE_CHUNK_PACKETS = 16 # Packets decoded per gather
+
+def decode_headers(buf):
+    """
+    Decode the headers of a batch of voltage packets.
+
+    :param buf: Packets, as a 2D array of shape [n_packets, >= HEADER_BYTES] of uint8,
+        such as a batch of slots in a `rx.PacketRing`.
+    :type buf: numpy.ndarray
+
+    :return: Structured array of headers, with fields as in HEADER_DTYPE
+    :rtype: numpy.ndarray
+    """
+    return np.ascontiguousarray(buf[:, 0:HEADER_BYTES]).view(HEADER_DTYPE)[:, 0]
+
+def packet_rate(n_chans, srate, n_chans_per_packet, n_chans_f=N_CHANS_F):
+    """
+    Compute the rate at which an F-engine sends voltage packets.
+
+    :param n_chans: Number of channels sent, eg. to a single destination
+    :type n_chans: int
+    :param srate: ADC sample rate, in MHz
+    :type srate: float
+    :param n_chans_per_packet: Number of channels in each packet
+    :type n_chans_per_packet: int
+    :param n_chans_f: Number of channels generated by the F-engine
+    :type n_chans_f: int
+
+    :return: Packets per second
+    :rtype: float
+    """
+    spectra_per_sec = srate * 1e6 / (2 * n_chans_f)
+    return spectra_per_sec / N_TIMES_PER_PACKET * n_chans / n_chans_per_packet
+
+def to_complex(data):
+    """
+    Get decoded samples as complex values.
+
+    :param data: Samples, as complex64, as int8 pairs of (real, imaginary) values
+        in the last dimension, or as packed uint8 bytes, as returned by `decode_payloads`
+    :type data: numpy.ndarray
+
+    :return: Complex samples. Complex input is returned unchanged.
+    :rtype: numpy.ndarray
+    """
+    if np.iscomplexobj(data):
+        return data
+    if data.dtype == np.uint8:
+        return LUT_COMPLEX[data]
+    return data[..., 0] + np.complex64(1j) * data[..., 1]
+
+def to_packed(data, out=None):
+    """
+    Pack decoded samples into bytes, as in packet payloads, with the real part
+    in the four most significant bits and the imaginary part in the four least.
+    This is the inverse of decoding.
+
+    :param data: Samples, as complex64, whose real and imaginary parts are rounded
+        and clipped to the range -8..7, as int8 pairs of (real, imaginary) values in
+        the last dimension, or as packed uint8 bytes
+    :type data: numpy.ndarray
+    :param out: If not None, a uint8 array of the output shape into which samples are packed
+    :type out: numpy.ndarray
+
+    :return: Packed samples, as uint8
+    :rtype: numpy.ndarray
+    """
+    if np.iscomplexobj(data):
+        re = np.clip(np.round(data.real), -8, 7).astype(np.int8)
+        im = np.clip(np.round(data.imag), -8, 7).astype(np.int8)
+    elif data.dtype == np.uint8:
+        if out is None:
+            return data
+        np.copyto(out, data)
+        return out
+    else:
+        re, im = data[..., 0], data[..., 1]
+    if out is None:
+        out = np.empty(re.shape, dtype=np.uint8)
+    np.left_shift(re.view(np.uint8), 4, out=out)
+    out |= im.view(np.uint8) & 0xf
+    return out
+
+def payload_bytes(n_chans_per_packet):
+    """
+    Get the payload size of a voltage packet.
+
+    :param n_chans_per_packet: Number of channels in each packet
+    :type n_chans_per_packet: int
+
+    :return: Payload size, in bytes
+    :rtype: int
+    """
+    return n_chans_per_packet * N_TIMES_PER_PACKET * N_POLS
+
+def decode_payloads(buf, n_chans_per_packet, out_format='complex64', out=None):
+    """
+    Decode the payloads of a batch of voltage packets.
+
+    :param buf: Packets, as a 2D array of shape [n_packets, >= packet size] of uint8,
+        such as a batch of slots in a `rx.PacketRing`.
+    :type buf: numpy.ndarray
+    :param n_chans_per_packet: Number of channels in each packet
+    :type n_chans_per_packet: int
+    :param out_format: 'complex64' to decode to complex samples, 'int8' to decode
+        to pairs of (real, imaginary) integers, or 'packed' to copy the payload bytes
+        unchanged. One of OUTPUT_FORMATS.
+    :type out_format: str
+    :param out: If not None, an array of the output shape and type into which samples
+        are decoded.
+    :type out: numpy.ndarray
+
+    :return: Samples, with dimensions [packet, channel, time, polarization] of complex64
+        or packed uint8, or [packet, channel, time, polarization, real/imag] of int8
+    :rtype: numpy.ndarray
+    """
+    if out_format not in OUTPUT_FORMATS:
+        raise ValueError("Output format must be one of %s" % (list(OUTPUT_FORMATS),))
+    lut = OUTPUT_FORMATS[out_format]
+    n = len(buf)
+    nbytes = payload_bytes(n_chans_per_packet)
+    if buf.shape[1] < HEADER_BYTES + nbytes:
+        raise ValueError("Packets of %d bytes are too short for %d channels" % (buf.shape[1], n_chans_per_packet))
+    shape = (n, n_chans_per_packet, N_TIMES_PER_PACKET, N_POLS) + lut.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype=lut.dtype)
+    elif out.shape != shape or out.dtype != lut.dtype:
+        raise ValueError("Output array must have shape %s and type %s" % (shape, lut.dtype))
+    _gather(lut, buf[:, HEADER_BYTES:HEADER_BYTES + nbytes], out.reshape((n, nbytes) + lut.shape[1:]))
+    return out
+
+def _gather(lut, payload, out, idx=None):
+    """
+    Look up payload bytes, with dimensions [packet, byte], in a lookup table,
+    writing the results to `out`. `idx` is an optional intp scratch array of
+    shape [DECODE_CHUNK_PACKETS, byte].
+    """
+    if lut is LUT_PACKED:
+        np.copyto(out, payload)
+        return
+    if idx is None:
+        idx = np.empty((min(len(payload), DECODE_CHUNK_PACKETS), payload.shape[1]), dtype=np.intp)
+    for i in range(0, len(payload), len(idx)):
+        n = min(len(idx), len(payload) - i)
+        np.copyto(idx[0:n], payload[i:i + n], casting='unsafe')
+        # Bytes are always in range, so clipping skips the bounds check
+        np.take(lut, idx[0:n], axis=0, out=out[i:i + n], mode='clip')
+
+def decode_packets(buf, n_chans_per_packet=None, out_format='complex64', out=None):
+    """
+    Decode the headers and payloads of a batch of voltage packets.
+
+    :param buf: Packets, as a 2D array of shape [n_packets, >= packet size] of uint8
+    :type buf: numpy.ndarray
+    :param n_chans_per_packet: Number of channels in each packet. If None, this is
+        taken from the packet headers, which must all agree.
+    :type n_chans_per_packet: int
+    :param out_format: Output sample format. One of OUTPUT_FORMATS.
+    :type out_format: str
+    :param out: If not None, an array into which samples are decoded. See `decode_payloads`.
+    :type out: numpy.ndarray
+
+    :return: headers, data. Structured array of headers, with fields as in HEADER_DTYPE,
+        and samples, as returned by `decode_payloads`.
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    headers = decode_headers(buf)
+    if n_chans_per_packet is None:
+        if len(headers) == 0:
+            raise ValueError("Number of channels must be given to decode an empty batch")
+        n_chans_per_packet = int(headers['n_chans'][0])
+        if np.any(headers['n_chans'] != n_chans_per_packet):
+            raise ValueError("Packets in a batch must all have the same number of channels")
+    return headers, decode_payloads(buf, n_chans_per_packet, out_format=out_format, out=out)
+
+class VoltageDecoder(object):
+    """
+    Decode batches of voltage packets into a reusable output buffer, so
+    that no memory is allocated per batch.
+
+    :param n_chans_per_packet: Number of channels in each packet
+    :type n_chans_per_packet: int
+    :param max_packets: Maximum number of packets in a batch
+    :type max_packets: int
+    :param out_format: Output sample format. One of OUTPUT_FORMATS.
+    :type out_format: str
+
+    :ivar n_packets: Number of packets decoded
+    :ivar n_invalid: Number of packets discarded because their header did not
+        match `n_chans_per_packet`
+    """
+    def __init__(self, n_chans_per_packet, max_packets=1024, out_format='complex64'):
+        if out_format not in OUTPUT_FORMATS:
+            raise ValueError("Output format must be one of %s" % (list(OUTPUT_FORMATS),))
+        self.n_chans_per_packet = n_chans_per_packet
+        self.max_packets = max_packets
+        self.out_format = out_format
+        lut = OUTPUT_FORMATS[out_format]
+        self._out = np.empty((max_packets, n_chans_per_packet, N_TIMES_PER_PACKET, N_POLS) + lut.shape[1:],
+                             dtype=lut.dtype)
+        self._idx = np.empty((DECODE_CHUNK_PACKETS, payload_bytes(n_chans_per_packet)), dtype=np.intp)
+        self.n_packets = 0
+        self.n_invalid = 0
+
+    def decode(self, buf, nbytes=None):
+        """
+        Decode a batch of packets. Packets whose size or channel count does not
+        match the decoder are discarded.
+
+        :param buf: Packets, as a 2D array of shape [n_packets, >= packet size] of uint8,
+            with n_packets <= max_packets
+        :type buf: numpy.ndarray
+        :param nbytes: Size of each packet, such as the `nbytes` of a batch of `rx.PacketRing` slots.
+            If None, all packets are taken to be of the expected size.
+        :type nbytes: numpy.ndarray
+
+        :return: headers, data. Headers of the valid packets, and their samples, as
+            returned by `decode_payloads`. The samples are a view of the decoder's
+            buffer, which is overwritten by the next call.
+        :rtype: numpy.ndarray, numpy.ndarray
+        """
+        if len(buf) > self.max_packets:
+            raise ValueError("Batch of %d packets is larger than the maximum of %d" % (len(buf), self.max_packets))
+        headers = decode_headers(buf)
+        valid = headers['n_chans'] == self.n_chans_per_packet
+        if nbytes is not None:
+            valid &= np.asarray(nbytes) == HEADER_BYTES + payload_bytes(self.n_chans_per_packet)
+        if not np.all(valid):
+            buf = buf[valid]
+            headers = headers[valid]
+        n = len(buf)
+        size = payload_bytes(self.n_chans_per_packet)
+        data = self._out[0:n]
+        _gather(OUTPUT_FORMATS[self.out_format], buf[:, HEADER_BYTES:HEADER_BYTES + size],
+                data.reshape((n, size) + data.shape[4:]), self._idx)
+        self.n_packets += n
+        self.n_invalid += len(valid) - n
+        return headers, data
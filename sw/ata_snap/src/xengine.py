@@ -0,0 +1,340 @@
+"""
+A CPU X-engine, which correlates assembled voltage blocks from many
+antennas.
+
+For each channel, the voltages of all the antennas and polarizations in a
+block are arranged as a matrix X with dimensions
+[antenna x polarization, time], and the coherency matrix X X^H is computed
+by a single batched matrix multiply over channels, which NumPy passes to
+BLAS. This gives the XX, XY, YX and YY products of every baseline at once.
+Coherencies are accumulated over a configurable number of time samples,
+and the upper triangle (including autocorrelations) is converted to linear
+or Stokes products and written to a visibility file.
+
+Channels may be split between several threads, each of which multiplies
+its own range of channels. NumPy releases the GIL while BLAS runs, so this
+scales across cores. When using more than one thread, BLAS should itself be
+limited to a single thread (eg. OPENBLAS_NUM_THREADS=1) to avoid
+oversubscription.
+
+Visibility files begin with the bytes VIS_MAGIC, a little-endian uint32
+giving the length of a JSON metadata header, and the header itself. This is
+followed by fixed-size records, one per integration, with the dtype returned
+by `record_dtype`, so a file can be memory-mapped as an array of records
+(see `read_visibilities`).
+
+Example usage:
+    xeng = XEngine('obs.vis', feng_ids, chans, n_int=250000)
+    for block in assembler.get():
+        xeng.process(block.data, block.valid(), block.timestamp)
+        assembler.free(block)
+    xeng.close()
+"""
+
+import json
+import struct
+import concurrent.futures
+import numpy as np
+
+from . import voltage
+
+#: Products which can be output, and their names
+PRODUCTS = {
+    'linear': ('XX', 'XY', 'YX', 'YY'),
+    'stokes': ('I', 'Q', 'U', 'V'),
+}
+
+#: First bytes of a visibility file
+VIS_MAGIC = b'ATAVIS01'
+
+def baselines(n_ants):
+    """
+    Get the antenna pairs of all baselines, including autocorrelations,
+    in the order in which they are output.
+
+    :param n_ants: Number of antennas
+    :type n_ants: int
+
+    :return: i, j. Arrays of the antenna indices of each baseline, with i <= j.
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    return np.triu_indices(n_ants)
+
+def record_dtype(n_chans, n_baselines, n_products=4):
+    """
+    Get the dtype of an integration record in a visibility file.
+
+    :param n_chans: Number of channels
+    :type n_chans: int
+    :param n_baselines: Number of baselines
+    :type n_baselines: int
+    :param n_products: Number of products per baseline
+    :type n_products: int
+
+    :return: Record dtype, with fields 'timestamp' (first sample of the integration),
+        'n_times' (time samples integrated), 'vis' (visibilities, with dimensions
+        [channel, baseline, product]) and 'weight' (fraction of the samples which
+        were received, with dimensions [channel, baseline])
+    :rtype: numpy.dtype
+    """
+    return np.dtype([
+        ('timestamp', '<u8'),
+        ('n_times', '<u8'),
+        ('vis', '<c8', (n_chans, n_baselines, n_products)),
+        ('weight', '<f4', (n_chans, n_baselines)),
+    ])
+
+def to_products(coh, products='stokes'):
+    """
+    Convert coherencies to output products.
+
+    :param coh: Coherencies, with dimensions [..., polarization, polarization],
+        where coh[..., p, q] is the product of polarization p of the first antenna
+        and the conjugate of polarization q of the second
+    :type coh: numpy.ndarray
+    :param products: Product mode. One of PRODUCTS.
+    :type products: str
+
+    :return: Products, with dimensions [..., product], in the order given by PRODUCTS
+    :rtype: numpy.ndarray
+    """
+    xx, xy, yx, yy = coh[..., 0, 0], coh[..., 0, 1], coh[..., 1, 0], coh[..., 1, 1]
+    if products == 'linear':
+        return np.stack([xx, xy, yx, yy], axis=-1)
+    elif products == 'stokes':
+        return np.stack([xx + yy, xx - yy, xy + yx, -1j * (xy - yx)], axis=-1)
+    raise ValueError("Products must be one of %s" % (list(PRODUCTS),))
+
+class Correlator(object):
+    """
+    Accumulate the coherencies of all baselines.
+
+    :param n_ants: Number of antennas
+    :type n_ants: int
+    :param n_chans: Number of channels
+    :type n_chans: int
+    :param n_int: Number of time samples per integration. An integration ends at
+        the first block boundary at or after this many samples.
+    :type n_int: int
+    :param products: Product mode. One of PRODUCTS.
+    :type products: str
+    :param n_threads: Number of threads between which channels are split
+    :type n_threads: int
+
+    :ivar n_times: Number of time samples in the current integration
+    :ivar n_integrations: Number of integrations completed
+    """
+    def __init__(self, n_ants, n_chans, n_int, products='stokes', n_threads=1):
+        if products not in PRODUCTS:
+            raise ValueError("Products must be one of %s" % (list(PRODUCTS),))
+        self.n_ants = n_ants
+        self.n_chans = n_chans
+        self.n_int = n_int
+        self.products = products
+        self.n_threads = n_threads
+        self.bl_i, self.bl_j = baselines(n_ants)
+        self.n_baselines = len(self.bl_i)
+        n_inputs = n_ants * voltage.N_POLS
+        self._acc = np.zeros([n_chans, n_inputs, n_inputs], dtype=np.complex128)
+        self._count = np.zeros([n_chans, n_ants, n_ants], dtype=np.float64)
+        self.n_times = 0
+        self._timestamp = None
+        self.n_integrations = 0
+        # Channel range of each thread
+        edges = np.linspace(0, n_chans, n_threads + 1).astype(int)
+        self._ranges = [slice(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+        self._pool = concurrent.futures.ThreadPoolExecutor(n_threads) if n_threads > 1 else None
+
+    def _correlate(self, x, valid, chans):
+        """
+        Accumulate the coherencies of a range of channels.
+        """
+        n_times = x.shape[2]
+        # Dimensions [channel, antenna x polarization, time]
+        m = np.ascontiguousarray(x[:, chans].transpose(1, 0, 3, 2)).reshape(-1, self.n_ants * voltage.N_POLS, n_times)
+        if valid is not None:
+            v = np.ascontiguousarray(valid[:, chans].transpose(1, 0, 2), dtype=np.float32)
+            m *= np.repeat(v, voltage.N_POLS, axis=1)
+            self._count[chans] += np.matmul(v, v.swapaxes(1, 2))
+        else:
+            self._count[chans] += n_times
+        self._acc[chans] += np.matmul(m, m.conj().swapaxes(1, 2))
+
+    def process(self, data, valid=None, timestamp=0):
+        """
+        Correlate a block of voltages.
+
+        :param data: Voltages, with dimensions [antenna, channel, time, polarization] of
+            complex64, or [antenna, channel, time, polarization, real/imag] of int8, such as
+            the `data` of a `assemble.VoltageBlock`
+        :type data: numpy.ndarray
+        :param valid: Boolean mask, with dimensions [antenna, channel, time], which is True
+            where data were received, such as returned by `assemble.VoltageBlock.valid`.
+            Data which were not received are excluded. If None, all data are valid.
+        :type valid: numpy.ndarray
+        :param timestamp: Timestamp, in samples, of the first sample in the block
+        :type timestamp: int
+
+        :return: Integrations completed by this block, as a list of (timestamp, n_times, vis,
+            weight) tuples, with fields as described by `record_dtype`
+        :rtype: list
+        """
+        x = voltage.to_complex(data)
+        if self._timestamp is None:
+            self._timestamp = timestamp
+        if self._pool is None:
+            self._correlate(x, valid, slice(None))
+        else:
+            for f in [self._pool.submit(self._correlate, x, valid, r) for r in self._ranges]:
+                f.result()
+        self.n_times += x.shape[2]
+        if self.n_times >= self.n_int:
+            return [self.dump()]
+        return []
+
+    def dump(self):
+        """
+        End the current integration, and get its visibilities.
+
+        :return: timestamp, n_times, vis, weight. See `record_dtype`.
+        :rtype: tuple
+        """
+        n_times = self.n_times
+        acc = self._acc.reshape(self.n_chans, self.n_ants, voltage.N_POLS, self.n_ants, voltage.N_POLS)
+        coh = acc[:, self.bl_i, :, self.bl_j, :]
+        # Indexing two separated axes moves the baseline axis first
+        coh = coh.transpose(1, 0, 2, 3) / max(n_times, 1)
+        vis = to_products(coh, self.products).astype(np.complex64)
+        weight = (self._count[:, self.bl_i, self.bl_j] / max(n_times, 1)).astype(np.float32)
+        timestamp = self._timestamp or 0
+        self._acc[...] = 0
+        self._count[...] = 0
+        self.n_times = 0
+        self._timestamp = None
+        self.n_integrations += 1
+        return timestamp, n_times, vis, weight
+
+    def close(self):
+        """
+        Stop the correlator's threads.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+
+class VisibilityWriter(object):
+    """
+    Write integrations to a visibility file.
+
+    :param filename: File to write
+    :type filename: str
+    :param feng_ids: F-engine IDs of the antennas, in antenna order
+    :type feng_ids: list
+    :param chans: Channel numbers
+    :type chans: list
+    :param products: Product mode. One of PRODUCTS.
+    :type products: str
+    :param meta: Other entries for the file's metadata header, eg. the sample rate
+        and sky frequency
+    :type meta: dict
+    """
+    def __init__(self, filename, feng_ids, chans, products='stokes', meta=None):
+        n_ants = len(feng_ids)
+        bl_i, bl_j = baselines(n_ants)
+        self.meta = dict(meta or {})
+        self.meta.update({
+            'feng_ids': [int(f) for f in feng_ids],
+            'chans': [int(c) for c in chans],
+            'products': list(PRODUCTS[products]),
+            'baselines': [[int(i), int(j)] for i, j in zip(bl_i, bl_j)],
+        })
+        self.dtype = record_dtype(len(chans), len(bl_i), len(PRODUCTS[products]))
+        self.fh = open(filename, 'wb')
+        header = json.dumps(self.meta).encode()
+        self.fh.write(VIS_MAGIC + struct.pack('<I', len(header)) + header)
+        self.n_records = 0
+
+    def write(self, timestamp, n_times, vis, weight):
+        """
+        Write an integration.
+
+        :param timestamp: Timestamp of the first sample of the integration
+        :type timestamp: int
+        :param n_times: Number of time samples integrated
+        :type n_times: int
+        :param vis: Visibilities, with dimensions [channel, baseline, product]
+        :type vis: numpy.ndarray
+        :param weight: Weights, with dimensions [channel, baseline]
+        :type weight: numpy.ndarray
+        """
+        rec = np.zeros(1, dtype=self.dtype)
+        rec['timestamp'] = timestamp
+        rec['n_times'] = n_times
+        rec['vis'] = vis
+        rec['weight'] = weight
+        self.fh.write(rec.tobytes())
+        self.n_records += 1
+
+    def close(self):
+        self.fh.close()
+
+def read_visibilities(filename):
+    """
+    Read a visibility file.
+
+    :param filename: File to read
+    :type filename: str
+
+    :return: meta, records. The metadata header, and a read-only memory map of the
+        integration records, with the dtype given by `record_dtype`
+    :rtype: dict, numpy.memmap
+    """
+    with open(filename, 'rb') as fh:
+        magic = fh.read(len(VIS_MAGIC))
+        if magic != VIS_MAGIC:
+            raise ValueError("%s is not a visibility file" % filename)
+        n, = struct.unpack('<I', fh.read(4))
+        meta = json.loads(fh.read(n).decode())
+    offset = len(VIS_MAGIC) + 4 + n
+    dtype = record_dtype(len(meta['chans']), len(meta['baselines']), len(meta['products']))
+    return meta, np.memmap(filename, dtype=dtype, mode='r', offset=offset)
+
+class XEngine(object):
+    """
+    Correlate voltage blocks and write the visibilities to a file.
+
+    :param filename: Visibility file to write
+    :type filename: str
+    :param feng_ids: F-engine IDs of the antennas, in antenna order
+    :type feng_ids: list
+    :param chans: Channel numbers
+    :type chans: list
+    :param n_int: Number of time samples per integration
+    :type n_int: int
+    :param products: Product mode. One of PRODUCTS.
+    :type products: str
+    :param n_threads: Number of threads between which channels are split
+    :type n_threads: int
+    :param meta: Other entries for the file's metadata header
+    :type meta: dict
+    """
+    def __init__(self, filename, feng_ids, chans, n_int, products='stokes', n_threads=1, meta=None):
+        meta = dict(meta or {}, n_int=n_int)
+        self.correlator = Correlator(len(feng_ids), len(chans), n_int, products=products, n_threads=n_threads)
+        self.writer = VisibilityWriter(filename, feng_ids, chans, products=products, meta=meta)
+
+    def process(self, data, valid=None, timestamp=0):
+        """
+        Correlate a block of voltages, writing any integrations it completes.
+        See `Correlator.process`.
+        """
+        for integration in self.correlator.process(data, valid, timestamp):
+            self.writer.write(*integration)
+
+    def close(self):
+        """
+        Write the final, partial integration, if any, and close the file.
+        """
+        if self.correlator.n_times > 0:
+            self.writer.write(*self.correlator.dump())
+        self.correlator.close()
+        self.writer.close()
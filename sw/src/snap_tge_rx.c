@@ -42,10 +42,11 @@ main (int argc, char **argv)
   int starttime;
   int elapsed;
   int wait = 1;
-  int header;
+  uint64_t header;
   int sub_spectra_index;
   unsigned long spectra_index;
-  unsigned long last_spectra_written = -1;
+  unsigned long last_spectra_written = 0;
+  int have_written = 0;
   unsigned long missing_spectra;
   long int last_header;
   int pkt_cnt = 0;
@@ -212,8 +213,9 @@ main (int argc, char **argv)
       //}
       // Figure out if any spectra are missing and repeat this spectra
       // to compensate. Lazy, but this should very rarely happen.
-      if (last_spectra_written > 0) {
-        missing_spectra = last_spectra_written - spectra_index;
+      missing_spectra = 0;
+      if (have_written && spectra_index > last_spectra_written + 1) {
+        missing_spectra = spectra_index - last_spectra_written - 1;
       }
       for (i=missing_spectra; i>0; i--) {
         fprintf(stderr, "Writing %lu missing spectra\n", missing_spectra);
@@ -223,6 +225,7 @@ main (int argc, char **argv)
       fwrite(spec_xx, N_CHANNELS * sizeof(float), 1, fxx_p);
       fwrite(spec_yy, N_CHANNELS * sizeof(float), 1, fyy_p);
       last_spectra_written = spectra_index;
+      have_written = 1;
       if (elapsed > inttime) {
         break;
       }